@@ -0,0 +1,29 @@
+"""Benchmarks that run the bot's code against a fake guild and an in-memory database.
+
+Importing this package points the bot at an in-memory SQLite database and fills in placeholder ids for any settings
+missing from the environment, so that no benchmark can touch a real database or needs a `.env` file.
+"""
+
+import os
+
+os.environ["DB_PATH"] = ":memory:"
+
+_PLACEHOLDER_SETTINGS = {
+    "TANK": "1",
+    "SUPPORT": "2",
+    "ASSASSIN": "3",
+    "OFFLANE": "4",
+    "TANK_FILL": "5",
+    "SUPPORT_FILL": "6",
+    "ASSASSIN_FILL": "7",
+    "OFFLANE_FILL": "8",
+    "ADMIN": "9",
+    "QUEUED": "10",
+    "LOBBY_CHANNEL_ID": "11",
+    "TEAM_1_CHANNEL_ID": "12",
+    "TEAM_2_CHANNEL_ID": "13",
+    "GENERAL_CHANNEL_ID": "14",
+    "MATCHMAKING_BUDGET_MS": "0",
+}
+for setting, value in _PLACEHOLDER_SETTINGS.items():
+    os.environ.setdefault(setting, value)
@@ -0,0 +1,107 @@
+"""Lightweight stand-ins for discord members, and synthetic player ratings to go with them."""
+
+import random
+from typing import List, Self, Sequence
+
+import trueskill
+
+from database.db import DBGlobalSession
+from database.models.player_data import RATED_ROLES, PlayerData
+from util.env_load import (
+    ASSASSIN_FILL_ID,
+    ASSASSIN_ID,
+    OFFLANE_FILL_ID,
+    OFFLANE_ID,
+    SUPPORT_FILL_ID,
+    SUPPORT_ID,
+    TANK_FILL_ID,
+    TANK_ID,
+)
+
+# (main role name, main role id, fill role name, fill role id), in role category order.
+ROLES = [
+    ("Tank", TANK_ID, "Tank (Fill)", TANK_FILL_ID),
+    ("Support", SUPPORT_ID, "Support (Fill)", SUPPORT_FILL_ID),
+    ("Assassin", ASSASSIN_ID, "Assassin (Fill)", ASSASSIN_FILL_ID),
+    ("Offlane", OFFLANE_ID, "Offlane (Fill)", OFFLANE_FILL_ID),
+]
+
+# How likely each role is to be a player's main, roughly matching the slots each role has in a game.
+DEFAULT_MAIN_WEIGHTS = (2, 2, 4, 2)
+DEFAULT_FILL_CHANCE = 0.3
+
+
+class FakeRole:
+    """The parts of a discord role the bot reads."""
+
+    def __init__(self: Self, role_id: int, name: str) -> None:
+        """Init that takes in the role's id and name."""
+        self.id = role_id
+        self.name = name
+
+
+class FakeMember:
+    """The parts of a discord member the bot reads."""
+
+    def __init__(self: Self, user_id: int, roles: List[FakeRole]) -> None:
+        """Init that takes in the member's user id and roles."""
+        self.id = user_id
+        self.roles = roles
+        self.name = f"player{user_id}"
+        self.display_name = self.name
+
+    def __repr__(self: Self) -> str:
+        """Override repr to return the member's name."""
+        return self.name
+
+
+def make_members(
+    count: int,
+    rng: random.Random,
+    main_weights: Sequence[float] = DEFAULT_MAIN_WEIGHTS,
+    fill_chance: float = DEFAULT_FILL_CHANCE,
+    first_user_id: int = 1000,
+) -> List[FakeMember]:
+    """Makes members with one main role each, drawn from `main_weights`, and each other role as a fill by chance."""
+    members = []
+    for user_id in range(first_user_id, first_user_id + count):
+        main = rng.choices(range(len(ROLES)), weights=main_weights)[0]
+        roles = [FakeRole(ROLES[main][1], ROLES[main][0])]
+        for role, (_, _, fill_name, fill_id) in enumerate(ROLES):
+            if role != main and rng.random() < fill_chance:
+                roles.append(FakeRole(fill_id, fill_name))
+        members.append(FakeMember(user_id, roles))
+    return members
+
+
+def make_player_data(user_id: int, rng: random.Random, max_games: int = 80) -> PlayerData:
+    """Makes a player whose ratings look like they have played a random number of games on each role.
+
+    Sigma shrinks with every game played, and mu drifts further from the default the more games there are.
+    """
+    ratings = {}
+    for role in RATED_ROLES:
+        games = int(rng.expovariate(1 / 15)) % max_games
+        sigma = max(1.0, trueskill.SIGMA * 0.95**games)
+        mu = rng.gauss(trueskill.MU, trueskill.SIGMA - sigma)
+        ratings[f"{role}_mu"] = mu
+        ratings[f"{role}_sigma"] = sigma
+        ratings[f"{role}_games_played"] = games
+        ratings[f"{role}_games_won"] = rng.randint(0, games)
+    return PlayerData(user_id=user_id, **ratings)
+
+
+async def seed_player_data(members: Sequence[FakeMember], rng: random.Random, new_player_chance: float = 0.1) -> None:
+    """Adds synthetic ratings to the database for the members, leaving some as new players with default ratings."""
+    db_session = DBGlobalSession().new_session()
+    try:
+        for member in members:
+            if await db_session.get(PlayerData, member.id) is not None:
+                continue
+            if rng.random() < new_player_chance:
+                db_session.add(PlayerData(user_id=member.id))
+            else:
+                db_session.add(make_player_data(member.id, rng))
+        await db_session.commit()
+    finally:
+        await db_session.close()
@@ -0,0 +1,120 @@
+"""Times leaderboard rank and page lookups against a full scan of the players table, at a large number of players.
+
+Run from the repository root with `python -m benchmarks.leaderboard_benchmark`. Synthetic players are written to the
+in-memory database and read into the `RatingStore`, then the JSON file written records how long building the
+leaderboards took, and the median time of a rank lookup, a page lookup and a reported rating on the leaderboard,
+next to counting the players ranked above someone with a query.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import platform
+import random
+import statistics
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import func, insert, select
+
+from benchmarks.fakes import make_player_data
+from benchmarks.matchmaking_benchmark import get_commit, time_await, time_call
+from database.db import DBGlobalSession, init_db
+from database.leaderboard import CONSERVATIVE_SIGMAS, conservative_rating
+from database.models.player_data import RATED_ROLES, PlayerData, RatingStore
+
+logger = logging.getLogger(__name__)
+
+
+def median_call_seconds(func: Callable[[int], Any], count: int) -> float:
+    """Calls `func` with 0 to `count` - 1, returning the median seconds a call took."""
+    return statistics.median(time_call(lambda: func(i))[0] for i in range(count))
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Benchmarks the leaderboards of `args.players` synthetic players on `args.role`."""
+    await init_db()
+    rng = random.Random(args.seed)
+    players = [make_player_data(user_id, rng) for user_id in range(1000, 1000 + args.players)]
+    columns = PlayerData.__table__.c
+    db_session = DBGlobalSession().new_session()
+    try:
+        await db_session.execute(
+            insert(PlayerData),
+            [{column.name: getattr(player, column.name) for column in columns} for player in players],
+        )
+        await db_session.commit()
+    finally:
+        await db_session.close()
+
+    store = RatingStore()
+    load_seconds, _ = time_call(lambda: store.add_rows(players))
+    leaderboard = store.leaderboards[args.role]
+    ranked: List[int] = [user_id for user_id, _ in leaderboard.page(0, len(leaderboard))]
+    lookups = [rng.choice(ranked) for _ in range(args.lookups)]
+    pages = [rng.randrange(0, len(leaderboard)) for _ in range(args.lookups)]
+    ratings = [conservative_rating(rng.gauss(25, 5), rng.uniform(1, 8)) for _ in range(args.lookups)]
+
+    rank_seconds = median_call_seconds(lambda i: leaderboard.rank(lookups[i]), args.lookups)
+    page_seconds = median_call_seconds(lambda i: leaderboard.page(pages[i], 10), args.lookups)
+    update_seconds = median_call_seconds(lambda i: leaderboard.set(lookups[i], ratings[i]), args.lookups)
+
+    mu, sigma = columns[f"{args.role}_mu"], columns[f"{args.role}_sigma"]
+    # Counting the players rated above someone, as ranking them without the leaderboards would.
+    scan = select(func.count()).select_from(PlayerData).where(columns[f"{args.role}_games_played"] > 0)
+    scan_times = []
+    db_session = DBGlobalSession().new_session()
+    try:
+        for user_id in lookups[: args.scans]:
+            rating = leaderboard.ratings[user_id]
+            seconds, _ = await time_await(db_session.scalar(scan.where(mu - CONSERVATIVE_SIGMAS * sigma > rating)))
+            scan_times.append(seconds)
+    finally:
+        await db_session.close()
+    scan_seconds = statistics.median(scan_times)
+
+    logger.info(
+        f"{len(leaderboard)} ranked {args.role} players of {args.players}: built in {load_seconds:.2f} s, "
+        f"rank {rank_seconds * 1e6:.1f} us, page {page_seconds * 1e6:.1f} us, update {update_seconds * 1e6:.1f} us, "
+        f"scanning query {scan_seconds * 1000:.1f} ms"
+    )
+    return {
+        "commit": get_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {
+            "players": args.players,
+            "role": args.role,
+            "lookups": args.lookups,
+            "scans": args.scans,
+            "seed": args.seed,
+        },
+        "ranked_players": len(leaderboard),
+        "load_seconds": load_seconds,
+        "rank_seconds_median": rank_seconds,
+        "page_seconds_median": page_seconds,
+        "update_seconds_median": update_seconds,
+        "scan_seconds_median": scan_seconds,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    """Parses the benchmark's command line options."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--players", type=int, default=100000, help="Number of synthetic players.")
+    parser.add_argument("--role", choices=RATED_ROLES, default="assassin", help="Role whose leaderboard to time.")
+    parser.add_argument("--lookups", type=int, default=1000, help="Rank and page lookups and updates to time.")
+    parser.add_argument("--scans", type=int, default=20, help="Scanning queries to time.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic players.")
+    parser.add_argument("--output", default="leaderboard_benchmark.json", help="File to write the JSON results to.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    report = asyncio.run(run(args))
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    logger.info(f"Results written to {args.output}")
@@ -0,0 +1,193 @@
+"""Times the matchmaking pipeline in `commands.game` on synthetic queues, and writes the results to a JSON file.
+
+Run from the repository root with `python -m benchmarks.matchmaking_benchmark`, and compare the JSON files written
+on different commits to spot regressions.
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import platform
+import random
+import statistics
+import subprocess
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from benchmarks.fakes import DEFAULT_FILL_CHANCE, DEFAULT_MAIN_WEIGHTS, FakeMember, make_members, seed_player_data
+from commands import game, matchmaking
+from commands.queue import Queue, get_matchmaking_executor
+from database.db import init_db
+from database.models.player_data import bump_ratings_version
+from util.env_load import MATCHMAKING_WORKERS
+from util.exceptions import NoValidGameException
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZES = list(range(10, 65, 5))
+
+# The guild whose queue the benchmark starts games for, which no player ever joins, so every game is searched for.
+BENCHMARK_GUILD_ID = 0
+
+
+def time_call(func: Callable[[], Any]) -> Tuple[float, Any]:
+    """Runs `func` once, returning how many seconds it took along with its result."""
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+async def time_await(awaitable: Awaitable[Any]) -> Tuple[float, Any]:
+    """Awaits `awaitable`, returning how many seconds it took along with its result."""
+    start = time.perf_counter()
+    result = await awaitable
+    return time.perf_counter() - start, result
+
+
+def get_commit() -> Optional[str]:
+    """Returns the current git commit, or None when not run from a git checkout."""
+    try:
+        output = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+async def start_matchmaking_workers() -> None:
+    """Starts every matchmaking worker and has it import the search, so none of that is timed."""
+    loop = asyncio.get_running_loop()
+    empty = matchmaking.QueueSnapshot(user_ids=[], costs=[], mus=[], sigmas=[])
+    await asyncio.gather(
+        *(
+            loop.run_in_executor(get_matchmaking_executor(), matchmaking.search_best_game, empty)
+            for _ in range(MATCHMAKING_WORKERS)
+        )
+    )
+
+
+async def find_queue_game_or_none(players: Sequence[FakeMember]) -> Optional[Dict[str, Any]]:
+    """Runs `find_queue_game` the way `/start` does, returning None when the players can not make a valid game."""
+    try:
+        return await game.find_queue_game(Queue(BENCHMARK_GUILD_ID), list(players))
+    except NoValidGameException:
+        return None
+
+
+async def benchmark_queue(players: Sequence[FakeMember], repeats: int, valid_games_limit: int) -> Dict[str, Any]:
+    """Times each stage of matchmaking for one queue.
+
+    `find_valid_games` is only timed up to its first `valid_games_limit` games, since large queues have billions.
+    `find_queue_game` is timed `repeats` times, bumping the ratings version first so the matchmaking cache misses and
+    the players are searched in the matchmaking process pool.
+    """
+    seconds, valid_games = time_call(
+        lambda: list(itertools.islice(game.find_valid_games(list(players)), valid_games_limit))
+    )
+    valid_games_result = {
+        "games": len(valid_games),
+        "seconds": seconds,
+        "games_per_second": len(valid_games) / seconds if seconds else None,
+    }
+
+    seconds, splits = time_call(
+        lambda: sum(1 for valid_game in valid_games for _ in game.get_team_combinations(valid_game))
+    )
+    team_combinations_result = {
+        "splits": splits,
+        "seconds": seconds,
+        "splits_per_second": splits / seconds if seconds else None,
+    }
+
+    best_game_seconds: List[float] = []
+    best_game: Dict[str, Any] = {}
+    for _ in range(repeats):
+        bump_ratings_version()
+        seconds, best_game = await time_await(find_queue_game_or_none(players))
+        best_game_seconds.append(seconds)
+    best_game_result = {
+        "seconds_min": min(best_game_seconds),
+        "seconds_median": statistics.median(best_game_seconds),
+        "seconds": best_game_seconds,
+        "quality": best_game["quality"] if best_game else None,
+        "coverage": best_game["coverage"] if best_game else None,
+    }
+
+    return {
+        "queue_size": len(players),
+        "find_valid_games": valid_games_result,
+        "get_team_combinations": team_combinations_result,
+        "find_queue_game": best_game_result,
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Benchmarks every queue size, with each queue holding the first players of one shared pool."""
+    await init_db()
+    rng = random.Random(args.seed)
+    pool = make_members(max(args.sizes), rng, args.main_weights, args.fill_chance)
+    await seed_player_data(pool, rng, args.new_player_chance)
+    await start_matchmaking_workers()
+
+    results = []
+    for size in args.sizes:
+        result = await benchmark_queue(pool[:size], args.repeats, args.valid_games_limit)
+        logger.info(
+            f"{size} players: find_queue_game {result['find_queue_game']['seconds_median'] * 1000:.1f} ms, "
+            f"quality {result['find_queue_game']['quality']}"
+        )
+        results.append(result)
+
+    return {
+        "commit": get_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {
+            "sizes": args.sizes,
+            "repeats": args.repeats,
+            "seed": args.seed,
+            "valid_games_limit": args.valid_games_limit,
+            "main_weights": list(args.main_weights),
+            "fill_chance": args.fill_chance,
+            "new_player_chance": args.new_player_chance,
+        },
+        "results": results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    """Parses the benchmark's command line options."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_QUEUE_SIZES, help="Queue sizes to time.")
+    parser.add_argument("--repeats", type=int, default=3, help="Times to run find_queue_game per queue size.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic players.")
+    parser.add_argument(
+        "--valid-games-limit", type=int, default=2000, help="Most valid games to pull from find_valid_games."
+    )
+    parser.add_argument(
+        "--main-weights",
+        type=float,
+        nargs=4,
+        default=DEFAULT_MAIN_WEIGHTS,
+        metavar=("TANK", "SUPPORT", "ASSASSIN", "OFFLANE"),
+        help="Relative chance of each role being a player's main.",
+    )
+    parser.add_argument(
+        "--fill-chance", type=float, default=DEFAULT_FILL_CHANCE, help="Chance of each other role being a fill."
+    )
+    parser.add_argument(
+        "--new-player-chance", type=float, default=0.1, help="Chance of a player still having default ratings."
+    )
+    parser.add_argument("--output", default="matchmaking_benchmark.json", help="File to write the JSON results to.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    report = asyncio.run(run(args))
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    logger.info(f"Results written to {args.output}")
@@ -0,0 +1,246 @@
+"""Find the best game with one mixed integer program that picks players, roles and teams together.
+
+Where `commands.matchmaking.search_best_game` enumerates games and scores every split of each, this models the
+whole queue at once: one binary variable per player, role category they signed up for and team, with the
+constraints of a valid game, and hands it to the HiGHS solver through `scipy.optimize.milp`.
+
+Match quality is not linear in the players picked, so the program is solved a few times, each time linearized
+around the sigma total of the previous solution:
+
+- When the target quality is reachable at that sigma total, quality is closest to the target at a known mu
+  difference between the teams. The program minimizes the distance from that mu difference, with the target mu
+  difference linearized in the sigma total.
+- When it is not, quality is highest with no mu difference and the lowest sigma total. The gap to the target grows
+  with the sigma total and with the square of the mu difference, so the program minimizes their sum, with the square
+  approximated by tangent lines.
+
+Every role a player is placed on as a fill adds `FILL_WEIGHT` to the objective, so players stay on their main
+role unless filling brings the game noticeably closer to the target. Each solution's players and roles are then
+scored over every team split, same as the enumerating search.
+
+The penalty is soft, so unlike the search the program can put a player on a fill when the same players could all
+play their mains. It is also far slower than the search and rarely finds a better game, so the bot never uses it.
+It is only kept for `benchmarks.solver_benchmark` to compare against.
+"""
+
+import math
+import time
+from typing import Optional, Self, Tuple
+
+import numpy as np
+from scipy.optimize import Bounds, LinearConstraint, milp
+
+from commands.matchmaking import (
+    GAME_SIZE,
+    INVALID_COST,
+    QUALITY_TOLERANCE,
+    ROLE_SLOTS,
+    TARGET_QUALITY,
+    GameResult,
+    CandidateGames,
+    QueueSnapshot,
+    SearchStats,
+    _score_games,
+    game_score,
+    store_game,
+)
+
+# Most times the program is solved, each linearized around the previous solution.
+MILP_ITERATIONS = 4
+
+# How much placing a player on a fill role adds to the objective, in mu of distance from the target mu difference.
+FILL_WEIGHT = 0.1
+
+# Mu differences at which the square of the mu difference is approximated by a tangent line.
+_SQUARE_TANGENTS = (0.0, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0)
+
+
+def target_mu_difference(sigma_squared_total: float, beta: float) -> Tuple[float, float]:
+    """Returns the mu difference at which quality equals `TARGET_QUALITY`, and its slope in the sigma total.
+
+    Quality is `sqrt(10 beta^2 / V) * exp(-d^2 / 2V)` with `V = 10 beta^2 + sigma total`, so the target is met at
+    `d^2 = 2V ln(sqrt(10 beta^2 / V) / TARGET_QUALITY)`. Returns (0.0, 0.0) when no mu difference reaches it.
+    """
+    variance = GAME_SIZE * beta**2 + sigma_squared_total
+    log_ratio = math.log(math.sqrt(GAME_SIZE * beta**2 / variance) / TARGET_QUALITY)
+    if log_ratio <= 0:
+        return 0.0, 0.0
+    difference = math.sqrt(2 * variance * log_ratio)
+    return difference, (2 * log_ratio - 1) / (2 * difference)
+
+
+def mu_difference_tolerance(mu_difference: float, sigma_squared_total: float, beta: float) -> float:
+    """Returns how far the mu difference can move from `mu_difference` while quality moves half of `QUALITY_TOLERANCE`.
+
+    Half, so that the error in linearizing the target mu difference does not take the game out of tolerance.
+    """
+    variance = GAME_SIZE * beta**2 + sigma_squared_total
+    # The derivative of quality in the mu difference is quality * difference / variance.
+    return QUALITY_TOLERANCE / 2 * variance / (TARGET_QUALITY * mu_difference)
+
+
+class GameProgram:
+    """The constraints of a valid game over a queue, to be solved with different objectives.
+
+    Variables are one binary per eligible (player, role category) pair on team 1, the same on team 2, then the
+    continuous mu difference between the teams and the continuous error the objective minimizes.
+    """
+
+    def __init__(self: Self, snapshot: QueueSnapshot, required: Optional[int] = None) -> None:
+        """Init that takes in the queue, and optionally the index of a player every game must include."""
+        self.snapshot = snapshot
+        self.pairs = [
+            (index, role)
+            for index, player_costs in enumerate(snapshot.costs)
+            for role, cost in enumerate(player_costs)
+            if cost < INVALID_COST
+        ]
+        pair_count = len(self.pairs)
+        self.size = 2 * pair_count + 2
+        self.difference, self.error = 2 * pair_count, 2 * pair_count + 1
+        players = np.array([index for index, _ in self.pairs], dtype=int)
+        roles = np.array([role for _, role in self.pairs], dtype=int)
+        self.mus = np.array([snapshot.mus[index][role] for index, role in self.pairs], dtype=float)
+        self.sigmas_squared = np.square([snapshot.sigmas[index][role] for index, role in self.pairs])
+        self.role_costs = np.array([snapshot.costs[index][role] for index, role in self.pairs], dtype=float)
+
+        rows = []
+        lower = []
+        upper = []
+        # Each player plays at most once, and the required player exactly once.
+        for index in range(len(snapshot.costs)):
+            on_player = np.tile(players == index, 2)
+            if not on_player.any():
+                continue
+            rows.append(np.append(on_player, [0, 0]))
+            lower.append(1 if index == required else 0)
+            upper.append(1)
+        # Each team has one tank, one support, two assassins and one offlane.
+        for team in range(2):
+            for role, slots in enumerate(ROLE_SLOTS):
+                on_role = np.zeros(self.size)
+                on_role[team * pair_count : (team + 1) * pair_count] = roles == role
+                rows.append(on_role)
+                lower.append(slots // 2)
+                upper.append(slots // 2)
+        # The mu difference is team 1's mu total minus team 2's. Swapping teams keeps the quality, so team 1 is
+        # always the stronger team and the difference is never negative.
+        rows.append(np.concatenate([self.mus, -self.mus, [-1, 0]]))
+        lower.append(0)
+        upper.append(0)
+        self.constraints = [LinearConstraint(np.array(rows), lower, upper)]
+        self.integrality = np.append(np.ones(2 * pair_count), [0, 0])
+        self.bounds = Bounds(np.zeros(self.size), np.append(np.ones(2 * pair_count), [np.inf, np.inf]))
+
+    def sigma_row(self: Self) -> np.ndarray:
+        """Returns the row giving the sigma squared total of a game."""
+        return np.concatenate([self.sigmas_squared, self.sigmas_squared, [0, 0]])
+
+    def solve(self: Self, sigma_squared_total: float, time_limit: Optional[float]) -> Tuple[Optional[GameResult], bool]:
+        """Solves the program linearized around `sigma_squared_total`.
+
+        Returns the best split of the players and roles picked, or None if there is no valid game, and whether the
+        solver ran out of time.
+        """
+        beta = self.snapshot.beta
+        target, slope = target_mu_difference(sigma_squared_total, beta)
+        fills = np.concatenate([self.role_costs, self.role_costs, [0, 0]]) * FILL_WEIGHT
+        sigma_row = self.sigma_row()
+        difference = np.zeros(self.size)
+        difference[self.difference] = 1
+        error = np.zeros(self.size)
+        error[self.error] = 1
+        if target > 0:
+            # error >= |difference - (target + slope * (sigma total - sigma_squared_total))| - tolerance, so that
+            # every game within tolerance of the target scores the same and the solver can stop at the first one.
+            offset = target - slope * sigma_squared_total
+            tolerance = mu_difference_tolerance(target, sigma_squared_total, beta)
+            rows = [difference - slope * sigma_row - error, -difference + slope * sigma_row - error]
+            upper = [offset + tolerance, -offset + tolerance]
+            objective = error + fills
+        else:
+            # error >= each tangent of difference squared, and the objective adds the sigma total.
+            rows = [2 * point * difference - error for point in _SQUARE_TANGENTS]
+            upper = [point**2 for point in _SQUARE_TANGENTS]
+            objective = error + sigma_row + fills
+        constraints = [*self.constraints, LinearConstraint(np.array(rows), -np.inf, upper)]
+        options = {} if time_limit is None else {"time_limit": max(time_limit, 0.001)}
+        result = milp(
+            objective,
+            integrality=self.integrality,
+            bounds=self.bounds,
+            constraints=constraints,
+            options=options,
+        )
+        # Status 1 is the time or iteration limit, which still returns the best solution found if there is one.
+        timed_out = result.status == 1
+        if result.x is None:
+            return None, timed_out
+
+        pair_count = len(self.pairs)
+        picked = [
+            self.pairs[position % pair_count] for position in np.flatnonzero(np.round(result.x[: 2 * pair_count]) == 1)
+        ]
+        subset = [index for index, _ in picked]
+        roles = [role for _, role in picked]
+        mus = np.asarray(self.snapshot.mus, dtype=float)
+        sigmas = np.asarray(self.snapshot.sigmas, dtype=float)
+        return _score_games([(subset, roles)], mus, sigmas, beta), timed_out
+
+
+def solve_best_game(
+    snapshot: QueueSnapshot,
+    budget: Optional[float] = None,
+    required: Optional[int] = None,
+    incumbent: Optional[GameResult] = None,
+    keep: int = 1,
+) -> Tuple[Optional[GameResult], SearchStats]:
+    """Finds a valid game with a match quality close to `TARGET_QUALITY` by mixed integer programming.
+
+    Takes the same `budget`, `required` player, `incumbent` game and number of games to `keep` as
+    `search_best_game`, though only the solutions of its few programs can be kept. The first program is
+    linearized around the lowest sigma total of any 10 players, and each later one around the previous solution,
+    until a game is within `QUALITY_TOLERANCE` of the target, the solution stops changing, or `MILP_ITERATIONS` is
+    reached.
+
+    The programs are not exhaustive, so the returned `SearchStats` only count the search space as covered when the
+    game found is within `QUALITY_TOLERANCE` of the target. Wait bonuses are not part of the programs, they only
+    decide between their solutions and the incumbent by `game_score`.
+
+    Returns the quality and each team as (player index, role category) pairs, or None if there is no valid game.
+    """
+    stats = SearchStats(budget)
+    bonuses = snapshot.wait_bonuses()
+    candidates = CandidateGames(keep)
+    if incumbent is not None:
+        candidates.push(game_score(incumbent, bonuses), incumbent)
+    if incumbent is None or abs(TARGET_QUALITY - incumbent[0]) > QUALITY_TOLERANCE:
+        _solve_programs(snapshot, required, stats, candidates)
+    else:
+        stats.covered = 1.0
+    stats.candidates = [(score, store_game(snapshot.user_ids, game)) for score, game in candidates.ranked()]
+    return candidates.best(), stats
+
+
+def _solve_programs(
+    snapshot: QueueSnapshot, required: Optional[int], stats: SearchStats, candidates: CandidateGames
+) -> None:
+    """Solves programs linearized around each solution in turn, keeping every solution in `candidates`."""
+    bonuses = snapshot.wait_bonuses()
+    program = GameProgram(snapshot, required)
+    sigma_squared_total = sum(sorted(min(sigma**2 for sigma in sigmas) for sigmas in snapshot.sigmas)[:GAME_SIZE])
+    for _ in range(MILP_ITERATIONS):
+        time_limit = None if stats.deadline is None else stats.deadline - time.monotonic()
+        candidate, timed_out = program.solve(sigma_squared_total, time_limit)
+        stats.games_scored += 1
+        stats.timed_out = stats.timed_out or timed_out
+        if candidate is None:
+            break
+        candidates.push(game_score(candidate, bonuses), candidate)
+        if abs(TARGET_QUALITY - candidate[0]) <= QUALITY_TOLERANCE:
+            stats.covered = 1.0
+            break
+        next_total = sum(snapshot.sigmas[index][role] ** 2 for index, role in candidate[1] + candidate[2])
+        if math.isclose(next_total, sigma_squared_total) or stats.out_of_time():
+            break
+        sigma_squared_total = next_total
@@ -0,0 +1,237 @@
+"""Replays a trace of queue joins and leaves under different matchmaking wait weights, and writes the results to JSON.
+
+Run from the repository root with `python -m benchmarks.queue_simulator`. The trace is either one recorded by the
+bot with `QUEUE_TRACE_PATH` set, passed with `--trace`, or a synthetic one of players joining at random and leaving
+after a random session.
+
+Every `--game-interval` minutes, as many games are started as there are free pairs of team channels and enough
+waiting players, the same way `/start` does. Players in a game stay queued and wait again once it ends, unless the
+trace has them leave first. For every value of `--wait-weights` the JSON file records how many games were played
+and players seated per hour, how long players waited before each game, how many left while waiting, and how
+close games were to `TARGET_QUALITY`.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import random
+import statistics
+from typing import Any, Dict, List, Optional, Self, Tuple
+
+import trueskill
+
+from benchmarks.fakes import DEFAULT_FILL_CHANCE, make_members, make_player_data
+from benchmarks.matchmaking_benchmark import get_commit
+from commands import matchmaking
+from commands.queue import get_role_costs
+from database.models.player_data import RATED_ROLES
+
+logger = logging.getLogger(__name__)
+
+# A queue event as recorded by `commands.queue.record_queue_event`.
+TraceEvent = Dict[str, Any]
+
+
+def load_trace(path: str) -> List[TraceEvent]:
+    """Reads a trace recorded by the bot, one JSON event per line, in time order."""
+    with open(path) as trace_file:
+        events = [json.loads(line) for line in trace_file if line.strip()]
+    return sorted(events, key=lambda event: event["time"])
+
+
+def make_trace(
+    rng: random.Random, hours: float, joins_per_hour: float, session_minutes: float, new_player_chance: float
+) -> List[TraceEvent]:
+    """Makes a trace of players joining at random at `joins_per_hour`, each leaving after a random session.
+
+    Sessions last `session_minutes` on average, and players' roles and ratings are drawn the same way as in the
+    other benchmarks.
+    """
+    events = []
+    time = rng.expovariate(joins_per_hour / 3600)
+    user_id = 1000
+    while time < hours * 3600:
+        member = make_members(1, rng, fill_chance=DEFAULT_FILL_CHANCE, first_user_id=user_id)[0]
+        if rng.random() < new_player_chance:
+            mus, sigmas = [trueskill.MU] * len(RATED_ROLES), [trueskill.SIGMA] * len(RATED_ROLES)
+        else:
+            player_data = make_player_data(user_id, rng)
+            mus = [getattr(player_data, f"{role}_mu") for role in RATED_ROLES]
+            sigmas = [getattr(player_data, f"{role}_sigma") for role in RATED_ROLES]
+        events.append(
+            {
+                "time": time,
+                "event": "join",
+                "user_id": user_id,
+                "costs": get_role_costs(member),
+                "mus": mus,
+                "sigmas": sigmas,
+            }
+        )
+        events.append(
+            {"time": time + rng.expovariate(1 / (session_minutes * 60)), "event": "leave", "user_id": user_id}
+        )
+        time += rng.expovariate(joins_per_hour / 3600)
+        user_id += 1
+    return sorted(events, key=lambda event: event["time"])
+
+
+class QueueSimulation:
+    """The queue and running games of one replay of a trace."""
+
+    def __init__(self: Self, args: argparse.Namespace, wait_weight: float) -> None:
+        """Init that takes in the simulator's options and the wait weight to matchmake with."""
+        self.args = args
+        self.wait_weight = wait_weight
+        # Role costs, mus and sigmas of every player in the queue, in the order they joined.
+        self.players: Dict[int, Tuple[List[int], List[float], List[float]]] = {}
+        # When each player not in a game started waiting.
+        self.waiting_since: Dict[int, float] = {}
+        # When each running game ends, with its players.
+        self.running: List[Tuple[float, List[int]]] = []
+        # How long each player waited before each game, and before leaving without one.
+        self.waits: List[float] = []
+        self.abandoned_waits: List[float] = []
+        self.gaps: List[float] = []
+        self.games = 0
+        self.timed_out = 0
+        # When the last game ended, since the trace can go on long after the queue is too short for a game.
+        self.last_game_end: Optional[float] = None
+
+    def apply(self: Self, event: TraceEvent) -> None:
+        """Applies a join or leave from the trace."""
+        user_id = event["user_id"]
+        if event["event"] == "join" and user_id not in self.players:
+            self.players[user_id] = (event["costs"], event["mus"], event["sigmas"])
+            self.waiting_since[user_id] = event["time"]
+        elif event["event"] == "leave":
+            self.players.pop(user_id, None)
+            if user_id in self.waiting_since:
+                self.abandoned_waits.append(event["time"] - self.waiting_since.pop(user_id))
+
+    def end_games(self: Self, now: float) -> None:
+        """Ends every game due by `now`, and has its players still in the queue wait again from when it ended."""
+        for end, user_ids in [game for game in self.running if game[0] <= now]:
+            self.running.remove((end, user_ids))
+            for user_id in user_ids:
+                if user_id in self.players:
+                    self.waiting_since[user_id] = end
+
+    def start_games(self: Self, now: float) -> None:
+        """Starts games for the waiting players until every pair of team channels is in use or no game is valid."""
+        while len(self.running) < self.args.channels and len(self.waiting_since) >= matchmaking.GAME_SIZE:
+            user_ids = list(self.waiting_since)
+            snapshot = matchmaking.QueueSnapshot(
+                user_ids=user_ids,
+                costs=[self.players[user_id][0] for user_id in user_ids],
+                mus=[self.players[user_id][1] for user_id in user_ids],
+                sigmas=[self.players[user_id][2] for user_id in user_ids],
+                waits=[now - self.waiting_since[user_id] for user_id in user_ids],
+                wait_weight=self.wait_weight,
+            )
+            budget = self.args.budget_ms / 1000 if self.args.budget_ms > 0 else None
+            best_game, stats = matchmaking.search_best_game(snapshot, budget=budget)
+            if best_game is None:
+                return
+            self.timed_out += stats.timed_out
+            self.games += 1
+            self.gaps.append(abs(matchmaking.TARGET_QUALITY - best_game[0]))
+            seated = [user_ids[index] for index, _ in best_game[1] + best_game[2]]
+            for user_id in seated:
+                self.waits.append(now - self.waiting_since.pop(user_id))
+            self.running.append((now + self.args.game_length * 60, seated))
+            self.last_game_end = now + self.args.game_length * 60
+
+    def run(self: Self, events: List[TraceEvent]) -> Dict[str, Any]:
+        """Replays the trace, checking for games every `--game-interval` minutes, and sums up how it went."""
+        start, end = events[0]["time"], events[-1]["time"]
+        now = start
+        position = 0
+        while now <= end:
+            while position < len(events) and events[position]["time"] <= now:
+                self.apply(events[position])
+                position += 1
+            self.end_games(now)
+            self.start_games(now)
+            now += self.args.game_interval * 60
+        # Throughput is over the time games were being played.
+        hours = max((self.last_game_end or end) - start, 1.0) / 3600
+        return {
+            "wait_weight": self.wait_weight,
+            "games": self.games,
+            "games_per_hour": self.games / hours,
+            "players_seated_per_hour": len(self.waits) / hours,
+            "wait_minutes_median": statistics.median(self.waits) / 60 if self.waits else None,
+            "wait_minutes_p90": statistics.quantiles(self.waits, n=10)[-1] / 60 if len(self.waits) > 1 else None,
+            "left_waiting": len(self.abandoned_waits),
+            "left_waiting_minutes_median": (
+                statistics.median(self.abandoned_waits) / 60 if self.abandoned_waits else None
+            ),
+            "gap_median": statistics.median(self.gaps) if self.gaps else None,
+            "gap_max": max(self.gaps) if self.gaps else None,
+            "searches_timed_out": self.timed_out,
+        }
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Replays the trace once for every wait weight."""
+    if args.trace is not None:
+        events = load_trace(args.trace)
+    else:
+        events = make_trace(
+            random.Random(args.seed), args.hours, args.joins_per_hour, args.session_minutes, args.new_player_chance
+        )
+    logger.info(f"Replaying {len(events)} queue events")
+
+    results = []
+    for wait_weight in args.wait_weights:
+        result = QueueSimulation(args, wait_weight).run(events)
+        wait, wait_p90 = result["wait_minutes_median"], result["wait_minutes_p90"]
+        gap = result["gap_median"]
+        logger.info(
+            f"Wait weight {wait_weight}: {result['players_seated_per_hour']:.1f} players seated per hour, "
+            + (f"median wait {wait:.1f} minutes, " if wait is not None else "")
+            + (f"p90 wait {wait_p90:.1f} minutes, " if wait_p90 is not None else "")
+            + f"{result['left_waiting']} left waiting, "
+            + (f"median gap {gap:.4f}" if gap is not None else "no games")
+        )
+        results.append(result)
+
+    return {
+        "commit": get_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parses the simulator's command line options."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--trace", help="Trace recorded by the bot with QUEUE_TRACE_PATH set. Synthetic if not set.")
+    parser.add_argument(
+        "--wait-weights", type=float, nargs="+", default=[0.0, 0.001, 0.005], help="MATCHMAKING_WAIT_WEIGHT values."
+    )
+    parser.add_argument("--channels", type=int, default=2, help="Games that can be played at once.")
+    parser.add_argument("--game-interval", type=float, default=1.0, help="Minutes between checks for new games.")
+    parser.add_argument("--game-length", type=float, default=20.0, help="Minutes each game lasts.")
+    parser.add_argument("--budget-ms", type=int, default=300, help="Time budget of each search, 0 for none.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic trace.")
+    parser.add_argument("--hours", type=float, default=4.0, help="Length of the synthetic trace.")
+    parser.add_argument("--joins-per-hour", type=float, default=40.0, help="Players joining the synthetic queue.")
+    parser.add_argument("--session-minutes", type=float, default=90.0, help="Average time synthetic players stay.")
+    parser.add_argument(
+        "--new-player-chance", type=float, default=0.1, help="Chance of a synthetic player having default ratings."
+    )
+    parser.add_argument("--output", default="queue_simulation.json", help="File to write the JSON results to.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    report = run(args)
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    logger.info(f"Results written to {args.output}")
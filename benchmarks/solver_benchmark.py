@@ -0,0 +1,137 @@
+"""Compares the enumerating matchmaking search against the mixed integer program on the same synthetic queues.
+
+Run from the repository root with `python -m benchmarks.solver_benchmark`. For every queue size and seed, both
+solvers get the same snapshot, and the JSON file written records how long each took, how far its game is from
+`TARGET_QUALITY`, and how many players it put on a fill role.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import platform
+import random
+import statistics
+from typing import Any, Dict, List, Optional
+
+from benchmarks import matchmaking_milp
+from benchmarks.fakes import DEFAULT_FILL_CHANCE, make_members, seed_player_data
+from benchmarks.matchmaking_benchmark import DEFAULT_QUEUE_SIZES, get_commit, time_call
+from commands import game, matchmaking
+from database.db import init_db
+
+logger = logging.getLogger(__name__)
+
+SOLVERS: Dict[str, matchmaking.Search] = {
+    "search": matchmaking.search_best_game,
+    "milp": matchmaking_milp.solve_best_game,
+}
+
+
+def count_fills(snapshot: matchmaking.QueueSnapshot, best_game: Optional[matchmaking.GameResult]) -> Optional[int]:
+    """Counts the players a game puts on one of their fill roles."""
+    if best_game is None:
+        return None
+    return sum(snapshot.costs[index][role] == matchmaking.FILL_COST for index, role in best_game[1] + best_game[2])
+
+
+def benchmark_snapshot(snapshot: matchmaking.QueueSnapshot) -> Dict[str, Dict[str, Any]]:
+    """Runs every solver once on a snapshot."""
+    results = {}
+    for name, search in SOLVERS.items():
+        seconds, (best_game, stats) = time_call(lambda: search(snapshot))
+        results[name] = {
+            "seconds": seconds,
+            "gap": abs(matchmaking.TARGET_QUALITY - best_game[0]) if best_game is not None else None,
+            "fills": count_fills(snapshot, best_game),
+            "covered": stats.covered,
+            "pruned": stats.pruned,
+        }
+    return results
+
+
+def summarize(runs: List[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """Sums up each solver's runs for one queue size, and counts how often each found the game closer to the target."""
+    summary = {}
+    for name in SOLVERS:
+        gaps = [run[name]["gap"] for run in runs if run[name]["gap"] is not None]
+        summary[name] = {
+            "seconds_median": statistics.median(run[name]["seconds"] for run in runs),
+            "seconds_max": max(run[name]["seconds"] for run in runs),
+            "gap_median": statistics.median(gaps) if gaps else None,
+            "gap_max": max(gaps) if gaps else None,
+            "fills_total": sum(run[name]["fills"] or 0 for run in runs),
+            "closer": sum(
+                1
+                for run in runs
+                if run[name]["gap"] is not None
+                and all(run[name]["gap"] < run[other]["gap"] for other in SOLVERS if other != name)
+            ),
+        }
+    return summary
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Benchmarks both solvers on `args.seeds` fresh pools of players for every queue size."""
+    await init_db()
+    results = []
+    for seed in range(args.seed, args.seed + args.seeds):
+        rng = random.Random(seed)
+        pool = make_members(max(args.sizes), rng, fill_chance=args.fill_chance, first_user_id=1000 + seed * 10000)
+        await seed_player_data(pool, rng, args.new_player_chance)
+        for size in args.sizes:
+            _, snapshot = await game.build_queue_snapshot(pool[:size])
+            results.append({"queue_size": size, "seed": seed, **benchmark_snapshot(snapshot)})
+
+    summaries = []
+    for size in args.sizes:
+        summary = {"queue_size": size, **summarize([result for result in results if result["queue_size"] == size])}
+        logger.info(
+            f"{size} players: "
+            + ", ".join(
+                f"{name} {summary[name]['seconds_median'] * 1000:.1f} ms, closer {summary[name]['closer']} times"
+                for name in SOLVERS
+            )
+        )
+        summaries.append(summary)
+
+    return {
+        "commit": get_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {
+            "sizes": args.sizes,
+            "seed": args.seed,
+            "seeds": args.seeds,
+            "fill_chance": args.fill_chance,
+            "new_player_chance": args.new_player_chance,
+        },
+        "summaries": summaries,
+        "results": results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    """Parses the benchmark's command line options."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_QUEUE_SIZES, help="Queue sizes to time.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the first pool of synthetic players.")
+    parser.add_argument("--seeds", type=int, default=5, help="Number of pools of players to run per queue size.")
+    parser.add_argument(
+        "--fill-chance", type=float, default=DEFAULT_FILL_CHANCE, help="Chance of each other role being a fill."
+    )
+    parser.add_argument(
+        "--new-player-chance", type=float, default=0.1, help="Chance of a player still having default ratings."
+    )
+    parser.add_argument("--output", default="solver_benchmark.json", help="File to write the JSON results to.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    report = asyncio.run(run(args))
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    logger.info(f"Results written to {args.output}")
@@ -6,9 +6,12 @@ from discord.ext import commands
 
 from util.exceptions import (
     GameInProgressException,
+    GameNotFoundException,
     NoGameInProgressException,
     NotAdminException,
     NotEnoughPlayersException,
+    NoOtherGameException,
+    NoValidGameException,
 )
 
 import logging
@@ -24,24 +27,48 @@ class GameCog(commands.Cog):
         self.bot: discord.Bot = bot
 
     @discord.slash_command(name="start", description="Start a game")
-    async def slash_start_game(self: Self, ctx: ApplicationContext) -> None:
-        """Starts a game."""
+    @option(
+        "games",
+        int,
+        description="How many games to start at once, seating as many players as possible",
+        min_value=1,
+        default=1,
+    )
+    async def slash_start_game(self: Self, ctx: ApplicationContext, games: int = 1) -> None:  # noqa: C901
+        """Starts one or more games."""
         await ctx.defer()
+        matchmaking_shown = False
+
+        async def show_matchmaking() -> None:
+            nonlocal matchmaking_shown
+            embed = discord.Embed(
+                title="Matchmaking...",
+                color=discord.Colour.blurple(),
+                description="Finding the best game for the players in the queue.",
+            )
+            await ctx.respond(embed=embed)
+            matchmaking_shown = True
+
         try:
-            current_game = await game.start_game(ctx)
-            if current_game:
-                current_game = game.CurrentGame()
-                embed = current_game.create_embed()
+            started_games = await game.start_game(ctx, on_matchmaking=show_matchmaking, games=games)
+            embeds = []
+            for started_game in started_games:
+                embed = started_game.create_embed()
                 embed.set_author(
                     name=f"Started by {ctx.user.display_name}",
                     icon_url=ctx.user.display_avatar,
                 )
-                await ctx.respond(embed=embed)
-                # Move players after the embed is sent.
-                for player in current_game.team_1.values():
-                    await game.move_player_from_lobby_to_team_voice(player.user, 1, ctx)
-                for player in current_game.team_2.values():
-                    await game.move_player_from_lobby_to_team_voice(player.user, 2, ctx)
+                embeds.append(embed)
+            if matchmaking_shown:
+                await ctx.edit(embeds=embeds)
+            else:
+                await ctx.respond(embeds=embeds)
+            # Move players after the embeds are sent.
+            for started_game in started_games:
+                for player in started_game.team_1.values():
+                    await game.move_player_from_lobby_to_team_voice(player.user, 1, ctx, started_game)
+                for player in started_game.team_2.values():
+                    await game.move_player_from_lobby_to_team_voice(player.user, 2, ctx, started_game)
         except NotEnoughPlayersException:
             await ctx.defer(ephemeral=True)
             embed = discord.Embed(
@@ -55,7 +82,7 @@ class GameCog(commands.Cog):
             embed = discord.Embed(
                 title="Error",
                 color=discord.Colour.red(),
-                description="Game is already in progress!",
+                description="Every game is already in progress!",
             )
             await ctx.respond(embed=embed, ephemeral=True)
         except NotAdminException:
@@ -66,6 +93,16 @@ class GameCog(commands.Cog):
                 description="Only admins can start a game.",
             )
             await ctx.respond(embed=embed, ephemeral=True)
+        except NoValidGameException:
+            embed = discord.Embed(
+                title="Error",
+                color=discord.Colour.red(),
+                description="Not enough players on each role to make a valid game!",
+            )
+            if matchmaking_shown:
+                await ctx.edit(embed=embed)
+            else:
+                await ctx.respond(embed=embed, ephemeral=True)
 
     @discord.slash_command(name="end", description="End a currently running game")
     @option(
@@ -74,11 +111,12 @@ class GameCog(commands.Cog):
         description="The team that won the game",
         choices=["team 1", "team 2"],
     )
-    async def slash_end_game(self: Self, ctx: ApplicationContext, winner: str) -> None:
+    @option("number", int, description="The number of the game that ended", min_value=1, default=1)
+    async def slash_end_game(self: Self, ctx: ApplicationContext, winner: str, number: int = 1) -> None:
         """Ends a game, reporting a winner."""
         await ctx.defer()
         try:
-            game.end_game(ctx, winner)
+            ended_game = await game.end_game(ctx, winner, number)
 
             embed = discord.Embed(
                 title="Game Ended",
@@ -88,7 +126,7 @@ class GameCog(commands.Cog):
             await ctx.respond(embed=embed)
 
             try:
-                await game.move_all_team_players_to_lobby(ctx)
+                await game.move_all_team_players_to_lobby(ctx, ended_game)
             except Forbidden | HTTPException as e:
                 logger.error(e)
                 pass
@@ -99,6 +137,13 @@ class GameCog(commands.Cog):
                 description="No game is currently in progress!",
             )
             await ctx.respond(embed=embed, ephemeral=True)
+        except GameNotFoundException as e:
+            embed = discord.Embed(
+                title="Error",
+                color=discord.Colour.red(),
+                description=f"There is no game {e.number}!",
+            )
+            await ctx.respond(embed=embed, ephemeral=True)
         except NotAdminException:
             embed = discord.Embed(
                 title="Error",
@@ -108,11 +153,12 @@ class GameCog(commands.Cog):
             await ctx.respond(embed=embed, ephemeral=True)
 
     @discord.slash_command(name="cancel", description="Cancel a currently running game")
-    async def slash_cancel_game(self: Self, ctx: ApplicationContext) -> None:
+    @option("number", int, description="The number of the game to cancel", min_value=1, default=1)
+    async def slash_cancel_game(self: Self, ctx: ApplicationContext, number: int = 1) -> None:
         """Cancels a started game with no winner reported."""
         await ctx.defer()
         try:
-            game.cancel_game(ctx)
+            cancelled_game = await game.cancel_game(ctx, number)
 
             embed = discord.Embed(
                 title="Game Cancelled",
@@ -122,7 +168,7 @@ class GameCog(commands.Cog):
             await ctx.respond(embed=embed)
 
             try:
-                await game.move_all_team_players_to_lobby(ctx)
+                await game.move_all_team_players_to_lobby(ctx, cancelled_game)
             except Forbidden | HTTPException as e:
                 logger.error(e)
                 pass
@@ -133,6 +179,13 @@ class GameCog(commands.Cog):
                 description="No game is currently in progress!",
             )
             await ctx.respond(embed=embed, ephemeral=True)
+        except GameNotFoundException as e:
+            embed = discord.Embed(
+                title="Error",
+                color=discord.Colour.red(),
+                description=f"There is no game {e.number}!",
+            )
+            await ctx.respond(embed=embed, ephemeral=True)
         except NotAdminException:
             embed = discord.Embed(
                 title="Error",
@@ -141,13 +194,84 @@ class GameCog(commands.Cog):
             )
             await ctx.respond(embed=embed, ephemeral=True)
 
+    @discord.slash_command(name="reshuffle", description="Switch a running game to the next best teams")
+    @option("number", int, description="The number of the game to reshuffle", min_value=1, default=1)
+    async def slash_reshuffle_game(self: Self, ctx: ApplicationContext, number: int = 1) -> None:  # noqa: C901
+        """Switches a running game to the next best game found for the queue, keeping its map."""
+        await ctx.defer()
+        matchmaking_shown = False
+
+        async def show_matchmaking() -> None:
+            nonlocal matchmaking_shown
+            embed = discord.Embed(
+                title="Matchmaking...",
+                color=discord.Colour.blurple(),
+                description="Finding other teams for the players in the queue.",
+            )
+            await ctx.respond(embed=embed)
+            matchmaking_shown = True
+
+        try:
+            reshuffled_game = await game.reshuffle_game(ctx, number, on_matchmaking=show_matchmaking)
+            embed = reshuffled_game.create_embed()
+            embed.set_author(
+                name=f"Reshuffled by {ctx.user.display_name}",
+                icon_url=ctx.user.display_avatar,
+            )
+            if matchmaking_shown:
+                await ctx.edit(embed=embed)
+            else:
+                await ctx.respond(embed=embed)
+            # Players who are no longer in the game go back to the lobby, before the new teams are moved.
+            try:
+                await game.move_all_team_players_to_lobby(ctx, reshuffled_game)
+            except Forbidden | HTTPException as e:
+                logger.error(e)
+            for player in reshuffled_game.team_1.values():
+                await game.move_player_from_lobby_to_team_voice(player.user, 1, ctx, reshuffled_game)
+            for player in reshuffled_game.team_2.values():
+                await game.move_player_from_lobby_to_team_voice(player.user, 2, ctx, reshuffled_game)
+        except NoGameInProgressException:
+            embed = discord.Embed(
+                title="Error",
+                color=discord.Colour.red(),
+                description="No game is currently in progress!",
+            )
+            await ctx.respond(embed=embed, ephemeral=True)
+        except GameNotFoundException as e:
+            embed = discord.Embed(
+                title="Error",
+                color=discord.Colour.red(),
+                description=f"There is no game {e.number}!",
+            )
+            await ctx.respond(embed=embed, ephemeral=True)
+        except NotAdminException:
+            embed = discord.Embed(
+                title="Error",
+                color=discord.Colour.red(),
+                description="Only admins can reshuffle a game.",
+            )
+            await ctx.respond(embed=embed, ephemeral=True)
+        except (NoOtherGameException, NoValidGameException):
+            embed = discord.Embed(
+                title="Error",
+                color=discord.Colour.red(),
+                description="There are no other teams to switch to!",
+            )
+            if matchmaking_shown:
+                await ctx.edit(embed=embed)
+            else:
+                await ctx.respond(embed=embed, ephemeral=True)
+
     @discord.slash_command(name="reroll", description="Reroll the map of the currently running game")
-    async def slash_reroll_game(self: Self, ctx: ApplicationContext) -> None:
+    @option("number", int, description="The number of the game to reroll", min_value=1, default=1)
+    async def slash_reroll_game(self: Self, ctx: ApplicationContext, number: int = 1) -> None:
         """Rerolls the map of a currently running game."""
         await ctx.defer()
         try:
-            game.CurrentGame().reroll_map()
-            embed = game.CurrentGame().create_embed()
+            rerolled_game = game.GameRegistry(ctx.guild.id).get(number)
+            rerolled_game.reroll_map()
+            embed = rerolled_game.create_embed()
             embed.set_author(
                 name=f"Started by {ctx.user.display_name}",
                 icon_url=ctx.user.display_avatar,
@@ -160,6 +284,13 @@ class GameCog(commands.Cog):
                 description="No game is currently in progress!",
             )
             await ctx.respond(embed=embed, ephemeral=True)
+        except GameNotFoundException as e:
+            embed = discord.Embed(
+                title="Error",
+                color=discord.Colour.red(),
+                description=f"There is no game {e.number}!",
+            )
+            await ctx.respond(embed=embed, ephemeral=True)
 
 
 def setup(bot: discord.Bot) -> None:
@@ -1,11 +1,15 @@
 import discord
-from discord import ApplicationContext
+from discord import ApplicationContext, option
 import database.models.player_data as player_data
-from typing import List, Dict, Self
+from typing import List, Dict, Optional, Self
 from discord.ext import commands
 
 from util.env_load import ASSASSIN_EMOJI, OFFLANE_EMOJI, SUPPORT_EMOJI, TANK_EMOJI
 
+# Players shown on each page of the leaderboard.
+LEADERBOARD_PAGE_SIZE = 10
+ROLE_EMOJIS = {"Tank": TANK_EMOJI, "Support": SUPPORT_EMOJI, "Assassin": ASSASSIN_EMOJI, "Offlane": OFFLANE_EMOJI}
+
 
 class PlayerInfoCog(commands.Cog):
     """Tracks commands related to player info and stats."""
@@ -25,7 +29,7 @@ class PlayerInfoCog(commands.Cog):
     async def slash_get_stats(self: Self, ctx: ApplicationContext) -> None:
         """Gets a player's stats and returns it ephemerally."""
         await ctx.defer(ephemeral=True)
-        stats: Dict[str, Dict[str, float]] = player_data.find_player_stats(ctx.user.id)
+        stats: Dict[str, Dict[str, float]] = await player_data.find_player_stats(ctx.user.id)
         embed = discord.Embed(
             title="Player Stats",
             color=discord.Colour.blurple(),
@@ -54,6 +58,44 @@ class PlayerInfoCog(commands.Cog):
         embed.set_thumbnail(url=ctx.author.display_avatar.url)
         await ctx.respond(embed=embed, ephemeral=True)
 
+    @discord.slash_command(name="leaderboard", description="See the best rated players on a role")
+    @option(
+        "role",
+        str,
+        description="The role to rank players on, your main role if not given",
+        choices=list(ROLE_EMOJIS),
+        default=None,
+    )
+    @option("page", int, description="The page of the leaderboard to show", min_value=1, default=1)
+    async def slash_leaderboard(self: Self, ctx: ApplicationContext, role: Optional[str] = None, page: int = 1) -> None:
+        """Shows a page of a role's leaderboard, ranked by conservative rating, and where the player stands on it."""
+        await ctx.defer(ephemeral=True)
+        if role is None:
+            main_roles = [user_role.name for user_role in ctx.user.roles if user_role.name in ROLE_EMOJIS]
+            role = main_roles[0] if main_roles else "Tank"
+
+        leaderboard = player_data.RatingStore().leaderboards[role.lower()]
+        start = (page - 1) * LEADERBOARD_PAGE_SIZE
+        entries = leaderboard.page(start, LEADERBOARD_PAGE_SIZE)
+        if entries:
+            description = "\n".join(
+                f"**#{leaderboard.rank(user_id)}** <@{user_id}> ({rating:.1f})" for user_id, rating in entries
+            )
+        else:
+            description = "No players on this page yet."
+        embed = discord.Embed(
+            title=f"{role} Leaderboard {ROLE_EMOJIS[role]}",
+            color=discord.Colour.blurple(),
+            description=description,
+        )
+        rank = leaderboard.rank(ctx.user.id)
+        pages = max(1, -(-len(leaderboard) // LEADERBOARD_PAGE_SIZE))
+        embed.set_footer(
+            text=(f"Your rank: #{rank} of {len(leaderboard)}" if rank is not None else "You are unranked")
+            + f" | Page {page} of {pages}"
+        )
+        await ctx.respond(embed=embed, ephemeral=True)
+
     @discord.slash_command(name="setup", description="Get set up with the Queue Bot!")
     async def slash_setup(self: Self, ctx: ApplicationContext) -> None:
         """Sets up a player's main and secondary roles."""
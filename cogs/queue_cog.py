@@ -22,7 +22,7 @@ class QueueCog(commands.Cog):
         """Joins the queue."""
         await ctx.defer()
         try:
-            user_id, queue_length = Queue().add(ctx.user)
+            user_id, queue_length = await Queue(ctx.guild.id).add(ctx.user)
             queued_role = ctx.guild.get_role(QUEUED_ID)
             await ctx.user.add_roles(queued_role)
             plural = "s" if queue_length != 1 else ""
@@ -54,12 +54,12 @@ class QueueCog(commands.Cog):
     async def slash_list_queue(self: Self, ctx: ApplicationContext) -> None:
         """Lists the queue in a stylized format."""
         await ctx.defer()
-        queue_info = Queue().as_dict()
+        queue_info = Queue(ctx.guild.id).as_dict()
         thumbnail = discord.File("images/hotslogo.png", filename="hotslogo.png")
         embed = discord.Embed(
             title="Queue",
             color=discord.Colour.blurple(),
-            description=f"Players in Queue: {len(Queue().queue)}",
+            description=f"Players in Queue: {len(Queue(ctx.guild.id).queue)}",
         )
         embed.add_field(
             name=f"Tanks {TANK_EMOJI}",
@@ -113,7 +113,7 @@ class QueueCog(commands.Cog):
         """Leaves the queue."""
         await ctx.defer()
         try:
-            user_id, queue_length = Queue().remove(ctx.user)
+            user_id, queue_length = await Queue(ctx.guild.id).remove(ctx.user)
             queued_role = ctx.guild.get_role(QUEUED_ID)
             await ctx.user.remove_roles(queued_role)
             plural = "s" if queue_length != 1 else ""
@@ -138,7 +138,7 @@ class QueueCog(commands.Cog):
         """Clears the queue. Admin command."""
         await ctx.defer()
         if ADMIN_ID in [role.id for role in ctx.user.roles] or ctx.user.guild_permissions.administrator:
-            Queue().queue.clear()
+            Queue(ctx.guild.id).clear()
             queued_role = ctx.guild.get_role(QUEUED_ID)
             for member in ctx.guild.members:
                 if queued_role in member.roles:
@@ -163,7 +163,7 @@ class QueueCog(commands.Cog):
         await ctx.defer()
         if ADMIN_ID in [role.id for role in ctx.user.roles] or ctx.user.guild_permissions.administrator:
             try:
-                user_id, queue_length = Queue().remove(user)
+                user_id, queue_length = await Queue(ctx.guild.id).remove(user)
                 # Remove the queued role from the user
                 queued_role = ctx.guild.get_role(QUEUED_ID)
                 await user.remove_roles(queued_role)
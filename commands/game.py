@@ -1,22 +1,49 @@
 from enum import Enum
-from sqlalchemy.orm import scoped_session
+from sqlalchemy.ext.asyncio import AsyncSession
 import trueskill
 from discord import ApplicationContext, Member, Forbidden, HTTPException
-from commands.queue import Queue
-from database.models.player_data import PlayerData
+from commands.queue import (
+    Queue,
+    ensure_guild_configured,
+    get_matchmaking_budget,
+    get_matchmaking_executor,
+    get_role_costs,
+    search_in_pool,
+)
+from database.models.player_data import (
+    RatingSnapshot,
+    RatingStore,
+    RatingUpdate,
+    bump_ratings_version,
+    ensure_players_in_db,
+    get_ratings_version,
+    load_rating_arrays,
+    load_rating_snapshot,
+)
 from database.db import DBGlobalSession
-from typing import List, Dict, Optional, Self, Type
-import numpy as np
-import itertools
-from scipy.optimize import linear_sum_assignment
+from database.models.match import MatchRecord
+from typing import Awaitable, Callable, FrozenSet, Iterator, List, Dict, Optional, Self, Tuple, Type
+import asyncio
 import random
-from util.env_load import ADMIN_ID, LOBBY_CHANNEL_ID, TEAM_1_CHANNEL_ID, TEAM_2_CHANNEL_ID
+import time
+from commands import matchmaking
+from util.env_load import (
+    ADMIN_ID,
+    EXTRA_GAME_CHANNEL_IDS,
+    LOBBY_CHANNEL_ID,
+    MATCHMAKING_CACHE_SIZE,
+    MATCHMAKING_WAIT_WEIGHT,
+    TEAM_1_CHANNEL_ID,
+    TEAM_2_CHANNEL_ID,
+)
 
 from util.exceptions import (
     ChannelNotFoundException,
     GameInProgressException,
+    GameNotFoundException,
     NoGameInProgressException,
     NoGuildException,
+    NoOtherGameException,
     NoValidGameException,
     NotAdminException,
 )
@@ -56,18 +83,8 @@ class RoleEnum(Enum):
         return hash(self.value)
 
 
-def convert_int_to_role(role_int: int) -> RoleEnum:
-    """Helper function which turns a cost matrix indicy into a role string."""
-    if role_int == 0 or role_int == 1:
-        return RoleEnum.TANK
-    elif role_int == 2 or role_int == 3:
-        return RoleEnum.SUPPORT
-    elif role_int == 4 or role_int == 5 or role_int == 6 or role_int == 7:
-        return RoleEnum.ASSASSIN
-    elif role_int == 8 or role_int == 9:
-        return RoleEnum.OFFLANE
-    else:
-        raise ValueError("Invalid `role_int`. Must be a number within 0-9.")
+# Roles indexed by the role categories used in `commands.matchmaking`.
+ROLE_CATEGORIES = [RoleEnum.TANK, RoleEnum.SUPPORT, RoleEnum.ASSASSIN, RoleEnum.OFFLANE]
 
 
 class Player:
@@ -82,22 +99,9 @@ class Player:
         self.user = user
         self.role = role
 
-    def calculate_trueskill(self: Self, data: PlayerData) -> trueskill.Rating:
-        """Calculates the trueskill rating of a player based on their role."""
-        if self.role == RoleEnum.ASSASSIN2:
-            lookup_role = RoleEnum.ASSASSIN
-        else:
-            lookup_role = self.role
-        mu = getattr(data, f"{lookup_role}_mu")
-        sigma = getattr(data, f"{lookup_role}_sigma")
-        return trueskill.Rating(mu, sigma)
-
 
-class CurrentGame:
-    """Singleton class to track the curent game.
-
-    TODO: Store a list of active games if we allow multiple games to run.
-    """
+class Game:
+    """Class to track one game, and the pair of team voice channels it is played in."""
 
     # TODO: Make this configurable?
     valid_maps = [
@@ -114,34 +118,32 @@ class CurrentGame:
         # "Braxis Holdout",
     ]
 
-    # Instantiate a singleton class, CurrentGame
-    def __new__(cls: Type["CurrentGame"]) -> "CurrentGame":
-        """Handle creation of a new class instance.
-
-        Because this is a singleton, we only want to create one instance of this class,
-        and return that same instance if a new one is attempted to be created after.
-        """
-        if not hasattr(cls, "instance"):
-            cls.instance = super(CurrentGame, cls).__new__(cls)
-            cls.instance.initialized = False
-        return cls.instance
-
-    def __init__(self: Self) -> None:
-        """Initialize this class instance."""
-        if hasattr(self, "initialized") and self.initialized:
-            return
-        else:
-            self.initialized = True
-            self.reset_state()
+    def __init__(self: Self, number: int, team_1_channel_id: int, team_2_channel_id: int) -> None:
+        """Init that takes in the game's number and the ids of its team voice channels."""
+        self.number = number
+        self.team_1_channel_id = team_1_channel_id
+        self.team_2_channel_id = team_2_channel_id
+        self.reset_state()
 
     def assign_game(
         self: Self,
         team_1: Dict[str, Player],
         team_2: Dict[str, Player],
+        quality: Optional[float] = None,
+        coverage: Optional[float] = None,
+        candidates: Optional[List[Dict[str, Dict[str, Player] | float]]] = None,
     ) -> None:
-        """Assign the game to the active CurrentGame object."""
+        """Assign the teams to this game and start it.
+
+        `quality` is the trueskill match quality of the teams, and `coverage` the fraction of the search space the
+        matchmaking search got through before settling on them. `candidates` are the next best games the search
+        found, best first, for `reshuffle` to switch to.
+        """
         self.team_1 = team_1
         self.team_2 = team_2
+        self.quality = quality
+        self.coverage = coverage
+        self.candidates = list(candidates or [])
         self.map = random.choice(self.valid_maps)
         self.first_pick = random.choice([1, 2])
         self.in_progress = True
@@ -150,12 +152,15 @@ class CurrentGame:
         """Set the appropriate variables for a default state."""
         self.team_1 = {}
         self.team_2 = {}
+        self.quality = None
+        self.coverage = None
+        self.candidates = []
         self.map = None
         self.first_pick = None
         self.in_progress = False
 
     def reroll_map(self: Self) -> None:
-        """Reroll the map for the current game."""
+        """Reroll the map for this game."""
         if self.in_progress:
             valid_maps_copy = self.valid_maps.copy()
             valid_maps_copy.remove(self.map)
@@ -163,6 +168,18 @@ class CurrentGame:
         else:
             raise NoGameInProgressException("No game is currently in progress.")
 
+    def reshuffle(self: Self, candidate: Dict[str, Dict[str, Player] | float]) -> None:
+        """Switches this game to the teams of another candidate game, keeping its map and first pick."""
+        if not self.in_progress:
+            raise NoGameInProgressException("No game is currently in progress.")
+        self.team_1 = candidate["team1"]
+        self.team_2 = candidate["team2"]
+        self.quality = candidate["quality"]
+
+    def user_ids(self: Self) -> List[int]:
+        """Lists the user ids of every player in this game."""
+        return [player.user.id for player in [*self.team_1.values(), *self.team_2.values()]]
+
     def convert_team_to_string(self: Self, team: Dict[str, Player]) -> str:
         """Helper function to convert a provided team dictionary to a string representation.
 
@@ -177,7 +194,7 @@ class CurrentGame:
         """Creates a discord embed object representing the game."""
         banner = f"https://static.icy-veins.com/images/heroes/tier-lists/maps/{self.map.replace(' ', '-').lower()}.jpg"
         embed = discord.Embed(
-            title="**Game Started**",
+            title=f"**Game {self.number} Started**" if EXTRA_GAME_CHANNEL_IDS else "**Game Started**",
             color=discord.Colour.blurple(),
             description=self.map,
         )
@@ -196,9 +213,64 @@ class CurrentGame:
             inline=True,
         )
         embed.set_image(url=banner)
+        if self.quality is not None:
+            footer = f"Match quality {self.quality:.1%}"
+            if self.coverage is not None:
+                footer += f", {self.coverage:.0%} of possible games searched"
+            embed.set_footer(text=footer)
         return embed
 
 
+class GameRegistry:
+    """Class to track every game a guild can run at once, one per pair of team voice channels.
+
+    There is one instance per guild, each with its own lock so that guilds never wait on each other.
+    """
+
+    # Every guild's games, keyed by guild id.
+    instances: Dict[int, "GameRegistry"] = {}
+
+    def __new__(cls: Type["GameRegistry"], guild_id: int) -> "GameRegistry":
+        """Returns the guild's games, creating them the first time the guild is seen."""
+        if guild_id not in cls.instances:
+            ensure_guild_configured(guild_id)
+            cls.instances[guild_id] = super(GameRegistry, cls).__new__(cls)
+            cls.instances[guild_id].initialized = False
+        return cls.instances[guild_id]
+
+    def __init__(self: Self, guild_id: int) -> None:
+        """Initialize the guild's games, one for every pair of team voice channels."""
+        if hasattr(self, "initialized") and self.initialized:
+            return
+        else:
+            self.initialized = True
+            self.guild_id = guild_id
+            self.lock = asyncio.Lock()
+            channel_pairs = [(TEAM_1_CHANNEL_ID, TEAM_2_CHANNEL_ID), *EXTRA_GAME_CHANNEL_IDS]
+            self.games = [
+                Game(number, team_1_channel_id, team_2_channel_id)
+                for number, (team_1_channel_id, team_2_channel_id) in enumerate(channel_pairs, start=1)
+            ]
+
+    def get(self: Self, number: int) -> Game:
+        """Returns a game by its number."""
+        if not 1 <= number <= len(self.games):
+            raise GameNotFoundException(number)
+        return self.games[number - 1]
+
+    def in_progress(self: Self) -> List[Game]:
+        """Lists the games that are being played."""
+        return [game for game in self.games if game.in_progress]
+
+    def free(self: Self) -> List[Game]:
+        """Lists the games whose voice channels are free to start a game in."""
+        return [game for game in self.games if not game.in_progress]
+
+    def playing_user_ids(self: Self) -> List[int]:
+        """Lists the user ids of every player in a game that is being played."""
+        return [user_id for game in self.in_progress() for user_id in game.user_ids()]
+
+
 def find_valid_game_for_permutation(perm: List[Member]) -> Optional[Dict[str, List[Player]]]:
     """For a permutation of 10 players, find a valid game, if one exists.
 
@@ -206,227 +278,338 @@ def find_valid_game_for_permutation(perm: List[Member]) -> Optional[Dict[str, Li
 
     A valid game has: 2 tanks, 2 supports, 4 assassins, and 2 offlanes.
     Players are priotized onto their primary role.
-
-    For each player in the queue, create a numpy matrix,
-    where the rows are the players, and the columns are
-    the roles (Tank, Healer, Assassin, Offlane).
-    The cost of each player to be assigned to a role is 0 if they have the role,
-    1 if they are a fill, and 2 if they do not have any roles.
     """
-    matrix = np.full((len(perm), 10), 2)
-    for i, player in enumerate(perm):
-        for role in player.roles:
-            match role.name:
-                case "Tank":
-                    matrix[i][0] = 0
-                    matrix[i][1] = 0
-                case "Tank (Fill)":
-                    matrix[i][0] = 1
-                    matrix[i][1] = 1
-                case "Support":
-                    matrix[i][2] = 0
-                    matrix[i][3] = 0
-                case "Support (Fill)":
-                    matrix[i][2] = 1
-                    matrix[i][3] = 1
-                case "Assassin":
-                    matrix[i][4] = 0
-                    matrix[i][5] = 0
-                    matrix[i][6] = 0
-                    matrix[i][7] = 0
-                case "Assassin (Fill)":
-                    matrix[i][4] = 1
-                    matrix[i][5] = 1
-                    matrix[i][6] = 1
-                    matrix[i][7] = 1
-                case "Offlane":
-                    matrix[i][8] = 0
-                    matrix[i][9] = 0
-                case "Offlane (Fill)":
-                    matrix[i][8] = 1
-                    matrix[i][9] = 1
-    # Find the optimal matching using the Hungarian Algorithm
-    # https://docs.scipy.org/doc/scipy-0.18.1/reference/generated/scipy.optimize.linear_sum_assignment.html
-    row_ind, col_ind = linear_sum_assignment(matrix)
-    # Check if this is a valid set, if not, continue to the next 10 perm.
-    if any(matrix[row_ind, col_ind] == 2):
+    roles = matchmaking.assign_roles([get_role_costs(player) for player in perm], range(len(perm)))
+    if roles is None:
         return
     game_dict = {RoleEnum.TANK: [], RoleEnum.SUPPORT: [], RoleEnum.ASSASSIN: [], RoleEnum.OFFLANE: []}
-    for i, player in enumerate(perm):
-        role = convert_int_to_role(col_ind[i])
+    for player, role_category in zip(perm, roles):
+        role = ROLE_CATEGORIES[role_category]
         game_dict[role].append(Player(player, role))
     return game_dict
 
 
-def find_valid_games() -> List[Dict[str, List[Player]]]:
-    """Finds all valid games of 10 players from the queue."""
-    players_in_queue: List[Member] = Queue().queue.copy()
-
-    # Ensure all players are in the db
-    db_session: scoped_session = DBGlobalSession().new_session()
-    for player in players_in_queue:
-        player_data = db_session.query(PlayerData).filter(PlayerData.user_id == player.id).first()
-        if player_data is None:
-            # Create a database entry for this player
-            logger.warn(f"Player {player.display_name} not found in database, creating entry...")
-            player_data = PlayerData(user_id=player.id)
-            db_session.add(player_data)
-    db_session.commit()
-    db_session.close()
-
-    player_set = set(players_in_queue)
-    combinations_of_players: List[List[Member]] = [list(comb) for comb in itertools.combinations(player_set, 10)]
-    valid_games = []
-
-    for perm in combinations_of_players:
-        valid_game = find_valid_game_for_permutation(perm)
+def find_valid_games(players: List[Member]) -> Iterator[Dict[str, List[Player]]]:
+    """Lazily yields every valid game of 10 players from a guild's queued players.
+
+    Subsets whose role mix can not make a valid game are pruned while they are being built,
+    rather than checking every combination of 10 players.
+    """
+    players_in_queue: List[Member] = list(dict.fromkeys(players))
+    costs = [get_role_costs(player) for player in players_in_queue]
+    for subset in matchmaking.iter_valid_subsets(costs):
+        valid_game = find_valid_game_for_permutation([players_in_queue[index] for index in subset])
         if valid_game is not None:
-            valid_games.append(valid_game)
-
-    return valid_games
-
-
-def get_team_combinations(players: Dict[str, List[Player]]) -> List[List[List[Player]]]:
-    """Finds every combination of players by role and returns a list of unique two team combinations."""
-    combinations = []
-    for tank in players[RoleEnum.TANK]:
-        for support in players[RoleEnum.SUPPORT]:
-            for assassin in itertools.combinations(players[RoleEnum.ASSASSIN], 2):
-                for offlane in players[RoleEnum.OFFLANE]:
-                    combinations.append([tank, support, assassin[0], assassin[1], offlane])
-    two_teams = []
-    for team1 in combinations:
-        for team2 in combinations:
-            if not any(player in team2 for player in team1):
-                if [team2, team1] not in two_teams:
-                    two_teams.append([team1, team2])
-
-    random.shuffle(two_teams)
-    random.shuffle(two_teams)
-    random.shuffle(two_teams)
-    return two_teams
-
-
-def build_trueskill_object_for_list_of_players(
-    players: List[Player], db_session: scoped_session = None
-) -> Dict[int, trueskill.Rating]:
-    """Builds a list of trueskill objects for a list of players."""
-    created_session = False
-    if db_session is None:
-        db_session = DBGlobalSession().new_session()
-        created_session = True
+            yield valid_game
 
-    # Collect the user ids
-    player_ids = [player.user.id for player in players]
-    playerdata_objs = db_session.query(PlayerData).filter(PlayerData.user_id.in_(player_ids)).all()
-    playerdata_objs = {player.user_id: player for player in playerdata_objs}
 
-    ratings = {}
+def get_team_combinations(players: Dict[str, List[Player]]) -> Iterator[List[List[Player]]]:
+    """Lazily yields every unique two team split of a game, broken down by role.
 
-    try:
-        assert len(playerdata_objs) == len(players)
-        ratings = {player.user.id: player.calculate_trueskill(playerdata_objs[player.user.id]) for player in players}
+    Each split comes out exactly once, with team 1 always holding the first tank.
+    """
+    by_slot = [player for role in ROLE_CATEGORIES for player in players[role]]
+    team_size = matchmaking.TEAM_SIZE
+    for split in matchmaking.SPLITS:
+        yield [
+            [by_slot[position] for position in split[:team_size]],
+            [by_slot[position] for position in split[team_size:]],
+        ]
+
+
+async def build_trueskill_object_for_list_of_players(
+    players: List[Player], db_session: AsyncSession = None, ratings: Optional[RatingSnapshot] = None
+) -> Dict[int, trueskill.Rating]:
+    """Builds a list of trueskill objects for a list of players.
+
+    Reads the players' ratings from the database unless a `RatingSnapshot` is passed in.
+    """
+    if ratings is None:
+        ratings = await load_rating_snapshot([player.user.id for player in players], db_session)
 
+    try:
+        assert all(player.user.id in ratings for player in players)
     except AssertionError:
         logger.error("Could not find player data for all players in the game.")
         raise
 
-    finally:
-        if created_session:
-            db_session.close()
+    return {player.user.id: ratings.get(player.user.id, player.role) for player in players}
+
 
-    return ratings
+async def build_queue_snapshot(
+    players: List[Member], queue: Optional[Queue] = None
+) -> Tuple[List[Member], matchmaking.QueueSnapshot]:
+    """Reads the ratings of every queued player once and packs them into a snapshot for the matchmaking search.
 
+    When `MATCHMAKING_WAIT_WEIGHT` is set and the players come from a `queue`, their waits in it are packed in too.
 
-def find_quality_of_teams(team1: List[Player], team2: List[Player], db_session: scoped_session = None) -> float:
-    """Finds the quality of two teams."""
-    created_session = False
-    if db_session is None:
-        db_session = DBGlobalSession().new_session()
-        created_session = True
+    Returns the players in the order the snapshot indexes them, along with the snapshot.
+    """
+    players = list(dict.fromkeys(players))
 
+    db_session: AsyncSession = DBGlobalSession().new_session()
     try:
-        team1_ratings = build_trueskill_object_for_list_of_players(team1, db_session)
-        team2_ratings = build_trueskill_object_for_list_of_players(team2, db_session)
+        await ensure_players_in_db([player.id for player in players], db_session)
+        # Rating columns are in the same order as `ROLE_CATEGORIES`.
+        mus, sigmas = await load_rating_arrays([player.id for player in players], db_session)
     finally:
-        if created_session:
-            db_session.close()
-
-    # Calculate the match quality
-    return trueskill.quality([team1_ratings.values(), team2_ratings.values()])
-
-
-def find_best_game(valid_games: List[Dict[str, List[Player]]]) -> Dict[str, Dict[str, Player] | str]:
-    """Takes in a set of valid games, broken down by role, and returns the best game by trueskill rating calculation."""
-    best_game = None
-    best_quality = 10000
-
-    for game in valid_games:
-        # Find every permutation of team comp,
-        # in which a valid team has 5 players:
-        # One tank, One Support, Two Assassins, and One Offlane.
-        team_combos: List[List[List[Player]]] = get_team_combinations(game)
-        logger.info(f"Found {len(team_combos)} configurations of players for this game group")
-        # TODO: Should we instead compare match quality within team_combos and then take a random game?
-        for combo in team_combos:
-            team1 = combo[0]
-            team2 = combo[1]
-            match_quality = find_quality_of_teams(team1, team2)
-            # Check if match_quality is closer to 0.5 than the current best match_quality.
-            if abs(0.5 - match_quality) < abs(0.5 - best_quality):
-                best_game = combo
-                best_quality = match_quality
-
-    if best_game is None or valid_games == []:
-        raise NoValidGameException("No valid game was found.")
-
-    team1 = {}
-    team2 = {}
-    for player in best_game[0]:
-        if player.role == RoleEnum.ASSASSIN and RoleEnum.ASSASSIN in team1:
-            team1[RoleEnum.ASSASSIN2] = player
-        else:
-            team1[player.role] = player
-    for player in best_game[1]:
-        if player.role == RoleEnum.ASSASSIN and RoleEnum.ASSASSIN in team2:
-            team2[RoleEnum.ASSASSIN2] = player
+        await db_session.close()
+
+    snapshot = matchmaking.QueueSnapshot(
+        user_ids=[player.id for player in players],
+        costs=[get_role_costs(player) for player in players],
+        mus=mus.tolist(),
+        sigmas=sigmas.tolist(),
+    )
+    if queue is not None and MATCHMAKING_WAIT_WEIGHT > 0:
+        snapshot.waits = queue.waits(snapshot.user_ids)
+        snapshot.wait_weight = MATCHMAKING_WAIT_WEIGHT
+    return players, snapshot
+
+
+def convert_game_result(
+    players: List[Member], best_game: Optional[matchmaking.GameResult], stats: matchmaking.SearchStats
+) -> Dict[str, Dict[str, Player] | float]:
+    """Turns the indices and role categories found by the matchmaking search back into teams of players.
+
+    The other games the search kept in `SearchStats.candidates` are turned into teams too, best first, for
+    `/reshuffle` to switch to.
+    """
+    if best_game is None:
+        raise NoValidGameException("Not enough players on each role to make a valid game.")
+
+    quality, best_team1, best_team2 = best_game
+    logger.info(
+        f"Found a game with match quality {quality} after scoring {stats.games_scored} games and pruning "
+        f"{stats.pruned} branches and games, "
+        f"covering {stats.covered:.1%} of the search space" + (" before running out of time" if stats.timed_out else "")
+    )
+    user_ids = [player.id for player in players]
+    best_teams = {frozenset(team) for team in matchmaking.store_game(user_ids, best_game)[1:]}
+    candidates = []
+    for _, stored_game in stats.candidates:
+        # Candidates from an older search of the queue may have players who have left since.
+        if {frozenset(team) for team in stored_game[1:]} == best_teams or any(
+            user_id not in user_ids for user_id, _ in stored_game[1] + stored_game[2]
+        ):
+            continue
+        candidate_quality, team1, team2 = matchmaking.load_game(user_ids, stored_game)
+        candidates.append(
+            {"team1": convert_team(players, team1), "team2": convert_team(players, team2), "quality": candidate_quality}
+        )
+
+    return {
+        "team1": convert_team(players, best_team1),
+        "team2": convert_team(players, best_team2),
+        "quality": quality,
+        "coverage": stats.covered,
+        "candidates": candidates,
+    }
+
+
+def convert_team(players: List[Member], team: List[Tuple[int, int]]) -> Dict[str, Player]:
+    """Turns a team of (player index, role category) pairs into players keyed by role."""
+    converted = {}
+    for index, role_category in team:
+        role = ROLE_CATEGORIES[role_category]
+        if role == RoleEnum.ASSASSIN and RoleEnum.ASSASSIN in converted:
+            converted[RoleEnum.ASSASSIN2] = Player(players[index], RoleEnum.ASSASSIN)
         else:
-            team2[player.role] = player
+            converted[role] = Player(players[index], role)
+    return converted
+
+
+# Results of earlier searches, so starting a game for a queue that has been searched before needs no search.
+_matchmaking_cache = matchmaking.MatchmakingCache(MATCHMAKING_CACHE_SIZE)
+
 
-    return {"team1": team1, "team2": team2}
+def get_matchmaking_cache_key(players: List[Member]) -> matchmaking.CacheKey:
+    """Builds the matchmaking cache key for a list of players from their role costs and the ratings version."""
+    return matchmaking.MatchmakingCache.key(
+        [player.id for player in players], [get_role_costs(player) for player in players], get_ratings_version()
+    )
 
 
-async def start_game(ctx: ApplicationContext) -> bool:
-    """Takes the players from the queue and creates a game."""
+async def find_queue_game(
+    queue: Queue, players: List[Member], on_matchmaking: Optional[Callable[[], Awaitable[None]]] = None
+) -> Dict[str, Dict[str, Player] | float]:
+    """Finds the best game for players from `queue`, doing as little work as the cache and its matchmaker allow.
+
+    Players that have been matched before are served from the matchmaking cache without reading any ratings.
+    Otherwise the queue's matchmaker has usually found the best game already, as players joined and left. The
+    players are only searched when their roles or ratings have changed since, starting from the most recent cached
+    game they can still play, and `on_matchmaking` is awaited right before that.
+
+    With `MATCHMAKING_WAIT_WEIGHT` set, the best game changes as players wait, so the players are always searched.
+    """
+    if MATCHMAKING_WAIT_WEIGHT > 0:
+        players, snapshot = await build_queue_snapshot(players, queue)
+        if on_matchmaking is not None:
+            await on_matchmaking()
+        found_game, stats = await search_in_pool(snapshot)
+        return convert_game_result(players, found_game, stats)
+
+    key = get_matchmaking_cache_key(players)
+    cached = _matchmaking_cache.get(key)
+    if cached is not None:
+        found_game, stats = matchmaking.load_game([player.id for player in players], cached[0]), cached[1]
+        return convert_game_result(players, found_game, stats)
+
+    players, snapshot = await build_queue_snapshot(players)
+    matchmaker = queue.matchmaker
+    if matchmaker.matches(snapshot):
+        found_game, stats = matchmaker.game_for(snapshot), matchmaker.stats
+    else:
+        if on_matchmaking is not None:
+            await on_matchmaking()
+        incumbent = matchmaking.load_game(snapshot.user_ids, _matchmaking_cache.incumbent(key))
+        found_game, stats = await search_in_pool(snapshot, incumbent)
+        # The matchmaker follows the whole queue, so it can only take on a search of the whole queue as it is now.
+        if set(snapshot.user_ids) == {player.id for player in queue.queue}:
+            matchmaker.reset(snapshot, found_game, stats)
+    _matchmaking_cache.put(key, matchmaking.store_game(snapshot.user_ids, found_game), stats)
+    return convert_game_result(players, found_game, stats)
+
+
+async def find_disjoint_games_in_pool(
+    players: List[Member],
+    games: int,
+    on_matchmaking: Optional[Callable[[], Awaitable[None]]] = None,
+    queue: Optional[Queue] = None,
+) -> List[Dict[str, Dict[str, Player] | float]]:
+    """Finds as many disjoint games as the players can fill, up to `games`, in the matchmaking process pool.
+
+    `on_matchmaking` is awaited right before the search starts. Waits in `queue` count when a single game is found.
+    """
+    players, snapshot = await build_queue_snapshot(players, queue)
+    if on_matchmaking is not None:
+        await on_matchmaking()
+    loop = asyncio.get_running_loop()
+    found_games, stats = await loop.run_in_executor(
+        get_matchmaking_executor(), matchmaking.find_disjoint_games, snapshot, games, get_matchmaking_budget()
+    )
+    if not found_games:
+        raise NoValidGameException("Not enough players on each role to make a valid game.")
+    # Coverage only describes the search for a single game.
+    return [
+        {**convert_game_result(players, found_game, stats), "coverage": None, "candidates": []}
+        for found_game in found_games
+    ]
+
+
+async def start_game(
+    ctx: ApplicationContext, on_matchmaking: Optional[Callable[[], Awaitable[None]]] = None, games: int = 1
+) -> List[Game]:
+    """Takes the players from the queue and starts up to `games` games, each in a free pair of voice channels.
+
+    Players already in a game that is being played are left out. A single game is found by `find_queue_game`,
+    while several are found together by `find_disjoint_games_in_pool`, seating as many players as possible.
+
+    Only one game start runs at a time in each guild, so two starts can not pick the same free voice channels, while
+    other guilds are never held up.
+
+    Returns the games that were started.
+    """
+    if ctx.guild is None:
+        raise NoGuildException
     assert type(ctx.user) is Member
     if ADMIN_ID in [role.id for role in ctx.user.roles] or ctx.user.guild_permissions.administrator:
-        if CurrentGame().in_progress:
-            raise GameInProgressException("A game is already in progress.")
-        valid_games = find_valid_games()
-        logger.info(f"Found {len(valid_games)} valid game configurations...")
-        if len(valid_games) == 0:
-            raise NoValidGameException("Not enough players on each role to make a valid game.")
-        best_game = find_best_game(valid_games)
-        CurrentGame().assign_game(best_game["team1"], best_game["team2"])
-        return True
+        registry = GameRegistry(ctx.guild.id)
+        async with registry.lock:
+            free_games = registry.free()
+            if not free_games:
+                raise GameInProgressException("A game is already in progress.")
+            queue = Queue(ctx.guild.id)
+            playing = set(registry.playing_user_ids())
+            players = [player for player in dict.fromkeys(queue.queue) if player.id not in playing]
+            games = min(games, len(free_games))
+            if games > 1:
+                best_games = await find_disjoint_games_in_pool(players, games, on_matchmaking, queue)
+            else:
+                best_games = [await find_queue_game(queue, players, on_matchmaking)]
+            for started_game, best_game in zip(free_games, best_games):
+                started_game.assign_game(
+                    best_game["team1"],
+                    best_game["team2"],
+                    quality=best_game["quality"],
+                    coverage=best_game["coverage"],
+                    candidates=best_game["candidates"],
+                )
+            return free_games[: len(best_games)]
     else:
         raise NotAdminException("You must be an admin to start a game.")
 
 
-async def move_player_from_lobby_to_team_voice(disc_user: Member, team_number: int, ctx: ApplicationContext) -> None:
-    """Moves a player from the lobby voice channel to the Team 1 voice channel."""
+def get_teams_key(team_1: Dict[str, Player], team_2: Dict[str, Player]) -> FrozenSet[FrozenSet[Tuple[int, str]]]:
+    """Builds a key for a pair of teams that ignores which team is which."""
+    return frozenset(
+        frozenset((player.user.id, str(player.role)) for player in team.values()) for team in (team_1, team_2)
+    )
+
+
+async def reshuffle_game(
+    ctx: ApplicationContext, number: int = 1, on_matchmaking: Optional[Callable[[], Awaitable[None]]] = None
+) -> Game:
+    """Switches a game in progress to the next best game the matchmaking search found when it was started.
+
+    Candidates with a player who has left the queue or is playing another game are skipped. When there are none
+    left, as when the game came from the queue's matchmaker rather than a search, the players not in another game
+    are searched again, and `on_matchmaking` is awaited right before that.
+
+    Returns the reshuffled game.
+    """
+    if ctx.guild is None:
+        raise NoGuildException
+    assert type(ctx.user) is Member
+    if ADMIN_ID in [role.id for role in ctx.user.roles] or ctx.user.guild_permissions.administrator:
+        registry = GameRegistry(ctx.guild.id)
+        async with registry.lock:
+            reshuffled_game = registry.get(number)
+            if not reshuffled_game.in_progress:
+                raise NoGameInProgressException("No game is currently in progress.")
+            queue = Queue(ctx.guild.id)
+            playing = set(registry.playing_user_ids()) - set(reshuffled_game.user_ids())
+            players = [player for player in dict.fromkeys(queue.queue) if player.id not in playing]
+            available = {player.id for player in players}
+            current = get_teams_key(reshuffled_game.team_1, reshuffled_game.team_2)
+
+            def can_play(candidate: Dict[str, Dict[str, Player] | float]) -> bool:
+                return get_teams_key(candidate["team1"], candidate["team2"]) != current and all(
+                    player.user.id in available
+                    for player in [*candidate["team1"].values(), *candidate["team2"].values()]
+                )
+
+            candidates = [candidate for candidate in reshuffled_game.candidates if can_play(candidate)]
+            if not candidates:
+                players, snapshot = await build_queue_snapshot(players, queue)
+                if on_matchmaking is not None:
+                    await on_matchmaking()
+                best_game = convert_game_result(players, *await search_in_pool(snapshot))
+                candidates = [candidate for candidate in [best_game, *best_game["candidates"]] if can_play(candidate)]
+            if not candidates:
+                raise NoOtherGameException("No other game was found for the players in the queue.")
+            reshuffled_game.reshuffle(candidates[0])
+            reshuffled_game.candidates = candidates[1:]
+            return reshuffled_game
+    else:
+        raise NotAdminException("You must be an admin to reshuffle a game.")
+
+
+async def move_player_from_lobby_to_team_voice(
+    disc_user: Member, team_number: int, ctx: ApplicationContext, game: Game
+) -> None:
+    """Moves a player from the lobby voice channel to their team's voice channel in a game."""
     if ctx.guild is None:
         raise NoGuildException
     if team_number == 1:
-        team_voice_channel = ctx.guild.get_channel(TEAM_1_CHANNEL_ID)
-        channel_id = TEAM_1_CHANNEL_ID
+        channel_id = game.team_1_channel_id
     elif team_number == 2:
-        team_voice_channel = ctx.guild.get_channel(TEAM_2_CHANNEL_ID)
-        channel_id = TEAM_2_CHANNEL_ID
+        channel_id = game.team_2_channel_id
     else:
         raise ValueError("Invalid `team_number`. Must be either 1 or 2.")
+    team_voice_channel = ctx.guild.get_channel(channel_id)
     if team_voice_channel is None:
-        raise ChannelNotFoundException(f"Team {team_number} Voice Channel", channel_id)
+        raise ChannelNotFoundException(f"Game {game.number} Team {team_number} Voice Channel", channel_id)
     try:
         await disc_user.move_to(team_voice_channel)
     except Forbidden | HTTPException as e:
@@ -434,143 +617,180 @@ async def move_player_from_lobby_to_team_voice(disc_user: Member, team_number: i
         pass
 
 
-async def move_all_team_players_to_lobby(ctx: ApplicationContext) -> None:
-    """For the end of a game, moves all players that are in team_1 or team_2 back to the lobby."""
+async def move_all_team_players_to_lobby(ctx: ApplicationContext, game: Game) -> None:
+    """For the end of a game, moves all players that are in its team voice channels back to the lobby."""
     if ctx.guild is None:
         raise NoGuildException
     lobby_voice_channel = ctx.guild.get_channel(LOBBY_CHANNEL_ID)
-    team_1_voice_channel = ctx.guild.get_channel(TEAM_1_CHANNEL_ID)
-    team_2_voice_channel = ctx.guild.get_channel(TEAM_2_CHANNEL_ID)
+    team_1_voice_channel = ctx.guild.get_channel(game.team_1_channel_id)
+    team_2_voice_channel = ctx.guild.get_channel(game.team_2_channel_id)
     if lobby_voice_channel is None:
         raise ChannelNotFoundException("Lobby Voice Channel", LOBBY_CHANNEL_ID)
     if team_1_voice_channel is None:
-        raise ChannelNotFoundException("Team 1 Voice Channel", TEAM_1_CHANNEL_ID)
+        raise ChannelNotFoundException(f"Game {game.number} Team 1 Voice Channel", game.team_1_channel_id)
     if team_2_voice_channel is None:
-        raise ChannelNotFoundException("Team 2 Voice Channel", TEAM_2_CHANNEL_ID)
+        raise ChannelNotFoundException(f"Game {game.number} Team 2 Voice Channel", game.team_2_channel_id)
     for member in team_1_voice_channel.members:
         await member.move_to(lobby_voice_channel)
     for member in team_2_voice_channel.members:
         await member.move_to(lobby_voice_channel)
 
 
-def update_player_data_for_team(
-    ratings: Dict[int, trueskill.Rating], players: Dict[int, Player], win: bool, db_session: scoped_session
-) -> None:
-    """Updates the DB record for players on a team to match the new trueskill rating."""
-    created_session = False
-    if db_session is None:
-        db_session = DBGlobalSession().new_session()
-        created_session = True
-
-    try:
-        for player_id in ratings:
-            player: PlayerData = db_session.query(PlayerData).filter(PlayerData.user_id == player_id).first()
-            if players[player_id].role == RoleEnum.ASSASSIN2:
-                players[player_id].role = RoleEnum.ASSASSIN
-            setattr(
-                player,
-                f"{players[player_id].role}_mu",
-                ratings[player_id].mu,
-            )
-            setattr(
-                player,
-                f"{players[player_id].role}_sigma",
-                ratings[player_id].sigma,
-            )
-            setattr(
-                player,
-                f"{players[player_id].role}_games_played",
-                getattr(player, f"{players[player_id].role}_games_played") + 1,
-            )
-            if win:
-                setattr(
-                    player,
-                    f"{players[player_id].role}_games_won",
-                    getattr(player, f"{players[player_id].role}_games_won") + 1,
-                )
-
-        db_session.flush()
-
-    finally:
-        if created_session:
-            db_session.commit()
-            db_session.close()
-
-
-def end_game(ctx: ApplicationContext, winner: str) -> None:
+def build_match_record(
+    guild_id: int,
+    game: Game,
+    winner: int,
+    ratings: RatingSnapshot,
+    new_ratings: Dict[int, trueskill.Rating],
+) -> MatchRecord:
+    """Describes a finished game for the match history, with every player's rating before and after it."""
+    return {
+        "guild_id": guild_id,
+        "ended_at": time.time(),
+        "map": game.map,
+        "first_pick": game.first_pick,
+        "winner": winner,
+        "quality": game.quality,
+        "players": [
+            {
+                "user_id": player.user.id,
+                "team": team_number,
+                "role": str(role),
+                "mu_before": ratings.get(player.user.id, player.role).mu,
+                "sigma_before": ratings.get(player.user.id, player.role).sigma,
+                "mu_after": new_ratings[player.user.id].mu,
+                "sigma_after": new_ratings[player.user.id].sigma,
+            }
+            for team_number, team in ((1, game.team_1), (2, game.team_2))
+            for role, player in team.items()
+        ],
+    }
+
+
+def get_rating_updates_for_team(
+    ratings: Dict[int, trueskill.Rating], players: Dict[int, Player], win: bool
+) -> List[RatingUpdate]:
+    """Pairs the new trueskill ratings of a team's players with the roles they played, to be written in one batch."""
+    return [(player_id, str(players[player_id].role), ratings[player_id], win) for player_id in ratings]
+
+
+async def end_game(ctx: ApplicationContext, winner: str, number: int = 1) -> Game:
     """
-    If a game is currently running, ends the game and moves all players back to the lobby.
+    If the game is currently running, ends the game and moves all players back to the lobby.
 
     Winner: The team that won the game.
+    Number: The number of the game that ended.
+
+    Only one game is started, ended or cancelled at a time in each guild, so a game reported twice at once, or reported
+    as it is cancelled, is only rated once.
+
+    Returns the game that ended.
     """
     if ctx.guild is None:
         raise NoGuildException
     assert type(ctx.user) is Member
     if ADMIN_ID in [role.id for role in ctx.user.roles] or ctx.user.guild_permissions.administrator:
-        if not CurrentGame().in_progress:
-            raise NoGameInProgressException("No game is currently in progress.")
-        if winner == "team 1":
-            winning_team = CurrentGame().team_1
-            losing_team = CurrentGame().team_2
-        elif winner == "team 2":
-            winning_team = CurrentGame().team_2
-            losing_team = CurrentGame().team_1
-        else:
-            raise ValueError("Invalid `winner`. Must be either `team 1` or `team 2`.")
-
-        # Setting up session
-        db_session: scoped_session = DBGlobalSession().new_session()
-
-        try:
-            logger.info(f"\nI think the winning team is {winning_team}\n")
-            logger.info(f"\nI think the losing team is {losing_team}\n")
-            # Update the ratings of the players
-            winning_team_ratings = build_trueskill_object_for_list_of_players(list(winning_team.values()))
-            logger.info(f"\nWinning team ratings: {winning_team_ratings}")
-            losing_team_ratings = build_trueskill_object_for_list_of_players(list(losing_team.values()))
-            logger.info(f"\nLosing team ratings: {losing_team_ratings}")
-            winning_team_ratings, losing_team_ratings = trueskill.rate(
-                [winning_team_ratings, losing_team_ratings], ranks=[0, 1]
-            )
-            logger.info(f"\nUpdated Winning team ratings: {winning_team_ratings}")
-            logger.info(f"\nUpdated Losing team ratings: {losing_team_ratings}")
-
-            # Reorganize winning and losing teams into propper structures
-            winning_team_players = {player.user.id: player for player in winning_team.values()}
-            losing_team_players = {player.user.id: player for player in losing_team.values()}
+        registry = GameRegistry(ctx.guild.id)
+        # Held until the game is reset, so a second report of the same game finds it over rather than rating it twice.
+        async with registry.lock:
+            ended_game = registry.get(number)
+            if not ended_game.in_progress:
+                raise NoGameInProgressException("No game is currently in progress.")
+            if winner == "team 1":
+                winning_team = ended_game.team_1
+                losing_team = ended_game.team_2
+            elif winner == "team 2":
+                winning_team = ended_game.team_2
+                losing_team = ended_game.team_1
+            else:
+                raise ValueError("Invalid `winner`. Must be either `team 1` or `team 2`.")
+
+            # Setting up session
+            db_session: AsyncSession = DBGlobalSession().new_session()
+
+            try:
+                logger.info(f"\nI think the winning team is {winning_team}\n")
+                logger.info(f"\nI think the losing team is {losing_team}\n")
+                # Update the ratings of the players
+                ratings = await load_rating_snapshot(
+                    [player.user.id for player in [*winning_team.values(), *losing_team.values()]], db_session
+                )
+                winning_team_ratings = await build_trueskill_object_for_list_of_players(
+                    list(winning_team.values()), ratings=ratings
+                )
+                logger.info(f"\nWinning team ratings: {winning_team_ratings}")
+                losing_team_ratings = await build_trueskill_object_for_list_of_players(
+                    list(losing_team.values()), ratings=ratings
+                )
+                logger.info(f"\nLosing team ratings: {losing_team_ratings}")
+                winning_team_ratings, losing_team_ratings = trueskill.rate(
+                    [winning_team_ratings, losing_team_ratings], ranks=[0, 1]
+                )
+                logger.info(f"\nUpdated Winning team ratings: {winning_team_ratings}")
+                logger.info(f"\nUpdated Losing team ratings: {losing_team_ratings}")
+
+                # Reorganize winning and losing teams into propper structures
+                winning_team_players = {player.user.id: player for player in winning_team.values()}
+                losing_team_players = {player.user.id: player for player in losing_team.values()}
+
+                # Update players' ratings in the tracked player stats and record the game in the match history, which
+                # are written to the database together in the background
+                logger.info("\nRecording rating updates...")
+                await RatingStore().record(
+                    [
+                        *get_rating_updates_for_team(winning_team_ratings, winning_team_players, True),
+                        *get_rating_updates_for_team(losing_team_ratings, losing_team_players, False),
+                    ],
+                    build_match_record(
+                        ctx.guild.id,
+                        ended_game,
+                        1 if winner == "team 1" else 2,
+                        ratings,
+                        {**winning_team_ratings, **losing_team_ratings},
+                    ),
+                )
+                bump_ratings_version()
 
-            # Update players' ratings in the tracked player stats, and then re-add them to the queue
-            logger.info("\nUpdating database entries...")
-            update_player_data_for_team(winning_team_ratings, winning_team_players, True, db_session)
-            update_player_data_for_team(losing_team_ratings, losing_team_players, False, db_session)
-            db_session.commit()
+                logger.info("\nRatings updated :)")
 
-            logger.info("\nDatabase updated :)")
+                # Players wait for their next game from now, and reset the game.
+                Queue(ctx.guild.id).restart_waits([*winning_team_players, *losing_team_players])
+                ended_game.reset_state()
 
-            # Reset the current game.
-            CurrentGame().reset_state()
+            finally:
+                await db_session.close()
 
-        finally:
-            db_session.close()
+        return ended_game
 
     else:
         raise NotAdminException("You must be an admin to report the end of a game.")
 
 
-def cancel_game(ctx: ApplicationContext) -> None:
+async def cancel_game(ctx: ApplicationContext, number: int = 1) -> Game:
     """Cancels a started game.
 
-    If a game is currently running, ends the game and moves all players
+    If the game is currently running, ends the game and moves all players
     back to the lobby without reporting winners.
+
+    Like ending it, cancelling holds the guild's lock, so a game being reported as it is cancelled is only ended once.
+
+    Returns the game that was cancelled.
     """
     if ctx.guild is None:
         raise NoGuildException
     assert type(ctx.user) is Member
     if ADMIN_ID in [role.id for role in ctx.user.roles] or ctx.user.guild_permissions.administrator:
-        if not CurrentGame().in_progress:
-            raise NoGameInProgressException("No game is currently in progress.")
-        # Move everyone back to the lobby.
-        CurrentGame().reset_state()
+        registry = GameRegistry(ctx.guild.id)
+        async with registry.lock:
+            cancelled_game = registry.get(number)
+            if not cancelled_game.in_progress:
+                raise NoGameInProgressException("No game is currently in progress.")
+            # Players wait for their next game from now, and move everyone back to the lobby.
+            Queue(ctx.guild.id).restart_waits(
+                [player.user.id for player in [*cancelled_game.team_1.values(), *cancelled_game.team_2.values()]]
+            )
+            cancelled_game.reset_state()
+            return cancelled_game
 
     else:
         raise NotAdminException("You must be an admin to cancel a game.")
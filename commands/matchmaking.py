@@ -0,0 +1,1174 @@
+"""Search the queue for the best valid game without enumerating every 10 player subset."""
+
+import asyncio
+import collections
+import functools
+import heapq
+import itertools
+import math
+import random
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Self, Sequence, Tuple, Type
+
+import numpy as np
+import trueskill
+from scipy.optimize import linear_sum_assignment
+
+# Role categories, in cost matrix column order.
+TANK, SUPPORT, ASSASSIN, OFFLANE = 0, 1, 2, 3
+ROLE_SLOTS = (2, 2, 4, 2)
+GAME_SIZE = sum(ROLE_SLOTS)
+
+# Cost of placing a player on a role: their main, one of their fills, or a role they did not sign up for.
+MAIN_COST, FILL_COST, INVALID_COST = 0, 1, 2
+
+# The match quality the search aims for, and how close to it a game must be to stop searching early.
+TARGET_QUALITY = 0.5
+QUALITY_TOLERANCE = 1e-3
+
+# Every non-empty set of role categories as a bitmask, with the number of slots those roles hold in a game.
+_ROLE_SETS = [
+    (mask, sum(slots for role, slots in enumerate(ROLE_SLOTS) if mask & (1 << role))) for mask in range(1, 16)
+]
+
+Signature = Tuple[int, ...]
+# (signature, number of players taken with that signature), for each signature in a game.
+SignatureCounts = Tuple[Tuple[Signature, int], ...]
+# A game's match quality, and each team as (player index, role category) pairs.
+GameResult = Tuple[float, List[Tuple[int, int]], List[Tuple[int, int]]]
+# The same as a `GameResult`, with each team as (user id, role category) pairs so it does not depend on queue order.
+StoredGame = Tuple[float, List[Tuple[int, int]], List[Tuple[int, int]]]
+# Ratings version, and (user id, role costs) for each queued player sorted by user id.
+CacheKey = Tuple[int, Tuple[Tuple[int, Tuple[int, ...]], ...]]
+# A function that finds the best game in a queue, called like `search_best_game` with keyword arguments only.
+Search = Callable[..., Tuple[Optional[GameResult], "SearchStats"]]
+# The same as a `Search`, awaited so it can run off the event loop.
+AsyncSearch = Callable[..., Awaitable[Tuple[Optional[GameResult], "SearchStats"]]]
+
+
+def eligibility_mask(costs: Sequence[int]) -> int:
+    """Returns a bitmask of the role categories a player can be placed on."""
+    mask = 0
+    for role, cost in enumerate(costs):
+        if cost < INVALID_COST:
+            mask |= 1 << role
+    return mask
+
+
+def group_by_signature(costs: Sequence[Sequence[int]]) -> Dict[Signature, List[int]]:
+    """Groups player indices by their role signature, leaving out players who can not play any role."""
+    classes: Dict[Signature, List[int]] = {}
+    for index, player_costs in enumerate(costs):
+        if eligibility_mask(player_costs):
+            classes.setdefault(tuple(player_costs), []).append(index)
+    return classes
+
+
+def _role_splits(signature: Signature, taken: int) -> List[Tuple[int, Tuple[int, ...]]]:
+    """Lists every way to put `taken` players of a signature on roles they can play, each with its total role cost."""
+    splits = []
+
+    def place(role: int, left: int, counts: Tuple[int, ...]) -> None:
+        if role == len(ROLE_SLOTS):
+            if not left:
+                splits.append((sum(count * signature[role] for role, count in enumerate(counts)), counts))
+            return
+        most = min(left, ROLE_SLOTS[role]) if signature[role] < INVALID_COST else 0
+        for count in range(most + 1):
+            place(role + 1, left - count, counts + (count,))
+
+    place(0, taken, ())
+    return splits
+
+
+@functools.lru_cache(maxsize=4096)
+def allocate_roles(signature_counts: SignatureCounts) -> Optional[Tuple[int, Tuple[Tuple[Tuple[int, ...], ...], ...]]]:
+    """Finds every way to fill the roles from the signatures at the lowest total role cost.
+
+    Returns that cost and the allocations, or None if the signatures can not fill every role.
+    """
+    splits = [_role_splits(signature, taken) for signature, taken in signature_counts]
+    # The lowest cost of filling the open slots from the signatures at a position onward, by (position, open slots).
+    lowest: Dict[Tuple[int, Tuple[int, ...]], float] = {}
+
+    def lowest_cost(position: int, open_slots: Tuple[int, ...]) -> float:
+        if position == len(splits):
+            return math.inf if any(open_slots) else 0
+        key = (position, open_slots)
+        if key not in lowest:
+            lowest[key] = min(
+                (
+                    cost + lowest_cost(position + 1, tuple(slots - count for slots, count in zip(open_slots, counts)))
+                    for cost, counts in splits[position]
+                    if all(count <= slots for count, slots in zip(counts, open_slots))
+                ),
+                default=math.inf,
+            )
+        return lowest[key]
+
+    total = lowest_cost(0, ROLE_SLOTS)
+    if total == math.inf:
+        return None
+
+    allocations = []
+
+    def collect(position: int, open_slots: Tuple[int, ...], chosen: Tuple[Tuple[int, ...], ...]) -> None:
+        if position == len(splits):
+            allocations.append(chosen)
+            return
+        for cost, counts in splits[position]:
+            rest = tuple(slots - count for slots, count in zip(open_slots, counts))
+            if min(rest) >= 0 and cost + lowest_cost(position + 1, rest) == lowest[(position, open_slots)]:
+                collect(position + 1, rest, chosen + (counts,))
+
+    collect(0, ROLE_SLOTS, ())
+    return int(total), tuple(allocations)
+
+
+def _count_role_sets(mask: int, contained: List[int], hits: List[int], step: int) -> None:
+    """Adds players of one signature to the per role set counts used by Hall's condition."""
+    for k, (role_set, _) in enumerate(_ROLE_SETS):
+        if mask & ~role_set == 0:
+            contained[k] += step
+        if mask & role_set:
+            hits[k] += step
+
+
+def _search_signature_counts(  # noqa: C901
+    signatures: Sequence[Signature],
+    sizes: Sequence[int],
+    lower_bounds: Optional[Sequence[Sequence[float]]] = None,
+    should_prune: Optional[Callable[..., bool]] = None,
+    stats: Optional["SearchStats"] = None,
+    minimums: Optional[Sequence[int]] = None,
+    upper_bounds: Optional[Sequence[Sequence[float]]] = None,
+    mu_ranges: Optional[Sequence[Sequence[Tuple[float, float]]]] = None,
+    bonus_bounds: Optional[Sequence[Sequence[float]]] = None,
+) -> Iterator[Tuple[Tuple[int, ...], float]]:
+    """Yields how many players to take from each signature, for every count vector that can make a valid game.
+
+    Branches are dropped when Hall's condition shows their role mix can not fill a game, or when `should_prune`
+    rejects the bounds the other arguments give. Dropped shares of the search tree are added to `stats.covered`.
+    """
+    masks = [eligibility_mask(signature) for signature in signatures]
+    count = len(signatures)
+
+    # remaining_hits[i][k] is how many players from signature i onward can play a role in _ROLE_SETS[k].
+    remaining_hits = [[0] * len(_ROLE_SETS) for _ in range(count + 1)]
+    remaining_players = [0] * (count + 1)
+    for position in range(count - 1, -1, -1):
+        remaining_players[position] = remaining_players[position + 1] + sizes[position]
+        for k, (role_set, _) in enumerate(_ROLE_SETS):
+            remaining_hits[position][k] = remaining_hits[position + 1][k] + (
+                sizes[position] if masks[position] & role_set else 0
+            )
+
+    # remaining_bound[i][n] is the smallest value any n players from signature i onward can add to a game.
+    if lower_bounds is not None:
+        remaining_bound = [[0.0] + [math.inf] * GAME_SIZE for _ in range(count + 1)]
+        for position in range(count - 1, -1, -1):
+            for needed in range(1, GAME_SIZE + 1):
+                remaining_bound[position][needed] = min(
+                    lower_bounds[position][taken] + remaining_bound[position + 1][needed - taken]
+                    for taken in range(min(needed, sizes[position]) + 1)
+                )
+
+    # remaining_ceiling[i][n] is the largest value any n players from signature i onward can add to a game.
+    if upper_bounds is not None:
+        remaining_ceiling = [[0.0] + [-math.inf] * GAME_SIZE for _ in range(count + 1)]
+        for position in range(count - 1, -1, -1):
+            for needed in range(1, GAME_SIZE + 1):
+                remaining_ceiling[position][needed] = max(
+                    upper_bounds[position][taken] + remaining_ceiling[position + 1][needed - taken]
+                    for taken in range(min(needed, sizes[position]) + 1)
+                )
+
+    # remaining_bonus[i][n] is the largest wait bonus any n players from signature i onward can add to a game.
+    if bonus_bounds is not None:
+        remaining_bonus = [[0.0] + [-math.inf] * GAME_SIZE for _ in range(count + 1)]
+        for position in range(count - 1, -1, -1):
+            for needed in range(1, GAME_SIZE + 1):
+                remaining_bonus[position][needed] = max(
+                    bonus_bounds[position][taken] + remaining_bonus[position + 1][needed - taken]
+                    for taken in range(min(needed, sizes[position]) + 1)
+                )
+
+    # remaining_mu_ranges[i][role] is the (lowest, highest) mu on a role of the players from signature i onward.
+    no_range = (math.inf, -math.inf)
+    if mu_ranges is not None:
+        remaining_mu_ranges = [[no_range] * len(ROLE_SLOTS) for _ in range(count + 1)]
+        for position in range(count - 1, -1, -1):
+            remaining_mu_ranges[position] = [
+                (min(low, signature_low), max(high, signature_high))
+                for (low, high), (signature_low, signature_high) in zip(
+                    remaining_mu_ranges[position + 1], mu_ranges[position]
+                )
+            ]
+
+    counts = [0] * count
+    contained = [0] * len(_ROLE_SETS)
+    hits = [0] * len(_ROLE_SETS)
+
+    def largest_difference(position: int) -> float:
+        difference = 0.0
+        for role, slots in enumerate(ROLE_SLOTS):
+            low, high = remaining_mu_ranges[position][role]
+            for chosen in range(position):
+                if counts[chosen]:
+                    low = min(low, mu_ranges[chosen][role][0])
+                    high = max(high, mu_ranges[chosen][role][1])
+            difference += slots // 2 * max(0.0, high - low)
+        return difference
+
+    def upper_bounds_for(
+        position: int, needed: int, partial_ceiling: float
+    ) -> Optional[Callable[[], Tuple[float, float]]]:
+        if upper_bounds is None or mu_ranges is None:
+            return None
+        return lambda: (partial_ceiling + remaining_ceiling[position][needed], largest_difference(position))
+
+    def is_feasible(position: int, needed: int) -> bool:
+        for k, (_, slots) in enumerate(_ROLE_SETS):
+            if contained[k] > slots:
+                return False
+            if hits[k] + min(needed, remaining_hits[position][k]) < slots:
+                return False
+        return True
+
+    def drop(share: float) -> None:
+        if stats is not None and not stats.timed_out:
+            stats.covered += share
+
+    def search(
+        position: int, needed: int, partial_bound: float, partial_ceiling: float, partial_bonus: float, share: float
+    ) -> Iterator[Tuple[Tuple[int, ...], float]]:
+        if remaining_players[position] < needed or not is_feasible(position, needed):
+            drop(share)
+            return
+        if needed == 0:
+            yield tuple(counts), share
+            return
+        if should_prune is not None and should_prune(
+            partial_bound + remaining_bound[position][needed],
+            upper_bounds_for(position, needed, partial_ceiling),
+            partial_bonus + remaining_bonus[position][needed] if bonus_bounds is not None else None,
+        ):
+            drop(share)
+            return
+        minimum = minimums[position] if minimums is not None else 0
+        choices = range(min(needed, sizes[position]), minimum - 1, -1)
+        if not choices:
+            drop(share)
+            return
+        for taken in choices:
+            counts[position] = taken
+            _count_role_sets(masks[position], contained, hits, taken)
+            step_bound = lower_bounds[position][taken] if lower_bounds is not None else 0.0
+            step_ceiling = upper_bounds[position][taken] if upper_bounds is not None else 0.0
+            step_bonus = bonus_bounds[position][taken] if bonus_bounds is not None else 0.0
+            yield from search(
+                position + 1,
+                needed - taken,
+                partial_bound + step_bound,
+                partial_ceiling + step_ceiling,
+                partial_bonus + step_bonus,
+                share / len(choices),
+            )
+            _count_role_sets(masks[position], contained, hits, -taken)
+        counts[position] = 0
+
+    yield from search(0, GAME_SIZE, 0.0, 0.0, 0.0, 1.0)
+
+
+def iter_valid_subsets(costs: Sequence[Sequence[int]]) -> Iterator[Tuple[int, ...]]:
+    """Lazily yields the index of every 10 player subset that can fill 2 tanks, 2 supports, 4 assassins, 2 offlanes."""
+    classes = group_by_signature(costs)
+    signatures = list(classes)
+    for counts, _ in _search_signature_counts(signatures, [len(classes[signature]) for signature in signatures]):
+        picks = [
+            itertools.combinations(classes[signature], taken) for signature, taken in zip(signatures, counts) if taken
+        ]
+        for chosen in itertools.product(*picks):
+            yield tuple(index for group in chosen for index in group)
+
+
+def assign_roles(costs: Sequence[Sequence[int]], subset: Sequence[int]) -> Optional[List[int]]:
+    """Assigns a role category to each player in a 10 player subset, prioritizing players onto their main role.
+
+    Returns None if a player would have to play a role they did not sign up for.
+    """
+    classes: Dict[Signature, List[int]] = {}
+    for position, index in enumerate(subset):
+        classes.setdefault(tuple(costs[index]), []).append(position)
+    signature_counts = tuple((signature, len(positions)) for signature, positions in classes.items())
+    allocation = allocate_roles(signature_counts)
+    if allocation is None:
+        return None
+
+    roles = [0] * len(subset)
+    for positions, role_counts in zip(classes.values(), allocation[1][0]):
+        signature_roles = [role for role, taken in enumerate(role_counts) for _ in range(taken)]
+        for position, role in zip(positions, signature_roles):
+            roles[position] = role
+    return roles
+
+
+def match_quality(mu_difference: float, sigma_squared_total: float, beta: Optional[float] = None) -> float:
+    """Closed form of `trueskill.quality` for two teams of 5, from the mu difference and sigma squared total."""
+    if beta is None:
+        beta = trueskill.global_env().beta
+    variance = GAME_SIZE * beta**2 + sigma_squared_total
+    return math.sqrt(GAME_SIZE * beta**2 / variance) * math.exp(-(mu_difference**2) / (2 * variance))
+
+
+def _build_split_masks() -> List[int]:
+    """Lists every split of a game ordered by role slot into two teams, as a bitmask of team 1's positions."""
+    slot_positions: List[List[int]] = []
+    for slots in ROLE_SLOTS:
+        start = sum(len(positions) for positions in slot_positions)
+        slot_positions.append(list(range(start, start + slots)))
+    masks = []
+    for support, assassins, offlane in itertools.product(
+        slot_positions[SUPPORT],
+        itertools.combinations(slot_positions[ASSASSIN], 2),
+        slot_positions[OFFLANE],
+    ):
+        masks.append(sum(1 << position for position in [slot_positions[TANK][0], support, *assassins, offlane]))
+    return masks
+
+
+SPLIT_MASKS = _build_split_masks()
+# The positions of team 1 followed by team 2 for each split mask, in role slot order within each team.
+SPLITS = np.array(
+    [
+        [position for position in range(GAME_SIZE) if mask >> position & 1]
+        + [position for position in range(GAME_SIZE) if not mask >> position & 1]
+        for mask in SPLIT_MASKS
+    ]
+)
+TEAM_SIZE = GAME_SIZE // 2
+
+# Number of games scored together by `search_best_game`.
+BATCH_SIZE = 256
+
+# Queues at least this long are searched across every matchmaking worker process.
+PARALLEL_QUEUE_SIZE = 20
+
+
+def batch_match_quality(mus: np.ndarray, sigmas: np.ndarray, beta: Optional[float] = None) -> np.ndarray:
+    """Vectorized `match_quality` for any number of stacked games.
+
+    `mus` and `sigmas` have a last axis of 10 players, the first 5 on team 1 and the last 5 on team 2.
+    """
+    if beta is None:
+        beta = trueskill.global_env().beta
+    variance = GAME_SIZE * beta**2 + np.sum(np.square(sigmas), axis=-1)
+    mu_difference = np.sum(mus[..., :TEAM_SIZE], axis=-1) - np.sum(mus[..., TEAM_SIZE:], axis=-1)
+    return np.sqrt(GAME_SIZE * beta**2 / variance) * np.exp(-np.square(mu_difference) / (2 * variance))
+
+
+def find_best_quality(
+    mus: np.ndarray, sigmas: np.ndarray, beta: Optional[float] = None, bonuses: Optional[np.ndarray] = None
+) -> Tuple[int, float]:
+    """Scores every stacked game in one pass and returns the flat index and quality of the one closest to the target."""
+    qualities = batch_match_quality(mus, sigmas, beta)
+    scores = np.abs(TARGET_QUALITY - qualities)
+    if bonuses is not None:
+        scores = scores - np.reshape(bonuses, (-1,) + (1,) * (scores.ndim - 1))
+    scores = scores.ravel()
+    index = int(random.choice(np.flatnonzero(scores == scores.min())))
+    return index, float(qualities.ravel()[index])
+
+
+def _order_games(games: Sequence[Tuple[List[int], List[int]]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Stacks a batch of role-assigned games into arrays of player indices and role categories, in role slot order."""
+    players = np.empty((len(games), GAME_SIZE), dtype=int)
+    roles = np.empty((len(games), GAME_SIZE), dtype=int)
+    for row, (subset, game_roles) in enumerate(games):
+        by_slot = sorted(range(GAME_SIZE), key=game_roles.__getitem__)
+        players[row] = [subset[position] for position in by_slot]
+        roles[row] = [game_roles[position] for position in by_slot]
+    return players, roles
+
+
+def _quality_ranges(
+    players: np.ndarray, roles: np.ndarray, mus: np.ndarray, sigmas: np.ndarray, beta: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the lowest and highest quality any split of each game ordered by `_order_games` could have."""
+    game_mus = mus[players, roles]
+    variance = GAME_SIZE * beta**2 + np.sum(np.square(sigmas[players, roles]), axis=-1)
+    largest_difference = np.zeros(len(players))
+    start = 0
+    for slots in ROLE_SLOTS:
+        role_mus = np.sort(game_mus[:, start : start + slots], axis=-1)
+        largest_difference += role_mus[:, slots // 2 :].sum(axis=-1) - role_mus[:, : slots // 2].sum(axis=-1)
+        start += slots
+    highest = np.sqrt(GAME_SIZE * beta**2 / variance)
+    lowest = highest * np.exp(-np.square(largest_difference) / (2 * variance))
+    return lowest, highest
+
+
+def _score_games(
+    games: Sequence[Tuple[List[int], List[int]]],
+    mus: np.ndarray,
+    sigmas: np.ndarray,
+    beta: float,
+    bonuses: Optional[np.ndarray] = None,
+) -> GameResult:
+    """Scores every split of a batch of role-assigned games together and returns the best one."""
+    return _score_ordered_games(*_order_games(games), mus, sigmas, beta, bonuses)
+
+
+def _score_ordered_games(
+    players: np.ndarray,
+    roles: np.ndarray,
+    mus: np.ndarray,
+    sigmas: np.ndarray,
+    beta: float,
+    bonuses: Optional[np.ndarray] = None,
+) -> GameResult:
+    """Scores every split of a batch of games ordered by `_order_games` together and returns the best one."""
+    split_players = players[:, SPLITS]
+    split_roles = roles[:, SPLITS]
+    index, quality = find_best_quality(
+        mus[split_players, split_roles],
+        sigmas[split_players, split_roles],
+        beta,
+        None if bonuses is None else bonuses[players].sum(axis=1),
+    )
+    row, split = divmod(index, len(SPLITS))
+    return _split_result(split_players[row, split], split_roles[row, split], quality)
+
+
+def _rank_ordered_games(
+    players: np.ndarray,
+    roles: np.ndarray,
+    mus: np.ndarray,
+    sigmas: np.ndarray,
+    beta: float,
+    bonuses: Optional[np.ndarray] = None,
+) -> Iterator[Tuple[float, GameResult]]:
+    """Yields the best split of every game in a batch ordered by `_order_games` with its `game_score`, best first.
+
+    Ties are broken at random, both between the splits of a game and between games, as in `find_best_quality`.
+    """
+    split_players = players[:, SPLITS]
+    split_roles = roles[:, SPLITS]
+    qualities = batch_match_quality(mus[split_players, split_roles], sigmas[split_players, split_roles], beta)
+    gaps = np.abs(TARGET_QUALITY - qualities)
+    rng = np.random.default_rng(random.getrandbits(64))
+    splits = np.where(gaps == gaps.min(axis=1, keepdims=True), rng.random(gaps.shape), -1.0).argmax(axis=1)
+    rows = np.arange(len(players))
+    scores = gaps[rows, splits]
+    if bonuses is not None:
+        scores = scores - bonuses[players].sum(axis=1)
+    for row in np.lexsort((rng.random(len(players)), scores)):
+        split = splits[row]
+        yield float(scores[row]), _split_result(
+            split_players[row, split], split_roles[row, split], float(qualities[row, split])
+        )
+
+
+def _split_result(split_players: np.ndarray, split_roles: np.ndarray, quality: float) -> GameResult:
+    """Packs one split of a game, team 1 then team 2 in role slot order, into a `GameResult`."""
+    best_game = list(zip(split_players.tolist(), split_roles.tolist()))
+    return quality, best_game[:TEAM_SIZE], best_game[TEAM_SIZE:]
+
+
+def _expand_signature_counts(
+    groups: Sequence[Tuple[List[int], int, int]],
+    mus: Sequence[Sequence[float]],
+    sigmas: Sequence[Sequence[float]],
+    should_prune: Callable[..., bool],
+    bonuses: Optional[Sequence[float]] = None,
+) -> Iterator[Tuple[List[int], List[int]]]:
+    """Yields the concrete players and roles for one feasible count vector, lowest sigma choices first.
+
+    `groups` holds (players of a signature, role category, number of players to put on that role).
+    """
+    group_bounds = [
+        sum(sorted(sigmas[index][role] ** 2 for index in members)[:taken]) for members, role, taken in groups
+    ]
+    remaining_bounds = list(itertools.accumulate(reversed(group_bounds), initial=0.0))[::-1]
+    if bonuses is not None:
+        group_bonuses = [
+            sum(sorted((bonuses[index] for index in members), reverse=True)[:taken]) for members, _, taken in groups
+        ]
+        remaining_bonuses = list(itertools.accumulate(reversed(group_bonuses), initial=0.0))[::-1]
+    # remaining_ceilings[i] is the largest sigma squared total groups i onward could add, and
+    # remaining_mu_ranges[i][role] the (lowest, highest) mu of the players they could put on a role. Both are only
+    # worked out once a branch could be too even, which most searches never reach.
+    remaining_ceilings: List[float] = []
+    remaining_mu_ranges: List[List[Tuple[float, float]]] = []
+    subset: List[int] = []
+    roles: List[int] = []
+    role_mus: List[List[float]] = [[] for _ in ROLE_SLOTS]
+    used = set()
+
+    def upper_bounds(position: int, partial_bound: float) -> Tuple[float, float]:
+        if not remaining_ceilings:
+            group_ceilings = [
+                sum(sorted(sigmas[index][role] ** 2 for index in members)[len(members) - taken :])
+                for members, role, taken in groups
+            ]
+            remaining_ceilings.extend(list(itertools.accumulate(reversed(group_ceilings), initial=0.0))[::-1])
+            remaining_mu_ranges.extend([[(math.inf, -math.inf)] * len(ROLE_SLOTS)] * (len(groups) + 1))
+            for group_position in range(len(groups) - 1, -1, -1):
+                members, role, _ = groups[group_position]
+                ranges = list(remaining_mu_ranges[group_position + 1])
+                group_mus = [mus[index][role] for index in members]
+                ranges[role] = (min([ranges[role][0], *group_mus]), max([ranges[role][1], *group_mus]))
+                remaining_mu_ranges[group_position] = ranges
+        largest_difference = 0.0
+        for role, slots in enumerate(ROLE_SLOTS):
+            low, high = remaining_mu_ranges[position][role]
+            largest_difference += slots // 2 * (max([high, *role_mus[role]]) - min([low, *role_mus[role]]))
+        return partial_bound + remaining_ceilings[position], largest_difference
+
+    def expand(position: int, partial_bound: float, partial_bonus: float) -> Iterator[Tuple[List[int], List[int]]]:
+        if position == len(groups):
+            yield list(subset), list(roles)
+            return
+        if should_prune(
+            partial_bound + remaining_bounds[position],
+            lambda: upper_bounds(position, partial_bound),
+            partial_bonus + remaining_bonuses[position] if bonuses is not None else None,
+        ):
+            return
+        members, role, taken = groups[position]
+        # Longest waiting players first when waits count, since their games score best.
+        available = sorted(
+            (index for index in members if index not in used),
+            key=lambda index: sigmas[index][role] if bonuses is None else -bonuses[index],
+        )
+        for chosen in itertools.combinations(available, taken):
+            subset.extend(chosen)
+            roles.extend([role] * taken)
+            role_mus[role].extend(mus[index][role] for index in chosen)
+            used.update(chosen)
+            yield from expand(
+                position + 1,
+                partial_bound + sum(sigmas[index][role] ** 2 for index in chosen),
+                partial_bonus + sum(bonuses[index] for index in chosen) if bonuses is not None else 0.0,
+            )
+            used.difference_update(chosen)
+            del role_mus[role][-taken:]
+            del subset[-taken:]
+            del roles[-taken:]
+
+    yield from expand(0, 0.0, 0.0)
+
+
+def _iter_candidate_games(
+    members: Sequence[List[int]],
+    signatures: Sequence[Signature],
+    count_vectors: Iterator[Tuple[Tuple[int, ...], float]],
+    mus: Sequence[Sequence[float]],
+    sigmas: Sequence[Sequence[float]],
+    should_prune: Callable[..., bool],
+    stats: "SearchStats",
+    partition: int = 0,
+    partitions: int = 1,
+    bonuses: Optional[Sequence[float]] = None,
+) -> Iterator[Tuple[List[int], List[int]]]:
+    """Expands each feasible count vector that hashes to `partition` into concrete (players, roles) games."""
+    for counts, share in count_vectors:
+        taken_positions = [position for position, taken in enumerate(counts) if taken]
+        allocation = allocate_roles(tuple((signatures[position], counts[position]) for position in taken_positions))
+        if allocation is not None and hash(counts) % partitions == partition:
+            for role_allocation in allocation[1]:
+                groups = [
+                    (members[position], role, role_count)
+                    for position, role_counts in zip(taken_positions, role_allocation)
+                    for role, role_count in enumerate(role_counts)
+                    if role_count
+                ]
+                yield from _expand_signature_counts(groups, mus, sigmas, should_prune, bonuses)
+        if not stats.timed_out:
+            stats.covered += share
+
+
+class SearchStats:
+    """Tracks how far a matchmaking search got, and stops it once its time budget runs out."""
+
+    def __init__(self: Self, budget: Optional[float] = None) -> None:
+        """Init that takes in the number of seconds the search may run for, or None to search until done."""
+        self.deadline = None if budget is None else time.monotonic() + budget
+        self.covered = 0.0
+        self.games_scored = 0
+        # Branches and games dropped because their quality bounds could not beat the best game found so far.
+        self.pruned = 0
+        self.timed_out = False
+        # The best distinct games found, best first, as (game_score, game by user id).
+        self.candidates: List[Tuple[float, StoredGame]] = []
+
+    def out_of_time(self: Self) -> bool:
+        """Checks whether the search has used up its budget."""
+        if not self.timed_out and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.timed_out = True
+        return self.timed_out
+
+    @classmethod
+    def merge(cls: Type["SearchStats"], partition_stats: Sequence["SearchStats"]) -> "SearchStats":
+        """Combines the stats of every partition of a search."""
+        merged = cls()
+        merged.covered = max(0.0, 1.0 - sum(1.0 - stats.covered for stats in partition_stats))
+        merged.games_scored = sum(stats.games_scored for stats in partition_stats)
+        merged.pruned = sum(stats.pruned for stats in partition_stats)
+        merged.timed_out = any(stats.timed_out for stats in partition_stats)
+        # Partitions never search the same count vector, so their candidates are already distinct.
+        merged.candidates = heapq.nsmallest(
+            max((len(stats.candidates) for stats in partition_stats), default=0),
+            (candidate for stats in partition_stats for candidate in stats.candidates),
+            key=lambda candidate: candidate[0],
+        )
+        return merged
+
+
+class QueueSnapshot:
+    """A picklable copy of everything the search needs to know about the queue."""
+
+    def __init__(
+        self: Self,
+        user_ids: List[int],
+        costs: List[List[int]],
+        mus: List[List[float]],
+        sigmas: List[List[float]],
+        beta: Optional[float] = None,
+        waits: Optional[List[float]] = None,
+        wait_weight: float = 0.0,
+    ) -> None:
+        """Init that takes in each player's user id, role costs and ratings, and optionally their waits."""
+        self.user_ids = user_ids
+        self.costs = costs
+        self.mus = mus
+        self.sigmas = sigmas
+        self.beta = trueskill.global_env().beta if beta is None else beta
+        self.waits = waits
+        self.wait_weight = wait_weight
+
+    def wait_bonuses(self: Self) -> Optional[List[float]]:
+        """Returns how much further from `TARGET_QUALITY` each player lets a game be, or None if waits do not count."""
+        if self.waits is None or self.wait_weight <= 0:
+            return None
+        return [self.wait_weight * wait / 60 for wait in self.waits]
+
+
+def game_score(result: GameResult, bonuses: Optional[Sequence[float]] = None) -> float:
+    """Returns how far a game is from `TARGET_QUALITY`, less the wait bonuses of its players. Lower is better."""
+    gap = abs(TARGET_QUALITY - result[0])
+    if bonuses is None:
+        return gap
+    return gap - sum(bonuses[index] for index, _ in result[1] + result[2])
+
+
+def pick_best_result(
+    results: Iterable[Optional[GameResult]], bonuses: Optional[Sequence[float]] = None
+) -> Optional[GameResult]:
+    """Picks the game with the lowest `game_score` out of the results of several searches."""
+    return min(
+        (result for result in results if result is not None),
+        key=lambda result: game_score(result, bonuses),
+        default=None,
+    )
+
+
+class CandidateGames:
+    """The best few distinct games found by a search, kept in a bounded heap by `game_score`."""
+
+    def __init__(self: Self, size: int) -> None:
+        """Init that takes in the most games to keep."""
+        self.size = size
+        # (negated score, order pushed, teams), so the worst game kept is at the top of the heap.
+        self.heap: List[Tuple[float, int, Tuple[frozenset, frozenset]]] = []
+        self.games: Dict[Tuple[frozenset, frozenset], Tuple[float, GameResult]] = {}
+        self.pushed = 0
+
+    def threshold(self: Self) -> float:
+        """Returns the score a game has to beat to be kept."""
+        return -self.heap[0][0] if len(self.heap) >= self.size else math.inf
+
+    def push(self: Self, score: float, game: GameResult) -> None:
+        """Keeps a game if it beats the worst game kept and is not already kept with its teams swapped."""
+        teams = frozenset(game[1]), frozenset(game[2])
+        if score >= self.threshold() or teams in self.games or teams[::-1] in self.games:
+            return
+        self.games[teams] = (score, game)
+        heapq.heappush(self.heap, (-score, self.pushed, teams))
+        self.pushed += 1
+        if len(self.heap) > self.size:
+            _, _, dropped = heapq.heappop(self.heap)
+            del self.games[dropped]
+
+    def best(self: Self) -> Optional[GameResult]:
+        """Returns the game with the lowest score, or None if no game was kept."""
+        return min(self.games.values(), key=lambda candidate: candidate[0], default=(0.0, None))[1]
+
+    def ranked(self: Self) -> List[Tuple[float, GameResult]]:
+        """Returns every game kept with its score, best first."""
+        return sorted(self.games.values(), key=lambda candidate: candidate[0])
+
+
+def _seed_longest_waiting(snapshot: QueueSnapshot, bonuses: Sequence[float]) -> Optional[GameResult]:
+    """Seats the longest waiting players that can fill a game, prioritizing players onto their main role.
+
+    Returns the best split of that game, or None if there is no valid game.
+    """
+    order = sorted(range(len(bonuses)), key=lambda index: -bonuses[index])
+    seats = seat_players([snapshot.costs[index] for index in order], 1)
+    if seats is None:
+        return None
+    return _score_games(
+        [([order[position] for position, _ in seats], [role for _, role in seats])],
+        np.asarray(snapshot.mus, dtype=float),
+        np.asarray(snapshot.sigmas, dtype=float),
+        snapshot.beta,
+    )
+
+
+def search_best_game(  # noqa: C901
+    snapshot: QueueSnapshot,
+    partition: int = 0,
+    partitions: int = 1,
+    budget: Optional[float] = None,
+    required: Optional[int] = None,
+    incumbent: Optional[GameResult] = None,
+    keep: int = 1,
+) -> Tuple[Optional[GameResult], SearchStats]:
+    """Finds the valid game whose best team split has a match quality closest to `TARGET_QUALITY`.
+
+    Returns the quality and each team as (player index, role category) pairs, or None if there is no valid game.
+    """
+    stats = SearchStats(budget)
+    costs, mus, sigmas, beta = snapshot.costs, snapshot.mus, snapshot.sigmas, snapshot.beta
+    classes = group_by_signature(costs)
+    # The lowest sigma squared each player can bring to a game, over the roles they can play.
+    lowest_sigma_squared = {
+        index: min(sigmas[index][role] ** 2 for role in range(len(ROLE_SLOTS)) if signature[role] < INVALID_COST)
+        for signature, members in classes.items()
+        for index in members
+    }
+    # And the highest, for the lowest quality a game could have.
+    highest_sigma_squared = {
+        index: max(sigmas[index][role] ** 2 for role in range(len(ROLE_SLOTS)) if signature[role] < INVALID_COST)
+        for signature, members in classes.items()
+        for index in members
+    }
+    groups = [(signature, members) for signature, members in classes.items()]
+    if required is not None:
+        if required not in lowest_sigma_squared:
+            stats.covered = 1.0
+            return incumbent, stats
+        groups = [(signature, [index for index in members if index != required]) for signature, members in groups]
+        groups = [(signature, members) for signature, members in groups if members]
+        groups.insert(0, (tuple(costs[required]), [required]))
+    for _, members in groups:
+        members.sort(key=lambda index: lowest_sigma_squared[index])
+    groups.sort(key=lambda group: (group[1] != [required], lowest_sigma_squared[group[1][0]]))
+    signatures = [signature for signature, _ in groups]
+    members_by_signature = [members for _, members in groups]
+    minimums = [1 if members == [required] else 0 for members in members_by_signature]
+    lower_bounds = [
+        list(itertools.accumulate((lowest_sigma_squared[index] for index in members), initial=0.0))
+        for members in members_by_signature
+    ]
+    upper_bounds = [
+        list(
+            itertools.accumulate(sorted((highest_sigma_squared[index] for index in members), reverse=True), initial=0.0)
+        )
+        for members in members_by_signature
+    ]
+    mu_ranges = [
+        [
+            (min(mus[index][role] for index in members), max(mus[index][role] for index in members))
+            if signature[role] < INVALID_COST
+            else (math.inf, -math.inf)
+            for role in range(len(ROLE_SLOTS))
+        ]
+        for signature, members in zip(signatures, members_by_signature)
+    ]
+    bonuses = snapshot.wait_bonuses()
+    bonus_array = None if bonuses is None else np.asarray(bonuses, dtype=float)
+    # The most any game's players can take off its score.
+    bonus_ceiling = 0.0 if bonuses is None else sum(sorted(bonuses, reverse=True)[:GAME_SIZE])
+    bonus_bounds = (
+        None
+        if bonuses is None
+        else [
+            list(itertools.accumulate(sorted((bonuses[index] for index in members), reverse=True), initial=0.0))
+            for members in members_by_signature
+        ]
+    )
+    candidates = CandidateGames(keep)
+    if incumbent is not None:
+        candidates.push(game_score(incumbent, bonuses), incumbent)
+    if bonuses is not None and required is None:
+        # Start from the longest waiting players' game, so that games of players who just joined are pruned early.
+        seed = _seed_longest_waiting(snapshot, bonuses)
+        if seed is not None:
+            candidates.push(game_score(seed, bonuses), seed)
+    # The score a game has to beat to be kept, which bounds every branch.
+    best_score = candidates.threshold()
+
+    def finish() -> Tuple[Optional[GameResult], SearchStats]:
+        stats.candidates = [(score, store_game(snapshot.user_ids, game)) for score, game in candidates.ranked()]
+        return candidates.best(), stats
+
+    if best_score <= QUALITY_TOLERANCE - bonus_ceiling:
+        stats.covered = 1.0
+        return finish()
+
+    def should_prune(
+        sigma_squared_floor: float,
+        upper_bounds: Optional[Callable[[], Tuple[float, float]]] = None,
+        branch_bonus: Optional[float] = None,
+    ) -> bool:
+        if stats.out_of_time():
+            return True
+        # A branch's games score at best their distance from the target less their largest wait bonus.
+        threshold = best_score + (bonus_ceiling if branch_bonus is None else branch_bonus) - QUALITY_TOLERANCE
+        # Quality is highest with no mu difference and the lowest sigma total.
+        highest_quality = match_quality(0, sigma_squared_floor, beta)
+        if TARGET_QUALITY - highest_quality >= threshold:
+            stats.pruned += 1
+            return True
+        if upper_bounds is None or highest_quality - TARGET_QUALITY < threshold:
+            return False
+        # Quality is lowest with the largest mu difference, at one end of the range of sigma totals, since quality
+        # only has a peak in the sigma total.
+        sigma_squared_ceiling, largest_difference = upper_bounds()
+        lowest_quality = min(
+            match_quality(largest_difference, sigma_squared_floor, beta),
+            match_quality(largest_difference, sigma_squared_ceiling, beta),
+        )
+        if lowest_quality - TARGET_QUALITY >= threshold:
+            stats.pruned += 1
+            return True
+        return False
+
+    def score_batch() -> None:
+        players, roles = _order_games(batch)
+        batch.clear()
+        lowest, highest = _quality_ranges(players, roles, mu_array, sigma_array, beta)
+        distance = np.maximum(np.maximum(TARGET_QUALITY - highest, lowest - TARGET_QUALITY), 0.0)
+        if bonus_array is not None:
+            distance = distance - bonus_array[players].sum(axis=1)
+        kept = distance < best_score - QUALITY_TOLERANCE
+        stats.pruned += int(np.count_nonzero(~kept))
+        stats.games_scored += int(np.count_nonzero(kept))
+        if not kept.any():
+            return
+        if keep == 1:
+            best_game = _score_ordered_games(players[kept], roles[kept], mu_array, sigma_array, beta, bonus_array)
+            candidates.push(game_score(best_game, bonuses), best_game)
+            return
+        ranked = _rank_ordered_games(players[kept], roles[kept], mu_array, sigma_array, beta, bonus_array)
+        for score, game in ranked:
+            if score >= candidates.threshold():
+                break
+            candidates.push(score, game)
+
+    count_vectors = _search_signature_counts(
+        signatures,
+        [len(members) for members in members_by_signature],
+        lower_bounds,
+        should_prune,
+        stats,
+        minimums,
+        upper_bounds,
+        mu_ranges,
+        bonus_bounds,
+    )
+    games = _iter_candidate_games(
+        members_by_signature,
+        signatures,
+        count_vectors,
+        mus,
+        sigmas,
+        should_prune,
+        stats,
+        partition,
+        partitions,
+        bonuses,
+    )
+    mu_array = np.asarray(mus, dtype=float)
+    sigma_array = np.asarray(sigmas, dtype=float)
+    batch: List[Tuple[List[int], List[int]]] = []
+    for game in games:
+        batch.append(game)
+        if len(batch) < BATCH_SIZE:
+            continue
+        score_batch()
+        best_score = candidates.threshold()
+        if best_score <= QUALITY_TOLERANCE - bonus_ceiling:
+            # No game left unsearched can score more than `QUALITY_TOLERANCE` lower, same as a pruned branch.
+            stats.covered = 1.0
+            return finish()
+        if stats.out_of_time():
+            break
+
+    if batch:
+        score_batch()
+
+    return finish()
+
+
+def seat_players(costs: Sequence[Sequence[int]], games: int) -> Optional[List[Tuple[int, int]]]:
+    """Picks the players and role categories for several disjoint games in a single assignment.
+
+    Returns (player index, role category) for every seat, or None if the players can not fill that many games.
+    """
+    slot_roles = [role for role, slots in enumerate(ROLE_SLOTS) for _ in range(slots * games)]
+    if len(costs) < len(slot_roles):
+        return None
+    # Weight role costs so that no amount of queue position tie-breaking can outweigh a single fill.
+    weight = len(costs) * len(slot_roles) + 1
+    most_fills = len(slot_roles) * FILL_COST
+    matrix = np.array([[player_costs[role] for role in slot_roles] for player_costs in costs], dtype=np.int64)
+    matrix[matrix == INVALID_COST] = most_fills + 1
+    matrix = matrix * weight + np.arange(len(costs), dtype=np.int64)[:, np.newaxis]
+    row_ind, col_ind = linear_sum_assignment(matrix)
+    if int(matrix[row_ind, col_ind].sum()) // weight > most_fills:
+        return None
+    return [(int(row), slot_roles[col]) for row, col in zip(row_ind, col_ind)]
+
+
+def _deal_seats(snapshot: QueueSnapshot, seated: List[Tuple[int, int]], games: int) -> List[List[Tuple[int, int]]]:
+    """Deals seated players out to games in a snake draft by mu on their role, one role at a time."""
+    seats: List[List[Tuple[int, int]]] = [[] for _ in range(games)]
+    for role, slots in enumerate(ROLE_SLOTS):
+        players = sorted(
+            (index for index, seat_role in seated if seat_role == role), key=lambda index: -snapshot.mus[index][role]
+        )
+        order = [game for turn in range(slots) for game in (range(games) if turn % 2 == 0 else reversed(range(games)))]
+        for index, game in zip(players, order):
+            seats[game].append((index, role))
+    return seats
+
+
+def find_disjoint_games(
+    snapshot: QueueSnapshot, max_games: int, budget: Optional[float] = None
+) -> Tuple[List[GameResult], SearchStats]:
+    """Finds as many disjoint games as the queue can fill, up to `max_games`, each as close to the target as it can."""
+    games = min(max_games, len(snapshot.user_ids) // GAME_SIZE)
+    while games > 1 and seat_players(snapshot.costs, games) is None:
+        games -= 1
+    if games <= 1:
+        best_game, stats = search_best_game(snapshot, budget=budget)
+        return [best_game] if best_game is not None else [], stats
+
+    stats = SearchStats(budget)
+    mus = np.asarray(snapshot.mus, dtype=float)
+    sigmas = np.asarray(snapshot.sigmas, dtype=float)
+    seats = _deal_seats(snapshot, seat_players(snapshot.costs, games), games)
+
+    def score(game_seats: List[Tuple[int, int]]) -> GameResult:
+        stats.games_scored += 1
+        return _score_games(
+            [([index for index, _ in game_seats], [role for _, role in game_seats])], mus, sigmas, snapshot.beta
+        )
+
+    results = [score(game_seats) for game_seats in seats]
+    improved = True
+    while improved and not stats.out_of_time():
+        improved = False
+        for first, second in itertools.combinations(range(games), 2):
+            for a, b in itertools.product(range(GAME_SIZE), range(GAME_SIZE)):
+                if seats[first][a][1] != seats[second][b][1]:
+                    continue
+                seats[first][a], seats[second][b] = seats[second][b], seats[first][a]
+                swapped = score(seats[first]), score(seats[second])
+                gap_before = abs(TARGET_QUALITY - results[first][0]) + abs(TARGET_QUALITY - results[second][0])
+                gap_after = abs(TARGET_QUALITY - swapped[0][0]) + abs(TARGET_QUALITY - swapped[1][0])
+                if gap_after < gap_before - QUALITY_TOLERANCE / games:
+                    results[first], results[second] = swapped
+                    improved = True
+                else:
+                    seats[first][a], seats[second][b] = seats[second][b], seats[first][a]
+    stats.covered = 0.0 if stats.timed_out else 1.0
+    return results, stats
+
+
+def store_game(user_ids: Sequence[int], game: Optional[GameResult]) -> Optional[StoredGame]:
+    """Swaps the player indices of a game for the user ids at those indices."""
+    if game is None:
+        return None
+    quality, team1, team2 = game
+    return (
+        quality,
+        [(user_ids[index], role) for index, role in team1],
+        [(user_ids[index], role) for index, role in team2],
+    )
+
+
+def load_game(user_ids: Sequence[int], game: Optional[StoredGame]) -> Optional[GameResult]:
+    """Swaps the user ids of a stored game for their indices in `user_ids`."""
+    if game is None:
+        return None
+    indices = {user_id: index for index, user_id in enumerate(user_ids)}
+    quality, team1, team2 = game
+    return (
+        quality,
+        [(indices[user_id], role) for user_id, role in team1],
+        [(indices[user_id], role) for user_id, role in team2],
+    )
+
+
+class IncrementalMatchmaker:
+    """Keeps the best game for a queue up to date as players join and leave, so it is ready before a game starts."""
+
+    def __init__(self: Self, search: AsyncSearch) -> None:
+        """Init that takes in the search to run, called like `search_best_game` with keyword arguments only."""
+        self.search = search
+        self.lock = asyncio.Lock()
+        # Bumped whenever the players are replaced, so a search that was running then knows its result is stale.
+        self.generation = 0
+        self.clear()
+
+    def clear(self: Self) -> None:
+        """Forgets every player."""
+        # Role costs, mus and sigmas of each player, in the order they joined.
+        self.players: Dict[int, Tuple[List[int], List[float], List[float]]] = {}
+        self.best: Optional[StoredGame] = None
+        self.stats = SearchStats()
+        self.stats.covered = 1.0
+        # False while a search is running, or after players were added without one.
+        self.searched = True
+        self.generation += 1
+
+    def snapshot(self: Self) -> QueueSnapshot:
+        """Packs every player into a snapshot, in the order they joined."""
+        user_ids = list(self.players)
+        return QueueSnapshot(
+            user_ids=user_ids,
+            costs=[self.players[user_id][0] for user_id in user_ids],
+            mus=[self.players[user_id][1] for user_id in user_ids],
+            sigmas=[self.players[user_id][2] for user_id in user_ids],
+        )
+
+    async def add(
+        self: Self, user_id: int, costs: List[int], mus: List[float], sigmas: List[float], search: bool = True
+    ) -> None:
+        """Adds a player, and searches the games they are in for one better than the current best game.
+
+        With `search` False the player is only added, and `refresh` has to be awaited before the best game is used.
+        """
+        async with self.lock:
+            self.players[user_id] = (list(costs), list(mus), list(sigmas))
+            if not search:
+                self.searched = False
+                return
+            searched, self.searched = self.searched, False
+            generation, snapshot = self.generation, self.snapshot()
+            best_game, stats = await self.search(
+                snapshot, required=len(snapshot.user_ids) - 1, incumbent=self.game_for(snapshot)
+            )
+            if generation != self.generation:
+                return
+            self.searched = searched
+            # The games without the new player were covered by earlier searches, so this undercounts the coverage.
+            # The stats are replaced rather than updated, as earlier ones may be cached.
+            previous, self.stats = self.stats, SearchStats()
+            self.stats.covered = min(previous.covered, stats.covered)
+            self.stats.games_scored = previous.games_scored + stats.games_scored
+            self.stats.pruned = previous.pruned + stats.pruned
+            self.stats.timed_out = previous.timed_out or stats.timed_out
+            self.store(snapshot, best_game)
+
+    async def remove(self: Self, user_id: int) -> None:
+        """Removes a player, searching the whole queue again if they were in the best game."""
+        async with self.lock:
+            if self.players.pop(user_id, None) is None:
+                return
+            if self.best is not None and user_id in [player for player, _ in self.best[1] + self.best[2]]:
+                self.best = None
+                await self._search_all()
+
+    async def refresh(self: Self) -> None:
+        """Searches the whole queue, for after players were added without searching."""
+        async with self.lock:
+            await self._search_all()
+
+    async def _search_all(self: Self) -> None:
+        """Searches the whole queue and keeps the result, unless the players were replaced in the meantime."""
+        self.searched = False
+        generation, snapshot = self.generation, self.snapshot()
+        best_game, stats = await self.search(snapshot)
+        if generation == self.generation:
+            self.reset(snapshot, best_game, stats)
+
+    def reset(self: Self, snapshot: QueueSnapshot, best_game: Optional[GameResult], stats: SearchStats) -> None:
+        """Replaces every player and the best game with the result of a search of the whole queue."""
+        self.players = {
+            user_id: (list(costs), list(mus), list(sigmas))
+            for user_id, costs, mus, sigmas in zip(snapshot.user_ids, snapshot.costs, snapshot.mus, snapshot.sigmas)
+        }
+        self.stats = stats
+        self.store(snapshot, best_game)
+        self.searched = True
+        self.generation += 1
+
+    def store(self: Self, snapshot: QueueSnapshot, best_game: Optional[GameResult]) -> None:
+        """Keeps a game found in `snapshot` as the best game, by user id so it survives players leaving."""
+        self.best = store_game(snapshot.user_ids, best_game)
+
+    def game_for(self: Self, snapshot: QueueSnapshot) -> Optional[GameResult]:
+        """Returns the best game with teams indexed into `snapshot`."""
+        return load_game(snapshot.user_ids, self.best)
+
+    def matches(self: Self, snapshot: QueueSnapshot) -> bool:
+        """Checks whether `snapshot` holds exactly the players, role costs and ratings the best game was found for.
+
+        The best game never matches while a search is running, or after players were added without one.
+        """
+        if not self.searched or len(snapshot.user_ids) != len(self.players):
+            return False
+        return all(
+            self.players.get(user_id) == (list(costs), list(mus), list(sigmas))
+            for user_id, costs, mus, sigmas in zip(snapshot.user_ids, snapshot.costs, snapshot.mus, snapshot.sigmas)
+        )
+
+
+class MatchmakingCache:
+    """A bounded LRU cache of search results, keyed by the queued players, their role costs and a ratings version.
+
+    Bumping the ratings version whenever ratings change makes every older entry miss, without reading any ratings.
+    """
+
+    def __init__(self: Self, size: int) -> None:
+        """Init that takes in the most results to keep."""
+        self.size = size
+        self.entries: collections.OrderedDict[
+            CacheKey, Tuple[Optional[StoredGame], SearchStats]
+        ] = collections.OrderedDict()
+
+    @staticmethod
+    def key(user_ids: Sequence[int], costs: Sequence[Sequence[int]], ratings_version: int) -> CacheKey:
+        """Builds the key for a queue, which does not depend on the order players joined in."""
+        return ratings_version, tuple(sorted((user_id, tuple(cost)) for user_id, cost in zip(user_ids, costs)))
+
+    def get(self: Self, key: CacheKey) -> Optional[Tuple[Optional[StoredGame], SearchStats]]:
+        """Returns the cached game and search stats for a queue, or None if it is not cached."""
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self: Self, key: CacheKey, game: Optional[StoredGame], stats: SearchStats) -> None:
+        """Caches the game found for a queue, evicting the least recently used result when full."""
+        self.entries[key] = (game, stats)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def incumbent(self: Self, key: CacheKey) -> Optional[StoredGame]:
+        """Finds the most recent cached game the queue in `key` can still play, to warm-start a search."""
+        ratings_version, players = key
+        queued = dict(players)
+        for (cached_version, cached_players), (game, _) in reversed(self.entries.items()):
+            if cached_version != ratings_version or game is None:
+                continue
+            cached_costs = dict(cached_players)
+            if all(queued.get(user_id) == cached_costs[user_id] for user_id, _ in game[1] + game[2]):
+                return game
+        return None
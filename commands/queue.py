@@ -1,12 +1,20 @@
 from discord import Member, Guild
-from typing import List, Dict, Self, Tuple, Type
+from typing import Any, List, Dict, Optional, Self, Sequence, Tuple, Type
 from dotenv import load_dotenv
+from commands import matchmaking
+from database.db import DBGlobalSession
+from database.models.player_data import ensure_players_in_db, load_rating_arrays
 from util.env_load import (
     ASSASSIN_FILL_ID,
     ASSASSIN_ID,
+    GUILD_ID,
+    MATCHMAKING_BUDGET_MS,
+    MATCHMAKING_CANDIDATES,
+    MATCHMAKING_WORKERS,
     OFFLANE_FILL_ID,
     OFFLANE_ID,
     QUEUED_ID,
+    QUEUE_TRACE_PATH,
     SUPPORT_FILL_ID,
     SUPPORT_ID,
     TANK_FILL_ID,
@@ -15,35 +23,205 @@ from util.env_load import (
 
 from util.exceptions import (
     AlreadyInQueueException,
+    GuildNotConfiguredException,
     NoGuildException,
     NoMainRoleException,
     PlayerNotFoundException,
 )
 
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import json
 import logging
+import multiprocessing
+import time
 
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# How many milliseconds each search of a queue's matchmaker may run for when `MATCHMAKING_BUDGET_MS` is 0, since
+# they run on every join and leave and are never left unbounded.
+MATCHMAKER_BUDGET_MS = 300
+
+
+def ensure_guild_configured(guild_id: int) -> None:
+    """Raises if the role and channel ids are set up for another guild than this one."""
+    if GUILD_ID is not None and guild_id != GUILD_ID:
+        raise GuildNotConfiguredException(guild_id)
+
+
+def get_role_costs(member: Member) -> List[int]:
+    """Returns the cost of assigning a member to each role category, in the order tank, support, assassin, offlane.
+
+    The cost is 0 if it is their main role, 1 if they are a fill, and 2 if they do not have the role.
+    """
+    costs = [matchmaking.INVALID_COST] * len(matchmaking.ROLE_SLOTS)
+    for role in member.roles:
+        match role.name:
+            case "Tank":
+                costs[matchmaking.TANK] = matchmaking.MAIN_COST
+            case "Tank (Fill)":
+                costs[matchmaking.TANK] = matchmaking.FILL_COST
+            case "Support":
+                costs[matchmaking.SUPPORT] = matchmaking.MAIN_COST
+            case "Support (Fill)":
+                costs[matchmaking.SUPPORT] = matchmaking.FILL_COST
+            case "Assassin":
+                costs[matchmaking.ASSASSIN] = matchmaking.MAIN_COST
+            case "Assassin (Fill)":
+                costs[matchmaking.ASSASSIN] = matchmaking.FILL_COST
+            case "Offlane":
+                costs[matchmaking.OFFLANE] = matchmaking.MAIN_COST
+            case "Offlane (Fill)":
+                costs[matchmaking.OFFLANE] = matchmaking.FILL_COST
+    return costs
+
+
+def get_matchmaking_budget() -> Optional[float]:
+    """Returns how many seconds a matchmaking search may run for, or None if `MATCHMAKING_BUDGET_MS` is set to 0."""
+    return MATCHMAKING_BUDGET_MS / 1000 if MATCHMAKING_BUDGET_MS > 0 else None
+
+
+def get_matchmaker_budget() -> float:
+    """Returns how many seconds each search of a queue's matchmaker may run for, which is never unbounded."""
+    return get_matchmaking_budget() or MATCHMAKER_BUDGET_MS / 1000
+
+
+_matchmaking_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_matchmaking_executor() -> ProcessPoolExecutor:
+    """Returns the process pool matchmaking runs in, starting it on first use.
+
+    Workers are spawned rather than forked, so they do not inherit the bot's event loop or connections.
+    """
+    global _matchmaking_executor
+    if _matchmaking_executor is None:
+        _matchmaking_executor = ProcessPoolExecutor(
+            max_workers=MATCHMAKING_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _matchmaking_executor
+
+
+async def search_in_pool(
+    snapshot: matchmaking.QueueSnapshot,
+    incumbent: Optional[matchmaking.GameResult] = None,
+    required: Optional[int] = None,
+    budget: Optional[float] = None,
+    keep: int = MATCHMAKING_CANDIDATES,
+) -> Tuple[Optional[matchmaking.GameResult], matchmaking.SearchStats]:
+    """Runs the matchmaking search in the process pool so the event loop is never blocked by it.
+
+    Queues of at least `matchmaking.PARALLEL_QUEUE_SIZE` players are split across every worker, and every worker
+    starts from the `incumbent` game if there is one. The search runs for `budget` seconds, or
+    `get_matchmaking_budget` if it is None, and keeps the best `keep` games.
+    """
+    if budget is None:
+        budget = get_matchmaking_budget()
+    loop = asyncio.get_running_loop()
+    executor = get_matchmaking_executor()
+    partitions = MATCHMAKING_WORKERS if len(snapshot.user_ids) >= matchmaking.PARALLEL_QUEUE_SIZE else 1
+    results = await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                executor,
+                matchmaking.search_best_game,
+                snapshot,
+                partition,
+                partitions,
+                budget,
+                required,
+                incumbent,
+                keep,
+            )
+            for partition in range(partitions)
+        )
+    )
+    return (
+        matchmaking.pick_best_result((best_game for best_game, _ in results), snapshot.wait_bonuses()),
+        matchmaking.SearchStats.merge([stats for _, stats in results]),
+    )
+
+
+async def search_for_matchmaker(
+    snapshot: matchmaking.QueueSnapshot,
+    required: Optional[int] = None,
+    incumbent: Optional[matchmaking.GameResult] = None,
+) -> Tuple[Optional[matchmaking.GameResult], matchmaking.SearchStats]:
+    """Runs a search for a queue's matchmaker in the process pool, within `get_matchmaker_budget`, keeping one game."""
+    return await search_in_pool(snapshot, incumbent, required, get_matchmaker_budget(), keep=1)
+
+
+# Trace lines waiting to be written, and the task writing them.
+_trace_lines: List[str] = []
+_trace_writer: Optional[asyncio.Task] = None
+
+
+def _append_to_trace(lines: List[str]) -> None:
+    """Appends lines to the trace at `QUEUE_TRACE_PATH`."""
+    with open(QUEUE_TRACE_PATH, "a") as trace_file:
+        trace_file.writelines(lines)
+
+
+async def _write_trace() -> None:
+    """Writes buffered trace lines in a thread until none are left, so the event loop never waits on the file."""
+    while _trace_lines:
+        lines = _trace_lines.copy()
+        _trace_lines.clear()
+        try:
+            await asyncio.to_thread(_append_to_trace, lines)
+        except OSError:
+            logger.exception(f"Could not write {len(lines)} events to the queue trace")
+
+
+def record_queue_event(event: str, user_id: int, **fields: Any) -> None:
+    """Appends a queue event to the trace at `QUEUE_TRACE_PATH` as a JSON line, if a trace is being recorded.
+
+    On the event loop, events are buffered and written in order by a single task, in a thread. Outside of it they
+    are written right away.
+    """
+    global _trace_writer
+    if QUEUE_TRACE_PATH is None:
+        return
+    _trace_lines.append(json.dumps({"time": time.time(), "event": event, "user_id": user_id, **fields}) + "\n")
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        lines = _trace_lines.copy()
+        _trace_lines.clear()
+        _append_to_trace(lines)
+        return
+    if _trace_writer is None or _trace_writer.done():
+        _trace_writer = loop.create_task(_write_trace())
+
 
 class Queue:
-    """Singleton class to represent the queue."""
+    """Class to represent a guild's queue, with one instance per guild."""
 
-    def __new__(cls: Type["Queue"]) -> "Queue":
-        """Create a new instance of the queue."""
-        if not hasattr(cls, "instance"):
-            cls.instance = super(Queue, cls).__new__(cls)
-            cls.instance.initialized = False
-        return cls.instance
+    # Every guild's queue, keyed by guild id.
+    instances: Dict[int, "Queue"] = {}
 
-    def __init__(self: Self) -> None:
-        """Initialize the queue."""
+    def __new__(cls: Type["Queue"], guild_id: int) -> "Queue":
+        """Returns the guild's queue, creating it the first time the guild is seen."""
+        if guild_id not in cls.instances:
+            ensure_guild_configured(guild_id)
+            cls.instances[guild_id] = super(Queue, cls).__new__(cls)
+            cls.instances[guild_id].initialized = False
+        return cls.instances[guild_id]
+
+    def __init__(self: Self, guild_id: int) -> None:
+        """Initialize the guild's queue."""
         if hasattr(self, "initialized") and self.initialized:
             return
         else:
             self.initialized = True
+            self.guild_id = guild_id
             self.queue: List[Member] = []
+            # When each player joined, or last came back from a game, as a unix timestamp.
+            self.joined_at: Dict[int, float] = {}
+            # Kept up to date as players join and leave, so a game is ready by the time one is started.
+            self.matchmaker = matchmaking.IncrementalMatchmaker(search_for_matchmaker)
 
     def as_dict(self: Self) -> Dict[str, List[str]]:  # noqa: C901
         """Lists the players in the queue and their roles."""
@@ -83,8 +261,12 @@ class Queue:
 
         return queue_data
 
-    def add(self: Self, user: Member) -> Tuple[int, int]:
-        """Adds a player to the queue, returns the user's id and the number of people in the queue."""
+    async def add(self: Self, user: Member, restoring: bool = False) -> Tuple[int, int]:
+        """Adds a player to the queue, returns the user's id and the number of people in the queue.
+
+        With `restoring`, the player is being put back in the queue on startup, so the matchmaker does not search the
+        games they make possible and the join is not traced again.
+        """
         assert type(user) is Member
         if user in self.queue:
             raise AlreadyInQueueException(user)
@@ -98,33 +280,87 @@ class Queue:
         ):
             raise NoMainRoleException(user)
         self.queue.append(user)
+        self.joined_at[user.id] = time.time()
+        try:
+            await self.add_to_matchmaker(user, restoring)
+        except BaseException:
+            # A player the matchmaker does not know of could never be matched, so they are taken back out.
+            if user in self.queue:
+                self.queue.remove(user)
+                self.joined_at.pop(user.id, None)
+            await self.matchmaker.remove(user.id)
+            raise
 
         return user.id, len(self.queue)
 
-    def remove(self: Self, user: Member) -> Tuple[int, int]:
+    async def remove(self: Self, user: Member) -> Tuple[int, int]:
         """Removes a player from the queue, returns the user's id and the number of people in the queue."""
         if user not in self.queue:
             raise PlayerNotFoundException(user)
         self.queue.remove(user)
+        self.joined_at.pop(user.id, None)
+        record_queue_event("leave", user.id)
         logger.info(f"{user} was removed from the queue")
         logger.info(f"There are now {len(self.queue)} players in the queue")
+        queue_length = len(self.queue)
+        await self.matchmaker.remove(user.id)
 
-        return user.id, len(self.queue)
+        return user.id, queue_length
+
+    def clear(self: Self) -> None:
+        """Removes every player from the queue."""
+        for user in self.queue:
+            record_queue_event("leave", user.id)
+        self.queue.clear()
+        self.joined_at.clear()
+        self.matchmaker.clear()
+
+    async def add_to_matchmaker(self: Self, user: Member, restoring: bool = False) -> None:
+        """Reads a player's ratings and adds them to the matchmaker, which searches the games they make possible.
+
+        Unless `restoring`, the join is then recorded in the queue trace, with the roles and ratings the matchmaker was
+        given.
+        """
+        db_session = DBGlobalSession().new_session()
+        try:
+            await ensure_players_in_db([user.id], db_session)
+            mus, sigmas = await load_rating_arrays([user.id], db_session)
+        finally:
+            await db_session.close()
+        costs = get_role_costs(user)
+        mus, sigmas = mus[0].tolist(), sigmas[0].tolist()
+        await self.matchmaker.add(user.id, costs, mus, sigmas, search=not restoring)
+        if not restoring:
+            record_queue_event("join", user.id, costs=costs, mus=mus, sigmas=sigmas)
+
+    def restart_waits(self: Self, user_ids: Sequence[int]) -> None:
+        """Counts the wait of players coming back from a game from now, if they are still in the queue."""
+        now = time.time()
+        for user_id in user_ids:
+            if user_id in self.joined_at:
+                self.joined_at[user_id] = now
+
+    def waits(self: Self, user_ids: Sequence[int]) -> List[float]:
+        """Returns how many seconds each player has waited since they joined or came back from a game."""
+        now = time.time()
+        return [now - self.joined_at.get(user_id, now) for user_id in user_ids]
 
 
-def populate_queue(guild: Guild) -> int:
+async def populate_queue(guild: Guild) -> int:
     """Populates the queue with all players who have the Queued Role."""
     if guild is None:
         raise NoGuildException
     queued_role = guild.get_role(QUEUED_ID)
+    # The players are searched once they are all in, rather than once for every player added.
     for member in guild.members:
         if queued_role in member.roles:
             try:
-                Queue().add(member)
+                await Queue(guild.id).add(member, restoring=True)
             except AlreadyInQueueException:
                 pass
             except NoMainRoleException:
                 continue
-    len_queue = len(Queue().queue)
+    await Queue(guild.id).matchmaker.refresh()
+    len_queue = len(Queue(guild.id).queue)
     logger.info(f"Queue initialized with {len_queue}")
     return len_queue
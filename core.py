@@ -3,9 +3,13 @@ import os
 from dotenv import load_dotenv
 import logging
 
-from commands.queue import populate_queue
+from discord import ApplicationContext
+
+from commands.queue import ensure_guild_configured, populate_queue
 from database.db import init_db
+from database.models.player_data import RatingStore
 from util.env_load import GENERAL_CHANNEL_ID
+from util.exceptions import GuildNotConfiguredException
 
 logger = logging.getLogger(__name__)
 
@@ -25,7 +29,14 @@ async def on_ready() -> None:
     """
     logger.info(f"{bot.user} has connected to Discord!")
     for guild in bot.guilds:
-        queue_length = populate_queue(guild)
+        try:
+            ensure_guild_configured(guild.id)
+        except GuildNotConfiguredException:
+            logger.warning(
+                f"Not serving guild [{guild.id}]:{guild.name}, as the role and channel ids are set up for GUILD_ID"
+            )
+            continue
+        queue_length = await populate_queue(guild)
         try:
             general = guild.get_channel(GENERAL_CHANNEL_ID)
             embed = discord.Embed(
@@ -39,11 +50,36 @@ async def on_ready() -> None:
             continue
 
 
+@bot.check
+async def guild_is_configured(ctx: ApplicationContext) -> bool:
+    """Only lets commands run in guilds the role and channel ids are set up for."""
+    if ctx.guild is not None:
+        ensure_guild_configured(ctx.guild.id)
+    return True
+
+
+@bot.event
+async def on_application_command_error(ctx: ApplicationContext, error: discord.DiscordException) -> None:
+    """Tells the user a guild is not set up for the bot, and logs any other error that reaches here."""
+    if isinstance(error, GuildNotConfiguredException):
+        embed = discord.Embed(
+            title="Error",
+            color=discord.Colour.red(),
+            description="This server is not set up for the bot! The bot's role and channel ids are set up for another server.",  # noqa: E501
+        )
+        await ctx.respond(embed=embed, ephemeral=True)
+        return
+    logger.error(f"Ignoring exception in command {ctx.command}", exc_info=error)
+
+
 if __name__ == "__main__":
     logging.basicConfig(
         level=logging.INFO,
     )
-    init_db()
+    # The database has to be set up on the loop the bot runs on, which owns its connections.
+    bot.loop.run_until_complete(init_db())
+    # Replays any rating updates a crash left in the journal, and starts writing new ones to the database periodically.
+    bot.loop.run_until_complete(RatingStore().open())
     bot.load_extension("cogs.game_cog")
     bot.load_extension("cogs.queue_cog")
     bot.load_extension("cogs.player_info_cog")
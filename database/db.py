@@ -1,9 +1,8 @@
 """Initialize the database and handle corresponding logical setup."""
 
 from typing import Self, Type
-from sqlalchemy import Engine, create_engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
-from sqlalchemy.orm import scoped_session, sessionmaker
 import logging
 import os
 from dotenv import load_dotenv
@@ -12,7 +11,12 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-ENGINE: Engine = create_engine(f"sqlite:///{os.getenv('DB_PATH')}", echo=True)
+# Logging every statement is useful while developing, but floods the log during matchmaking.
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() == "true"
+
+# SQLite is driven through aiosqlite, which runs each connection's I/O on its own thread, so a slow disk never holds
+# up the event loop and other users' commands.
+ENGINE: AsyncEngine = create_async_engine(f"sqlite+aiosqlite:///{os.getenv('DB_PATH')}", echo=DB_ECHO)
 Base: DeclarativeMeta = declarative_base()
 
 
@@ -21,7 +25,7 @@ class DBGlobalSession:
 
     # Instantiate a singleton object
     __instance = None
-    _session_class: scoped_session = None
+    _session_class: async_sessionmaker[AsyncSession] = None
 
     def __new__(cls: Type["DBGlobalSession"]) -> "DBGlobalSession":
         """Handle creation of a new class instance.
@@ -37,22 +41,26 @@ class DBGlobalSession:
         """Initialize this class instance."""
         pass
 
-    def assign_session_class(self: Self, session_class: scoped_session) -> None:
+    def assign_session_class(self: Self, session_class: async_sessionmaker[AsyncSession]) -> None:
         """Assign the session class to the singleton object."""
         self._session_class = session_class
 
-    def new_session(self: Self) -> scoped_session:
-        """Create a new session."""
+    def new_session(self: Self) -> AsyncSession:
+        """Create a new session, which must be awaited on and closed with `await session.close()`."""
         return self._session_class()
 
 
-def init_db() -> None:
-    """Initialize the database."""
+async def init_db() -> None:
+    """Initialize the database.
+
+    Must be awaited on the event loop the bot runs on, since the engine's connections belong to it.
+    """
     logger.info("Initializing database...")
-    Base.metadata.create_all(ENGINE)
+    async with ENGINE.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
     logger.info("Creating session...")
-    Session = sessionmaker(bind=ENGINE)
-    session = scoped_session(Session)
+    # Objects stay readable after a commit, since reloading their attributes would need to await.
+    session = async_sessionmaker(ENGINE, expire_on_commit=False)
 
     # Assign the session to the singleton object
     logger.info("Assigning session to the singleton object...")
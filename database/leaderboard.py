@@ -0,0 +1,75 @@
+"""Keeps players ranked by their conservative rating on a role, for the leaderboard and rank lookups."""
+
+import bisect
+from typing import Dict, Iterable, List, Optional, Self, Tuple
+
+# How many standard deviations are taken off a player's mu to rank them, so players with few games rank low.
+CONSERVATIVE_SIGMAS = 3
+
+
+def conservative_rating(mu: float, sigma: float) -> float:
+    """Returns the rating a player is almost certainly better than, which is what they are ranked by."""
+    return mu - CONSERVATIVE_SIGMAS * sigma
+
+
+class Leaderboard:
+    """Players ranked by conservative rating on one role, best first.
+
+    Players are kept in a list sorted by negated conservative rating, then user id, so finding a player's rank or the
+    start of a page is a binary search. Moving a player after a game shifts only the entries between their old and
+    new places, which stays far cheaper than sorting every player again.
+    """
+
+    def __init__(self: Self) -> None:
+        """Init that starts with no ranked players."""
+        self.entries: List[Tuple[float, int]] = []
+        self.ratings: Dict[int, float] = {}
+
+    def __len__(self: Self) -> int:
+        """Override len to return the number of ranked players."""
+        return len(self.entries)
+
+    def __contains__(self: Self, user_id: int) -> bool:
+        """Override contains to check whether a player is ranked."""
+        return user_id in self.ratings
+
+    def _remove(self: Self, user_id: int) -> None:
+        """Takes a player out of the ranking, if they are in it."""
+        rating = self.ratings.pop(user_id, None)
+        if rating is not None:
+            del self.entries[bisect.bisect_left(self.entries, (-rating, user_id))]
+
+    def set(self: Self, user_id: int, rating: float) -> None:
+        """Ranks a player by a new conservative rating, moving them if they were already ranked."""
+        self._remove(user_id)
+        self.ratings[user_id] = rating
+        bisect.insort(self.entries, (-rating, user_id))
+
+    def set_many(self: Self, ratings: Iterable[Tuple[int, float]]) -> None:
+        """Ranks many players at once, sorting the new entries into the ranking in one pass.
+
+        A player given more than once is ranked by their last rating.
+        """
+        new_entries = []
+        # A player's earlier rating in the batch is not in the entries yet, so there would be nothing to remove.
+        for user_id, rating in dict(ratings).items():
+            self._remove(user_id)
+            self.ratings[user_id] = rating
+            new_entries.append((-rating, user_id))
+        if new_entries:
+            # The existing entries are one sorted run, so sorting only has to order and merge the new ones.
+            self.entries.extend(new_entries)
+            self.entries.sort()
+
+    def rank(self: Self, user_id: int) -> Optional[int]:
+        """Returns a player's rank, starting from 1, where players with equal ratings share a rank."""
+        rating = self.ratings.get(user_id)
+        if rating is None:
+            return None
+        return bisect.bisect_left(self.entries, (-rating,)) + 1
+
+    def page(self: Self, start: int, count: int) -> List[Tuple[int, float]]:
+        """Returns the user ids and conservative ratings of `count` players from the 0-based position `start`."""
+        # A negative start would count from the end of the ranking.
+        start = max(start, 0)
+        return [(user_id, -rating) for rating, user_id in self.entries[start : start + count]]
@@ -0,0 +1,85 @@
+from typing import Any, Dict, Iterable, List, Tuple, TYPE_CHECKING
+from sqlalchemy import Float, Column, ForeignKey, Index, Integer, String, insert, select
+import logging
+from dotenv import load_dotenv
+
+from database.db import Base
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# A finished game as `end_game` reports it, in the plain form it is journaled in until it is written.
+MatchRecord = Dict[str, Any]
+
+
+class Match(Base):
+    """Database model class to represent a finished game. Rows are only ever added."""
+
+    __tablename__ = "matches"
+
+    # The sequence number the game was journaled under, so replaying the journal can never add it twice.
+    id = Column(Integer, primary_key=True, nullable=False)
+    guild_id = Column(Integer, nullable=False)
+    ended_at = Column(Float, nullable=False, index=True)
+    map = Column(String, nullable=True)
+    first_pick = Column(Integer, nullable=True)
+    winner = Column(Integer, nullable=False)
+    quality = Column(Float, nullable=True)
+
+
+class MatchPlayer(Base):
+    """Database model class to represent one player's part in a finished game, with their rating around it."""
+
+    __tablename__ = "match_players"
+    # A player's history is read newest first straight from this index, however many games are stored.
+    __table_args__ = (Index("ix_match_players_user_id_ended_at", "user_id", "ended_at"),)
+
+    match_id = Column(Integer, ForeignKey("matches.id"), primary_key=True, nullable=False)
+    user_id = Column(Integer, primary_key=True, nullable=False)
+    # Copied from the match, so a player's history needs no join to be sorted by time.
+    ended_at = Column(Float, nullable=False)
+    team = Column(Integer, nullable=False)
+    # The slot the player filled, where "assassin2" is the second assassin.
+    role = Column(String, nullable=False)
+    mu_before = Column(Float, nullable=False)
+    sigma_before = Column(Float, nullable=False)
+    mu_after = Column(Float, nullable=False)
+    sigma_after = Column(Float, nullable=False)
+
+
+async def insert_matches(matches: Iterable[Tuple[int, MatchRecord]], db_session: "AsyncSession") -> None:
+    """Adds finished games and their players to the match history, keyed by their sequence numbers.
+
+    Takes one batched INSERT per table, and commits nothing, so the games go in the same transaction as the rating
+    updates they came with.
+    """
+    match_rows = []
+    player_rows = []
+    for match_id, match in matches:
+        match_rows.append({"id": match_id, **{key: value for key, value in match.items() if key != "players"}})
+        player_rows.extend(
+            {"match_id": match_id, "ended_at": match["ended_at"], **player} for player in match["players"]
+        )
+    if match_rows:
+        await db_session.execute(insert(Match), match_rows)
+        await db_session.execute(insert(MatchPlayer), player_rows)
+
+
+async def find_recent_matches(user_id: int, limit: int, db_session: "AsyncSession") -> List[Tuple[MatchPlayer, Match]]:
+    """Returns a player's `limit` most recent games, newest first, as their part in each game along with the game.
+
+    Only reads the player's rows of `ix_match_players_user_id_ended_at`. Games reported since the `RatingStore` last
+    flushed are not in the database yet, so they are left out.
+    """
+    result = await db_session.execute(
+        select(MatchPlayer, Match)
+        .join(Match, Match.id == MatchPlayer.match_id)
+        .where(MatchPlayer.user_id == user_id)
+        .order_by(MatchPlayer.ended_at.desc())
+        .limit(limit)
+    )
+    return [(match_player, match) for match_player, match in result]
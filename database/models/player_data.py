@@ -1,18 +1,67 @@
-from typing import Dict, Self, TYPE_CHECKING
+from typing import Dict, Iterable, List, Optional, Self, Sequence, Tuple, Type, TYPE_CHECKING
+import numpy as np
 import trueskill
-from sqlalchemy import Float, Column, Integer
+from sqlalchemy import Float, Column, Integer, bindparam, case, select, update
+from sqlalchemy.dialects.sqlite import insert
+import asyncio
+import json
 import logging
+import os
 from dotenv import load_dotenv
 
 from database.db import Base, DBGlobalSession
+from database.leaderboard import Leaderboard, conservative_rating
+from database.models.match import MatchRecord, insert_matches
+from util.env_load import RATING_FLUSH_SECONDS, RATING_JOURNAL_PATH
 
 if TYPE_CHECKING:
-    from sqlalchemy.orm import scoped_session
+    from sqlalchemy import Row, Update
+    from sqlalchemy.ext.asyncio import AsyncSession
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+RATED_ROLES = ["tank", "support", "assassin", "offlane"]
+
+# Bumped whenever ratings are written, so anything worked out from older ratings can tell it is stale.
+_ratings_version = 0
+
+
+def get_rated_role(role: str) -> str:
+    """Returns the role a player's rating is kept under, where the second assassin slot shares the assassin rating."""
+    role = str(role)
+    return "assassin" if role == "assassin2" else role
+
+
+def get_ratings_version() -> int:
+    """Returns the current ratings version."""
+    return _ratings_version
+
+
+def bump_ratings_version() -> int:
+    """Marks every rating read so far as stale, and returns the new ratings version."""
+    global _ratings_version
+    _ratings_version += 1
+    return _ratings_version
+
+
+def build_stats(games_played: Sequence[int], games_won: Sequence[int]) -> Dict[str, int | str]:
+    """Return a representation of a player's stats, from their games played and won on each of `RATED_ROLES`."""
+    return_dict = {}
+    for role, role_games_played, role_games_won in zip(RATED_ROLES, games_played, games_won):
+        role_games_played, role_games_won = int(role_games_played), int(role_games_won)
+        if role_games_played != 0:
+            win_rate = role_games_won / role_games_played * 100
+        else:
+            win_rate = 0
+        return_dict[role] = {
+            "games_played": role_games_played,
+            "games_won": role_games_won,
+            "win_rate": str(win_rate) + "%",
+        }
+    return return_dict
+
 
 class PlayerData(Base):
     """Database model class to represent a player's statistics."""
@@ -43,31 +92,435 @@ class PlayerData(Base):
 
     def get_stats(self: Self) -> Dict[str, int | str]:
         """Return a representation of the player's stats."""
-        return_dict = {}
-        for role in ["tank", "support", "assassin", "offlane"]:
-            games_played = getattr(self, f"{role}_games_played")
-            games_won = getattr(self, f"{role}_games_won")
-            if games_played != 0:
-                win_rate = games_won / games_played * 100
+        return build_stats(
+            [getattr(self, f"{role}_games_played") for role in RATED_ROLES],
+            [getattr(self, f"{role}_games_won") for role in RATED_ROLES],
+        )
+
+
+class RatingJournalState(Base):
+    """Database model class to record the last journaled rating update written to the players table."""
+
+    __tablename__ = "rating_journal"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    last_sequence = Column(Integer, nullable=False, default=0)
+
+
+class RatingSnapshot:
+    """Ratings for a group of players, read from the database once and keyed by user id and role."""
+
+    def __init__(self: Self, ratings: Dict[Tuple[int, str], trueskill.Rating]) -> None:
+        """Init that takes in the ratings keyed by (user id, role)."""
+        self.ratings = ratings
+
+    def __contains__(self: Self, user_id: int) -> bool:
+        """Checks whether a player's ratings are in the snapshot."""
+        return (user_id, RATED_ROLES[0]) in self.ratings
+
+    def get(self: Self, user_id: int, role: str) -> trueskill.Rating:
+        """Returns a player's rating on a role, where the second assassin slot shares the assassin rating."""
+        return self.ratings[(user_id, get_rated_role(role))]
+
+
+async def ensure_players_in_db(user_ids: Iterable[int], db_session: "AsyncSession") -> None:
+    """Creates a database entry for every player that does not have one yet.
+
+    The players already in the database are found with a single query, and the rest are inserted in a single batch
+    that skips any player another command created in the meantime.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    existing_ids = set(await db_session.scalars(select(PlayerData.user_id).filter(PlayerData.user_id.in_(user_ids))))
+    missing_ids = [user_id for user_id in user_ids if user_id not in existing_ids]
+    if missing_ids:
+        # Create a database entry for these players
+        logger.warning(f"Players {missing_ids} not found in database, creating entries...")
+        await db_session.execute(
+            insert(PlayerData).on_conflict_do_nothing(index_elements=[PlayerData.user_id]),
+            [{"user_id": user_id} for user_id in missing_ids],
+        )
+    await db_session.commit()
+
+
+# A player's id, the role they played, their new rating on it, and whether they won.
+RatingUpdate = Tuple[int, str, trueskill.Rating, bool]
+
+
+def _build_rating_update() -> "Update":
+    """Builds the UPDATE that writes one player's new rating and counts their game, for any role.
+
+    The role is a parameter, so one statement covers all four roles and can be run for a batch of players at once.
+    Games played and won are incremented in SQL rather than written back.
+    """
+    columns = PlayerData.__table__.c
+    role = bindparam("update_role")
+    values = {}
+    for rated_role in RATED_ROLES:
+        on_role = role == rated_role
+        values[f"{rated_role}_mu"] = case((on_role, bindparam("update_mu")), else_=columns[f"{rated_role}_mu"])
+        values[f"{rated_role}_sigma"] = case((on_role, bindparam("update_sigma")), else_=columns[f"{rated_role}_sigma"])
+        values[f"{rated_role}_games_played"] = columns[f"{rated_role}_games_played"] + case((on_role, 1), else_=0)
+        values[f"{rated_role}_games_won"] = columns[f"{rated_role}_games_won"] + case(
+            (on_role, bindparam("update_won")), else_=0
+        )
+    return update(PlayerData.__table__).where(columns.user_id == bindparam("update_user_id")).values(values)
+
+
+_RATING_UPDATE = _build_rating_update()
+
+
+async def update_player_ratings(updates: Iterable[RatingUpdate], db_session: "AsyncSession") -> None:
+    """Writes the new ratings of a batch of players and counts the game they played, in a single executemany.
+
+    Nothing is committed, so the caller decides what else goes in the same transaction. Since games played and won
+    are incremented by the database, games ending at the same time can not overwrite each other's counts.
+    """
+    rows: List[Dict[str, int | str | float]] = [
+        {
+            "update_user_id": user_id,
+            "update_role": get_rated_role(role),
+            "update_mu": rating.mu,
+            "update_sigma": rating.sigma,
+            "update_won": int(won),
+        }
+        for user_id, role, rating, won in updates
+    ]
+    if rows:
+        await db_session.execute(_RATING_UPDATE, rows)
+
+
+# A reported game's rating updates, and the game itself for the match history when it was played in full.
+GameReport = Tuple[List[RatingUpdate], Optional[MatchRecord]]
+
+
+def _append_to_journal(entries: List[Tuple[int, GameReport]]) -> None:
+    """Appends reported games to the journal as JSON lines, and waits for them to reach the disk."""
+    with open(RATING_JOURNAL_PATH, "a") as journal_file:
+        for sequence, (updates, match) in entries:
+            journal_file.write(
+                json.dumps(
+                    {
+                        "sequence": sequence,
+                        "updates": [
+                            {"user_id": user_id, "role": role, "mu": rating.mu, "sigma": rating.sigma, "won": won}
+                            for user_id, role, rating, won in updates
+                        ],
+                        "match": match,
+                    }
+                )
+                + "\n"
+            )
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+
+def _read_journal() -> List[Tuple[int, GameReport]]:
+    """Reads every reported game in the journal, in the order they were reported."""
+    if not os.path.exists(RATING_JOURNAL_PATH):
+        return []
+    entries = []
+    with open(RATING_JOURNAL_PATH) as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Only the last line can be cut short by a crash, and its game was never reported as ended.
+                logger.warning(f"Skipping a partly written line in the rating journal: {line!r}")
+                continue
+            # Journals written before games were recorded have a line per rating update.
+            updates = entry["updates"] if "updates" in entry else [entry]
+            entries.append(
+                (
+                    entry["sequence"],
+                    (
+                        [
+                            (
+                                update["user_id"],
+                                update["role"],
+                                trueskill.Rating(update["mu"], update["sigma"]),
+                                update["won"],
+                            )
+                            for update in updates
+                        ],
+                        entry.get("match"),
+                    ),
+                )
+            )
+    return entries
+
+
+def _clear_journal() -> None:
+    """Empties the journal once every update in it is in the database."""
+    with open(RATING_JOURNAL_PATH, "w") as journal_file:
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+
+class RatingStore:
+    """Defines a singleton that mirrors the players table in memory, as NumPy arrays with a row per player.
+
+    Mus and sigmas are float64 and games played and won are int32, each with a column per role in `RATED_ROLES`
+    order, so matchmaking and rankings read them without building ORM objects. The whole table is read once on
+    startup, and players created since are read the first time they are needed. Every player who has played a role
+    is also ranked on that role's `Leaderboard`, which is kept up to date as games are reported.
+
+    A reported game's new ratings are appended to the journal at `RATING_JOURNAL_PATH` along with the game itself,
+    then applied to the arrays. Every `RATING_FLUSH_SECONDS`, and on shutdown, the games still pending are written to
+    the database in one transaction, ratings and match history together, which also records the sequence number of
+    the last one, so after a crash the journal is replayed from where the database left off. Without a journal, games
+    are written right away.
+    """
+
+    # Rows the arrays start with, doubled whenever they fill up.
+    INITIAL_CAPACITY = 1024
+
+    # Instantiate a singleton object
+    __instance = None
+
+    def __new__(cls: Type["RatingStore"]) -> "RatingStore":
+        """Returns the store, creating it the first time it is needed."""
+        if cls.__instance is None:
+            cls.__instance = super(RatingStore, cls).__new__(cls)
+            cls.__instance.initialized = False
+        return cls.__instance
+
+    def __init__(self: Self) -> None:
+        """Initialize the store the first time it is created."""
+        if self.initialized:
+            return
+        self.initialized = True
+        # Each player's row in the arrays, of which the first `size` are in use.
+        self.index: Dict[int, int] = {}
+        self.size = 0
+        self.user_ids = np.zeros(self.INITIAL_CAPACITY, dtype=np.int64)
+        self.mus = np.zeros((self.INITIAL_CAPACITY, len(RATED_ROLES)), dtype=np.float64)
+        self.sigmas = np.zeros((self.INITIAL_CAPACITY, len(RATED_ROLES)), dtype=np.float64)
+        self.games_played = np.zeros((self.INITIAL_CAPACITY, len(RATED_ROLES)), dtype=np.int32)
+        self.games_won = np.zeros((self.INITIAL_CAPACITY, len(RATED_ROLES)), dtype=np.int32)
+        self.leaderboards: Dict[str, Leaderboard] = {role: Leaderboard() for role in RATED_ROLES}
+        # Games applied to the arrays but not yet written to the database, with their sequence numbers.
+        self.pending: List[Tuple[int, GameReport]] = []
+        self.sequence = 0
+        # Keeps the journal, the pending updates and the database in the same order.
+        self.lock = asyncio.Lock()
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def open(self: Self) -> None:
+        """Replays the journal, reads every player into the arrays, and starts writing new updates periodically.
+
+        Must be awaited on the event loop the bot runs on.
+        """
+        await self.replay_journal()
+
+        db_session: AsyncSession = DBGlobalSession().new_session()
+        try:
+            rows = (await db_session.execute(select(PlayerData.__table__))).all()
+        finally:
+            await db_session.close()
+        self.add_rows(rows)
+        logger.info(f"Loaded the ratings of {self.size} players.")
+
+        self.flush_task = asyncio.create_task(self.flush_periodically())
+
+    async def replay_journal(self: Self) -> None:
+        """Writes any games a crash left in the journal to the database, and empties it."""
+        db_session: AsyncSession = DBGlobalSession().new_session()
+        try:
+            last_sequence = await db_session.scalar(select(RatingJournalState.last_sequence)) or 0
+        finally:
+            await db_session.close()
+
+        entries = await asyncio.to_thread(_read_journal) if RATING_JOURNAL_PATH is not None else []
+        self.sequence = max([last_sequence, *(sequence for sequence, _ in entries)])
+        async with self.lock:
+            self.pending = [entry for entry in entries if entry[0] > last_sequence]
+        if self.pending:
+            logger.warning(f"Replaying {len(self.pending)} reported games from the journal...")
+            await self.flush()
+        elif entries:
+            await asyncio.to_thread(_clear_journal)
+
+    def add_rows(self: Self, rows: Sequence["Row"]) -> None:
+        """Appends players read from the players table to the arrays, skipping any already in them."""
+        new_rows = {row.user_id: row for row in rows if row.user_id not in self.index}
+        if not new_rows:
+            return
+        end = self.size + len(new_rows)
+        if end > len(self.user_ids):
+            capacity = max(end, 2 * len(self.user_ids))
+            for name in ("user_ids", "mus", "sigmas", "games_played", "games_won"):
+                array = getattr(self, name)
+                grown = np.zeros((capacity, *array.shape[1:]), dtype=array.dtype)
+                grown[: self.size] = array[: self.size]
+                setattr(self, name, grown)
+
+        added = slice(self.size, end)
+        new_rows = list(new_rows.values())
+        self.user_ids[added] = [row.user_id for row in new_rows]
+        self.mus[added] = [[getattr(row, f"{role}_mu") for role in RATED_ROLES] for row in new_rows]
+        self.sigmas[added] = [[getattr(row, f"{role}_sigma") for role in RATED_ROLES] for row in new_rows]
+        self.games_played[added] = [[getattr(row, f"{role}_games_played") for role in RATED_ROLES] for row in new_rows]
+        self.games_won[added] = [[getattr(row, f"{role}_games_won") for role in RATED_ROLES] for row in new_rows]
+        for offset, row in enumerate(new_rows):
+            self.index[row.user_id] = self.size + offset
+        self.size = end
+
+        ratings = conservative_rating(self.mus[added], self.sigmas[added])
+        for column, role in enumerate(RATED_ROLES):
+            played = self.games_played[added, column] > 0
+            self.leaderboards[role].set_many(
+                zip(self.user_ids[added][played].tolist(), ratings[played, column].tolist())
+            )
+
+    async def load(self: Self, user_ids: Iterable[int], db_session: "AsyncSession") -> Dict[int, int]:
+        """Returns the row of every player with a database entry, reading the ones not in the arrays in one query."""
+        user_ids = list(dict.fromkeys(user_ids))
+        missing_ids = [user_id for user_id in user_ids if user_id not in self.index]
+        if missing_ids:
+            rows = (
+                await db_session.execute(select(PlayerData.__table__).filter(PlayerData.user_id.in_(missing_ids)))
+            ).all()
+            # Another command may have read the players in the meantime, and a game may have updated them since.
+            self.add_rows(rows)
+        return {user_id: self.index[user_id] for user_id in user_ids if user_id in self.index}
+
+    def get_stats(self: Self, user_id: int) -> Dict[str, int | str]:
+        """Return a representation of a player's stats and their rank on each role, who must have been loaded."""
+        row = self.index[user_id]
+        stats = build_stats(self.games_played[row], self.games_won[row])
+        for role in RATED_ROLES:
+            leaderboard = self.leaderboards[role]
+            rank = leaderboard.rank(user_id)
+            stats[role]["rank"] = f"#{rank} of {len(leaderboard)}" if rank is not None else "Unranked"
+        return stats
+
+    def apply(self: Self, rating_update: RatingUpdate) -> None:
+        """Applies a player's new rating and counts their game in the arrays, if the player has been read."""
+        user_id, role, rating, won = rating_update
+        row = self.index.get(user_id)
+        if row is None:
+            return
+        column = RATED_ROLES.index(get_rated_role(role))
+        self.mus[row, column] = rating.mu
+        self.sigmas[row, column] = rating.sigma
+        self.games_played[row, column] += 1
+        if won:
+            self.games_won[row, column] += 1
+        self.leaderboards[get_rated_role(role)].set(user_id, conservative_rating(rating.mu, rating.sigma))
+
+    async def record(self: Self, updates: Iterable[RatingUpdate], match: Optional[MatchRecord] = None) -> None:
+        """Journals a reported game's rating updates and the game itself, then applies the updates to the arrays.
+
+        The game is written to the database right away when there is no journal to keep it safe until then, and only
+        applied once it is written, so a report that fails leaves nothing behind and can be retried.
+        """
+        async with self.lock:
+            self.sequence += 1
+            entry = (self.sequence, (list(updates), match))
+            if RATING_JOURNAL_PATH is None:
+                await self._write([entry])
             else:
-                win_rate = 0
-            return_dict[role] = {
-                "games_played": games_played,
-                "games_won": games_won,
-                "win_rate": str(win_rate) + "%",
-            }
-        return return_dict
+                await asyncio.to_thread(_append_to_journal, [entry])
+                self.pending.append(entry)
+            for rating_update in entry[1][0]:
+                self.apply(rating_update)
+
+    async def flush(self: Self) -> None:
+        """Writes every pending game to the database in one transaction, and empties the journal after."""
+        async with self.lock:
+            if not self.pending:
+                return
+            await self._write(self.pending)
+            self.pending.clear()
+            if RATING_JOURNAL_PATH is not None:
+                await asyncio.to_thread(_clear_journal)
+
+    async def _write(self: Self, entries: List[Tuple[int, GameReport]]) -> None:
+        """Writes reported games to the database in one transaction, ratings and match history together."""
+        db_session: AsyncSession = DBGlobalSession().new_session()
+        try:
+            await update_player_ratings(
+                [rating_update for _, (updates, _) in entries for rating_update in updates], db_session
+            )
+            await insert_matches(
+                [(sequence, match) for sequence, (_, match) in entries if match is not None], db_session
+            )
+            await db_session.merge(RatingJournalState(id=0, last_sequence=entries[-1][0]))
+            await db_session.commit()
+        finally:
+            await db_session.close()
+        logger.info(f"Wrote {len(entries)} reported games to the database.")
+
+    async def flush_periodically(self: Self) -> None:
+        """Flushes every `RATING_FLUSH_SECONDS`, and one last time when cancelled as the bot shuts down.
+
+        A flush that fails is logged and retried on the next interval, whatever went wrong.
+        """
+        try:
+            while True:
+                await asyncio.sleep(RATING_FLUSH_SECONDS)
+                try:
+                    await self.flush()
+                except Exception:
+                    logger.exception("Could not write reported games to the database, will retry.")
+        finally:
+            await self.flush()
+
 
+async def load_rating_snapshot(user_ids: Iterable[int], db_session: Optional["AsyncSession"] = None) -> RatingSnapshot:
+    """Reads every role's rating for a group of players through the `RatingStore`, reading any not in it at once."""
+    created_session = False
+    if db_session is None:
+        db_session = DBGlobalSession().new_session()
+        created_session = True
 
-def find_player_stats(user_id: int) -> Dict[str, int | str]:
+    store = RatingStore()
+    try:
+        rows = await store.load(user_ids, db_session)
+    finally:
+        if created_session:
+            await db_session.close()
+
+    return RatingSnapshot(
+        {
+            (user_id, role): trueskill.Rating(float(store.mus[row, column]), float(store.sigmas[row, column]))
+            for user_id, row in rows.items()
+            for column, role in enumerate(RATED_ROLES)
+        }
+    )
+
+
+async def load_rating_arrays(
+    user_ids: Sequence[int], db_session: Optional["AsyncSession"] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Reads the mus and sigmas of a group of players through the `RatingStore`, reading any not in it at once.
+
+    Returns arrays with a row per player, in the order given, and a column per role in `RATED_ROLES` order. Every
+    player must have a database entry.
+    """
+    created_session = False
+    if db_session is None:
+        db_session = DBGlobalSession().new_session()
+        created_session = True
+
+    store = RatingStore()
+    try:
+        rows = await store.load(user_ids, db_session)
+    finally:
+        if created_session:
+            await db_session.close()
+
+    indices = [rows[user_id] for user_id in user_ids]
+    return store.mus[indices], store.sigmas[indices]
+
+
+async def find_player_stats(user_id: int) -> Dict[str, int | str]:
     """Find a player's stats in the database."""
-    db_session: scoped_session = DBGlobalSession().new_session()
-    search_attempt = db_session.query(PlayerData).filter_by(user_id=user_id).first()
-    if search_attempt is None:
-        logger.info(f"Creating new player entry for {user_id}")
-        new_player = PlayerData(user_id=user_id)
-        db_session.add(new_player)
-        db_session.commit()
-        search_attempt = new_player
-
-    return search_attempt.get_stats()
+    db_session: AsyncSession = DBGlobalSession().new_session()
+    try:
+        await ensure_players_in_db([user_id], db_session)
+        await RatingStore().load([user_id], db_session)
+    finally:
+        await db_session.close()
+
+    return RatingStore().get_stats(user_id)
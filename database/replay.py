@@ -0,0 +1,220 @@
+"""Recomputes every player's ratings from the match history, for when the TrueSkill parameters change.
+
+Run from the repository root, with the bot stopped, with `python -m database.replay`. Any games left in the rating
+journal are written first. Matches are then streamed in the order they ended and rated in memory, starting every
+player from the default rating, and the final ratings and games played and won of every player are written in a
+single transaction. Pass `--dry-run` to only see how long the replay takes and how many players it would change.
+
+Games reported before the match history was recorded can not be replayed, so the replay stops without writing
+anything when it would leave a player with fewer games than they have now, unless `--force` is passed.
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import time
+from typing import Any, Dict, List, Optional, Self, Tuple, TYPE_CHECKING
+
+import trueskill
+from sqlalchemy import bindparam, select, update
+
+from database.db import DBGlobalSession, init_db
+from database.models.match import Match, MatchPlayer
+from database.models.player_data import RATED_ROLES, PlayerData, RatingStore, get_rated_role
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+# Match players fetched from the database at a time while streaming the history.
+STREAM_BATCH_SIZE = 10000
+
+# A player's mu and sigma on one role.
+RoleRating = Tuple[float, float]
+
+
+def rate_match(
+    winners: List[RoleRating], losers: List[RoleRating], env: trueskill.TrueSkill
+) -> Tuple[List[RoleRating], List[RoleRating]]:
+    """Rates a game between two teams in closed form, giving the same ratings as `env.rate`, many times faster.
+
+    With only two teams the TrueSkill factor graph has a single truncated team difference, so one pass of its
+    message schedule is exact.
+    """
+    players = winners + losers
+    tau_squared = env.tau**2
+    c = math.sqrt(sum(sigma**2 + tau_squared for _, sigma in players) + len(players) * env.beta**2)
+    draw_margin = trueskill.calc_draw_margin(env.draw_probability, len(players), env) / c
+    difference = (sum(mu for mu, _ in winners) - sum(mu for mu, _ in losers)) / c
+    v = env.v_win(difference, draw_margin)
+    w = env.w_win(difference, draw_margin)
+
+    def update_team(team: List[RoleRating], sign: int) -> List[RoleRating]:
+        rated = []
+        for mu, sigma in team:
+            variance = sigma**2 + tau_squared
+            rated.append((mu + sign * variance / c * v, math.sqrt(variance * (1 - variance / c**2 * w))))
+        return rated
+
+    return update_team(winners, 1), update_team(losers, -1)
+
+
+class RatingReplay:
+    """Every player's ratings and games played and won on each role, as the replay has rated them so far."""
+
+    def __init__(self: Self, env: trueskill.TrueSkill) -> None:
+        """Init that takes in the TrueSkill environment to rate games with."""
+        self.env = env
+        self.ratings: Dict[Tuple[int, str], RoleRating] = {}
+        self.games_played: Dict[Tuple[int, str], int] = {}
+        self.games_won: Dict[Tuple[int, str], int] = {}
+        self.matches = 0
+
+    def rate(self: Self, players: List[Tuple[int, int, str]], winner: int) -> None:
+        """Rates one match from its players' user ids, teams and role slots, and counts their games."""
+        default = (self.env.mu, self.env.sigma)
+        # The second assassin slot shares the assassin rating, as it does when the game is reported.
+        keys = {
+            team: [(user_id, get_rated_role(role)) for user_id, player_team, role in players if player_team == team]
+            for team in (1, 2)
+        }
+        winners, losers = keys[winner], keys[3 - winner]
+        rated_winners, rated_losers = rate_match(
+            [self.ratings.get(key, default) for key in winners],
+            [self.ratings.get(key, default) for key in losers],
+            self.env,
+        )
+        for key, rating in zip(winners + losers, rated_winners + rated_losers):
+            self.ratings[key] = rating
+            self.games_played[key] = self.games_played.get(key, 0) + 1
+        for key in winners:
+            self.games_won[key] = self.games_won.get(key, 0) + 1
+        self.matches += 1
+
+    def row(self: Self, user_id: int) -> Dict[str, Any]:
+        """Returns the columns a player's database entry should hold after the replay."""
+        row = {"replay_user_id": user_id}
+        for role in RATED_ROLES:
+            mu, sigma = self.ratings.get((user_id, role), (self.env.mu, self.env.sigma))
+            row[f"replay_{role}_mu"] = mu
+            row[f"replay_{role}_sigma"] = sigma
+            row[f"replay_{role}_games_played"] = self.games_played.get((user_id, role), 0)
+            row[f"replay_{role}_games_won"] = self.games_won.get((user_id, role), 0)
+        return row
+
+
+async def replay_matches(env: trueskill.TrueSkill, db_session: "AsyncSession") -> RatingReplay:
+    """Streams every match in the order they ended, rating each one in memory."""
+    replay = RatingReplay(env)
+    result = await db_session.stream(
+        select(MatchPlayer.match_id, MatchPlayer.user_id, MatchPlayer.team, MatchPlayer.role, Match.winner)
+        .join(Match, Match.id == MatchPlayer.match_id)
+        .order_by(Match.ended_at, Match.id)
+        .execution_options(yield_per=STREAM_BATCH_SIZE)
+    )
+    match_id, winner, players = None, None, []
+    # Whole batches are taken at once, as handing over one row at a time costs more than rating it.
+    async for partition in result.partitions():
+        for row_match_id, user_id, team, role, row_winner in partition:
+            if row_match_id != match_id:
+                if players:
+                    replay.rate(players, winner)
+                match_id, winner, players = row_match_id, row_winner, []
+            players.append((user_id, team, role))
+    if players:
+        replay.rate(players, winner)
+    return replay
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Replays the match history with the TrueSkill parameters in `args`, and writes the ratings unless told not to."""
+    base_env = trueskill.global_env()
+    env = trueskill.TrueSkill(
+        mu=base_env.mu if args.mu is None else args.mu,
+        sigma=base_env.sigma if args.sigma is None else args.sigma,
+        beta=base_env.beta if args.beta is None else args.beta,
+        tau=base_env.tau if args.tau is None else args.tau,
+        draw_probability=base_env.draw_probability if args.draw_probability is None else args.draw_probability,
+    )
+
+    await init_db()
+    # Games still in the journal are not in the match history yet.
+    await RatingStore().replay_journal()
+
+    db_session = DBGlobalSession().new_session()
+    try:
+        start = time.perf_counter()
+        replay = await replay_matches(env, db_session)
+        replay_seconds = time.perf_counter() - start
+        logger.info(
+            f"Replayed {replay.matches} matches in {replay_seconds:.2f} seconds, "
+            f"{replay.matches / replay_seconds if replay_seconds else 0:.0f} matches per second"
+        )
+
+        players = (await db_session.execute(select(PlayerData.__table__))).all()
+        rows = [replay.row(player.user_id) for player in players]
+        # Players whose games were reported before the match history was recorded would lose them.
+        short = [
+            player.user_id
+            for player, row in zip(players, rows)
+            if any(row[f"replay_{role}_games_played"] < getattr(player, f"{role}_games_played") for role in RATED_ROLES)
+        ]
+        changed = sum(
+            1
+            for player, row in zip(players, rows)
+            if any(row[f"replay_{column.name}"] != getattr(player, column.name) for column in PlayerData.__table__.c)
+        )
+        logger.info(f"{changed} of {len(players)} players' ratings would change")
+
+        write_seconds = None
+        if short and not args.force:
+            logger.error(
+                f"{len(short)} players have games that are not in the match history, such as {short[:5]}. "
+                "Pass --force to replay anyway, resetting those games."
+            )
+        elif not args.dry_run:
+            start = time.perf_counter()
+            columns = PlayerData.__table__.c
+            await db_session.execute(
+                update(PlayerData.__table__)
+                .where(columns.user_id == bindparam("replay_user_id"))
+                .values(
+                    {column.name: bindparam(f"replay_{column.name}") for column in columns if column.name != "user_id"}
+                ),
+                rows,
+            )
+            await db_session.commit()
+            write_seconds = time.perf_counter() - start
+            logger.info(f"Wrote the ratings of {len(rows)} players in {write_seconds:.2f} seconds")
+    finally:
+        await db_session.close()
+
+    return {
+        "matches": replay.matches,
+        "replay_seconds": replay_seconds,
+        "matches_per_second": replay.matches / replay_seconds if replay_seconds else None,
+        "players": len(players),
+        "players_changed": changed,
+        "players_missing_games": len(short),
+        "write_seconds": write_seconds,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parses the replay's command line options, where any TrueSkill parameter not passed keeps its default."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mu", type=float, help="Mean of a new player's rating.")
+    parser.add_argument("--sigma", type=float, help="Standard deviation of a new player's rating.")
+    parser.add_argument("--beta", type=float, help="Skill difference that gives about a 76%% chance of winning.")
+    parser.add_argument("--tau", type=float, help="Dynamic factor added to every sigma before each game.")
+    parser.add_argument("--draw-probability", type=float, help="Chance of a game being drawn.")
+    parser.add_argument("--dry-run", action="store_true", help="Replay without writing the ratings.")
+    parser.add_argument("--force", action="store_true", help="Write even if players would lose games.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,26 @@
+"""Runs the tests against an in-memory database with placeholder ids, on one event loop shared by every test.
+
+Ratings are written straight to the database and no queue trace is recorded, whatever a local `.env` sets.
+"""
+
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Iterator
+
+import pytest
+
+import benchmarks  # noqa: F401 - points the bot at an in-memory database before any of it is imported
+
+os.environ["RATING_JOURNAL_PATH"] = ""
+os.environ["QUEUE_TRACE_PATH"] = ""
+
+
+@pytest.fixture(scope="session")
+def run() -> Iterator[Callable[[Awaitable[Any]], Any]]:
+    """Runs a coroutine to completion on the shared event loop, which the in-memory database belongs to."""
+    from database.db import init_db
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(init_db())
+    yield loop.run_until_complete
+    loop.close()
@@ -0,0 +1,83 @@
+"""Tests for starting and ending games."""
+
+import asyncio
+import random
+from types import SimpleNamespace
+from typing import Callable
+
+import pytest
+from sqlalchemy import func, select
+
+from benchmarks.fakes import FakeMember, FakeRole, make_members
+from commands import game
+from database.db import DBGlobalSession
+from database.models.match import Match
+from database.models.player_data import ensure_players_in_db
+from util.env_load import ADMIN_ID
+from util.exceptions import NoGameInProgressException
+
+
+def test_concurrent_reports_rate_a_game_once(run: Callable, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Two `/end` reports of the same game at once rate it and record it in the match history only once."""
+    monkeypatch.setattr(game, "Member", FakeMember)
+    guild_id = 9001
+    members = make_members(10, random.Random(guild_id), first_user_id=9001000)
+    roles = list(game.RoleEnum)
+    ended_game = game.GameRegistry(guild_id).get(1)
+    ended_game.assign_game(
+        {role: game.Player(member, role) for role, member in zip(roles, members[:5])},
+        {role: game.Player(member, role) for role, member in zip(roles, members[5:])},
+    )
+    admin = FakeMember(9001999, [FakeRole(ADMIN_ID, "Admin")])
+    ctx = SimpleNamespace(guild=SimpleNamespace(id=guild_id), user=admin)
+
+    async def report_twice() -> tuple:
+        db_session = DBGlobalSession().new_session()
+        try:
+            await ensure_players_in_db([member.id for member in members], db_session)
+            reports = await asyncio.gather(
+                game.end_game(ctx, "team 1"), game.end_game(ctx, "team 1"), return_exceptions=True
+            )
+            matches = await db_session.scalar(select(func.count()).select_from(Match).where(Match.guild_id == guild_id))
+        finally:
+            await db_session.close()
+        return reports, matches
+
+    reports, matches = run(report_twice())
+    assert sum(report is ended_game for report in reports) == 1
+    assert sum(isinstance(report, NoGameInProgressException) for report in reports) == 1
+    assert matches == 1
+    assert not ended_game.in_progress
+
+
+@pytest.mark.parametrize("end_first", [True, False])
+def test_cancel_racing_end_ends_a_game_once(run: Callable, monkeypatch: pytest.MonkeyPatch, end_first: bool) -> None:
+    """A game cancelled as it is reported is either rated or cancelled, and the other command finds it over."""
+    monkeypatch.setattr(game, "Member", FakeMember)
+    guild_id = 9002 if end_first else 9003
+    members = make_members(10, random.Random(guild_id), first_user_id=guild_id * 1000)
+    roles = list(game.RoleEnum)
+    raced_game = game.GameRegistry(guild_id).get(1)
+    raced_game.assign_game(
+        {role: game.Player(member, role) for role, member in zip(roles, members[:5])},
+        {role: game.Player(member, role) for role, member in zip(roles, members[5:])},
+    )
+    admin = FakeMember(guild_id * 1000 + 999, [FakeRole(ADMIN_ID, "Admin")])
+    ctx = SimpleNamespace(guild=SimpleNamespace(id=guild_id), user=admin)
+
+    async def end_and_cancel() -> tuple:
+        db_session = DBGlobalSession().new_session()
+        try:
+            await ensure_players_in_db([member.id for member in members], db_session)
+            commands = [game.end_game(ctx, "team 1"), game.cancel_game(ctx)]
+            reports = await asyncio.gather(*(commands if end_first else commands[::-1]), return_exceptions=True)
+            matches = await db_session.scalar(select(func.count()).select_from(Match).where(Match.guild_id == guild_id))
+        finally:
+            await db_session.close()
+        return reports, matches
+
+    reports, matches = run(end_and_cancel())
+    assert reports[0] is raced_game
+    assert isinstance(reports[1], NoGameInProgressException)
+    assert matches == (1 if end_first else 0)
+    assert not raced_game.in_progress
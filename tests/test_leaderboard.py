@@ -0,0 +1,71 @@
+"""Tests for the role leaderboards."""
+
+import random
+
+from database.leaderboard import Leaderboard
+
+
+def ranking(leaderboard: Leaderboard) -> list:
+    """Lists every ranked player's user id, rank and rating, best first."""
+    return [(user_id, leaderboard.rank(user_id), rating) for user_id, rating in leaderboard.page(0, len(leaderboard))]
+
+
+def test_equal_ratings_share_a_rank() -> None:
+    """Players with equal ratings share a rank, listed by user id, and the next player's rank counts them all."""
+    leaderboard = Leaderboard()
+    leaderboard.set_many([(3, 10.0), (1, 20.0), (2, 10.0), (4, 5.0), (5, 10.0)])
+    assert ranking(leaderboard) == [(1, 1, 20.0), (2, 2, 10.0), (3, 2, 10.0), (5, 2, 10.0), (4, 5, 5.0)]
+    assert leaderboard.rank(6) is None and 6 not in leaderboard
+
+
+def test_set_moves_an_existing_player() -> None:
+    """Setting a ranked player's rating, alone or in a batch, moves them rather than ranking them twice."""
+    leaderboard = Leaderboard()
+    leaderboard.set_many([(1, 30.0), (2, 20.0), (3, 10.0)])
+    leaderboard.set(3, 40.0)
+    assert ranking(leaderboard) == [(3, 1, 40.0), (1, 2, 30.0), (2, 3, 20.0)]
+    leaderboard.set_many([(1, 5.0), (4, 25.0), (4, 35.0)])
+    assert ranking(leaderboard) == [(3, 1, 40.0), (4, 2, 35.0), (2, 3, 20.0), (1, 4, 5.0)]
+
+
+def test_removed_players_are_unranked() -> None:
+    """A removed player is unranked and the players below them move up, and removing an unranked player does nothing."""
+    leaderboard = Leaderboard()
+    leaderboard.set_many([(1, 30.0), (2, 20.0), (3, 10.0)])
+    leaderboard._remove(2)
+    leaderboard._remove(4)
+    assert ranking(leaderboard) == [(1, 1, 30.0), (3, 2, 10.0)]
+    assert leaderboard.rank(2) is None and len(leaderboard) == 2
+
+
+def test_pages_stay_within_the_ranking() -> None:
+    """Pages past the end are empty, the last page is cut short, and a negative start reads from the top."""
+    leaderboard = Leaderboard()
+    leaderboard.set_many((user_id, float(user_id)) for user_id in range(25))
+    assert [user_id for user_id, _ in leaderboard.page(0, 10)] == list(range(24, 14, -1))
+    assert [user_id for user_id, _ in leaderboard.page(20, 10)] == list(range(4, -1, -1))
+    assert leaderboard.page(25, 10) == [] and leaderboard.page(100, 10) == []
+    assert leaderboard.page(-5, 3) == leaderboard.page(0, 3)
+    assert leaderboard.page(0, 0) == [] and Leaderboard().page(0, 10) == []
+
+
+def test_ranks_match_sorting_every_player() -> None:
+    """After many random moves, every rank is one more than the number of players rated strictly higher."""
+    rng = random.Random(25)
+    leaderboard = Leaderboard()
+    ratings = {}
+    for _ in range(500):
+        batch = [(rng.randrange(60), float(rng.randrange(20))) for _ in range(rng.randrange(1, 5))]
+        if rng.random() < 0.5:
+            for user_id, rating in batch:
+                leaderboard.set(user_id, rating)
+        else:
+            leaderboard.set_many(batch)
+        ratings.update(batch)
+        if rng.random() < 0.1:
+            removed = rng.randrange(60)
+            leaderboard._remove(removed)
+            ratings.pop(removed, None)
+    assert len(leaderboard) == len(ratings)
+    for user_id, rating in ratings.items():
+        assert leaderboard.rank(user_id) == 1 + sum(other > rating for other in ratings.values())
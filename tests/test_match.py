@@ -0,0 +1,55 @@
+"""Tests for the match history."""
+
+from typing import Callable
+
+from database.db import DBGlobalSession
+from database.models.match import MatchRecord, find_recent_matches, insert_matches
+
+
+def make_match(ended_at: float, user_ids: list) -> MatchRecord:
+    """Describes a finished game between the players, all on team 1 as tanks."""
+    return {
+        "guild_id": 6001,
+        "ended_at": ended_at,
+        "map": "Sky Temple",
+        "first_pick": 1,
+        "winner": 1,
+        "quality": 0.5,
+        "players": [
+            {
+                "user_id": user_id,
+                "team": 1,
+                "role": "tank",
+                "mu_before": 25.0,
+                "sigma_before": 8.0,
+                "mu_after": 26.0,
+                "sigma_after": 7.5,
+            }
+            for user_id in user_ids
+        ],
+    }
+
+
+def test_recent_matches_are_newest_first(run: Callable) -> None:
+    """A player's recent matches come newest first, only up to the limit, and leave out games they were not in."""
+
+    async def recent() -> list:
+        db_session = DBGlobalSession().new_session()
+        try:
+            await insert_matches(
+                [
+                    (6001, make_match(100.0, [6001, 6002])),
+                    (6002, make_match(300.0, [6001])),
+                    (6003, make_match(400.0, [6002])),
+                    (6004, make_match(200.0, [6001, 6002])),
+                ],
+                db_session,
+            )
+            await db_session.commit()
+            return await find_recent_matches(6001, 2, db_session)
+        finally:
+            await db_session.close()
+
+    matches = run(recent())
+    assert [match.id for _, match in matches] == [6002, 6004]
+    assert all(match_player.user_id == 6001 for match_player, _ in matches)
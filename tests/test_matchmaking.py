@@ -0,0 +1,174 @@
+"""Tests for the matchmaking search."""
+
+import itertools
+import math
+import random
+import tracemalloc
+from typing import List, Optional, Sequence
+
+import numpy as np
+import pytest
+import trueskill
+
+from benchmarks.fakes import DEFAULT_FILL_CHANCE, make_members, make_player_data
+from commands import matchmaking
+from commands.queue import get_role_costs
+from database.models.player_data import RATED_ROLES
+from util.env_load import MATCHMAKING_CANDIDATES
+
+# The most memory a search may allocate at its peak, which is mostly the bounded `allocate_roles` cache.
+PEAK_MEMORY_BYTES = 8 * 1024 * 1024
+
+
+def make_snapshot(
+    size: int, seed: int, fill_chance: float = DEFAULT_FILL_CHANCE, wait_weight: float = 0.0
+) -> matchmaking.QueueSnapshot:
+    """Packs a synthetic queue of `size` players into a snapshot, with up to 20 minute waits if `wait_weight` is set."""
+    rng = random.Random(seed)
+    members = make_members(size, rng, fill_chance=fill_chance)
+    data = [make_player_data(member.id, rng) for member in members]
+    return matchmaking.QueueSnapshot(
+        user_ids=[member.id for member in members],
+        costs=[get_role_costs(member) for member in members],
+        mus=[[getattr(player, f"{role}_mu") for role in RATED_ROLES] for player in data],
+        sigmas=[[getattr(player, f"{role}_sigma") for role in RATED_ROLES] for player in data],
+        waits=[rng.uniform(0, 1200) for _ in members] if wait_weight else None,
+        wait_weight=wait_weight,
+    )
+
+
+@pytest.mark.parametrize("size", [15, 30, 60])
+def test_search_memory_stays_bounded(size: int) -> None:
+    """Building a snapshot and searching it for candidate games peaks below a bound that is the same for any queue."""
+    matchmaking.allocate_roles.cache_clear()
+    tracemalloc.start()
+    try:
+        snapshot = make_snapshot(size, seed=size)
+        best_game, stats = matchmaking.search_best_game(snapshot, budget=5, keep=MATCHMAKING_CANDIDATES)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert best_game is not None and stats.candidates
+    assert peak < PEAK_MEMORY_BYTES
+
+
+def test_equal_ratings_give_varied_teams() -> None:
+    """When every split of a queue is equally good, searches keeping several games still pick teams at random."""
+    snapshot = matchmaking.QueueSnapshot(
+        user_ids=list(range(10)),
+        costs=[[matchmaking.MAIN_COST] * len(matchmaking.ROLE_SLOTS)] * 10,
+        mus=[[25.0] * len(RATED_ROLES)] * 10,
+        sigmas=[[3.0] * len(RATED_ROLES)] * 10,
+    )
+    teams = set()
+    for _ in range(20):
+        best_game, _ = matchmaking.search_best_game(snapshot, keep=MATCHMAKING_CANDIDATES)
+        team = best_game[1] if 0 in [player for player, _ in best_game[1]] else best_game[2]
+        teams.add(frozenset(player for player, _ in team))
+    assert len(teams) > 1
+
+
+def lowest_cost_roles(costs: Sequence[Sequence[int]], subset: Sequence[int]) -> List[List[int]]:
+    """Lists every way to put a 10 player subset on roles at the lowest total role cost, one player at a time."""
+    found: List[List[int]] = []
+    lowest = [math.inf]
+
+    def place(position: int, open_slots: List[int], roles: List[int], cost: int) -> None:
+        if cost > lowest[0]:
+            return
+        if position == len(subset):
+            if cost < lowest[0]:
+                lowest[0] = cost
+                found.clear()
+            found.append(list(roles))
+            return
+        for role, role_cost in enumerate(costs[subset[position]]):
+            if open_slots[role] and role_cost < matchmaking.INVALID_COST:
+                open_slots[role] -= 1
+                roles.append(role)
+                place(position + 1, open_slots, roles, cost + role_cost)
+                roles.pop()
+                open_slots[role] += 1
+
+    place(0, list(matchmaking.ROLE_SLOTS), [], 0)
+    return found
+
+
+def brute_force_score(snapshot: matchmaking.QueueSnapshot, required: Optional[int] = None) -> float:
+    """Scores every split of every lowest cost role assignment of every 10 player subset, returning the best score."""
+    bonuses = snapshot.wait_bonuses()
+    best = math.inf
+    for subset in itertools.combinations(range(len(snapshot.costs)), matchmaking.GAME_SIZE):
+        if required is not None and required not in subset:
+            continue
+        bonus = sum(bonuses[index] for index in subset) if bonuses is not None else 0.0
+        for roles in lowest_cost_roles(snapshot.costs, subset):
+            sigma_squared_total = sum(snapshot.sigmas[index][role] ** 2 for index, role in zip(subset, roles))
+            role_mus = [
+                [snapshot.mus[index][role] for index, role in zip(subset, roles) if role == category]
+                for category in range(len(matchmaking.ROLE_SLOTS))
+            ]
+            halves = [itertools.combinations(range(len(on_role)), len(on_role) // 2) for on_role in role_mus]
+            for picks in itertools.product(*halves):
+                mu_difference = sum(
+                    sum(on_role) - 2 * sum(on_role[position] for position in pick)
+                    for on_role, pick in zip(role_mus, picks)
+                )
+                quality = matchmaking.match_quality(mu_difference, sigma_squared_total, snapshot.beta)
+                best = min(best, abs(matchmaking.TARGET_QUALITY - quality) - bonus)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(16))
+def test_search_matches_brute_force(seed: int, monkeypatch: pytest.MonkeyPatch) -> None:
+    """With no tolerance, the search finds a game as good as trying every role assignment of every subset."""
+    monkeypatch.setattr(matchmaking, "QUALITY_TOLERANCE", 0.0)
+    snapshot = make_snapshot(11 + seed % 2, seed, fill_chance=0.5)
+    best_game, _ = matchmaking.search_best_game(snapshot)
+    assert matchmaking.game_score(best_game) == pytest.approx(brute_force_score(snapshot), abs=1e-12)
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_batch_quality_matches_trueskill(seed: int) -> None:
+    """Every stacked game's quality, and the one `find_best_quality` picks, is what `trueskill.quality` gives."""
+    rng = np.random.default_rng(seed)
+    mus = rng.normal(trueskill.MU, 6.0, (16, matchmaking.GAME_SIZE))
+    sigmas = rng.uniform(0.5, trueskill.SIGMA, (16, matchmaking.GAME_SIZE))
+    team_size = matchmaking.TEAM_SIZE
+    expected = [
+        trueskill.quality(
+            [
+                [trueskill.Rating(mu, sigma) for mu, sigma in zip(game_mus[:team_size], game_sigmas[:team_size])],
+                [trueskill.Rating(mu, sigma) for mu, sigma in zip(game_mus[team_size:], game_sigmas[team_size:])],
+            ]
+        )
+        for game_mus, game_sigmas in zip(mus, sigmas)
+    ]
+    np.testing.assert_allclose(matchmaking.batch_match_quality(mus, sigmas), expected, rtol=0, atol=1e-12)
+    index, quality = matchmaking.find_best_quality(mus, sigmas)
+    assert quality == pytest.approx(expected[index], abs=1e-12)
+    assert abs(matchmaking.TARGET_QUALITY - quality) == pytest.approx(
+        min(abs(matchmaking.TARGET_QUALITY - value) for value in expected), abs=1e-12
+    )
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_required_search_matches_brute_force(seed: int, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A search for games with a required player finds the best of them, as the matchmaker does on every join."""
+    monkeypatch.setattr(matchmaking, "QUALITY_TOLERANCE", 0.0)
+    snapshot = make_snapshot(11 + seed % 2, seed, fill_chance=0.5)
+    required = len(snapshot.user_ids) - 1
+    best_game, _ = matchmaking.search_best_game(snapshot, required=required)
+    assert required in [player for player, _ in best_game[1] + best_game[2]]
+    assert matchmaking.game_score(best_game) == pytest.approx(brute_force_score(snapshot, required), abs=1e-12)
+
+
+@pytest.mark.parametrize("seed", range(28))
+def test_wait_search_matches_brute_force(seed: int, monkeypatch: pytest.MonkeyPatch) -> None:
+    """With waits counting, the search finds the game with the best score once its players' wait bonuses are taken."""
+    monkeypatch.setattr(matchmaking, "QUALITY_TOLERANCE", 0.0)
+    snapshot = make_snapshot(11 + seed % 2, seed, fill_chance=0.5, wait_weight=0.001)
+    best_game, _ = matchmaking.search_best_game(snapshot)
+    assert matchmaking.game_score(best_game, snapshot.wait_bonuses()) == pytest.approx(
+        brute_force_score(snapshot), abs=1e-12
+    )
@@ -0,0 +1,151 @@
+"""Tests for the in-memory rating store."""
+
+from typing import Any, Callable, Dict, List, Self
+
+import pytest
+import trueskill
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+from database.db import DBGlobalSession
+from database.models import player_data
+from database.models.player_data import (
+    RATED_ROLES,
+    PlayerData,
+    RatingStore,
+    ensure_players_in_db,
+    load_rating_snapshot,
+    update_player_ratings,
+)
+
+
+def test_failed_write_is_not_applied(run: Callable, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A report whose write fails leaves the ratings as they were, so retrying it counts the game only once."""
+    user_id = 7001
+    update = (user_id, "tank", trueskill.Rating(30.0, 6.0), True)
+    store = RatingStore()
+    insert_matches = player_data.insert_matches
+
+    async def failing_insert(*args: object) -> None:
+        raise OperationalError("INSERT", {}, Exception("database is locked"))
+
+    async def report() -> None:
+        db_session = DBGlobalSession().new_session()
+        try:
+            await ensure_players_in_db([user_id], db_session)
+        finally:
+            await db_session.close()
+        await load_rating_snapshot([user_id])
+        monkeypatch.setattr(player_data, "insert_matches", failing_insert)
+        with pytest.raises(OperationalError):
+            await store.record([update])
+        monkeypatch.setattr(player_data, "insert_matches", insert_matches)
+
+    run(report())
+    row, column = store.index[user_id], RATED_ROLES.index("tank")
+    assert store.games_played[row, column] == 0
+    assert store.mus[row, column] == trueskill.MU
+    assert not store.pending
+
+    run(store.record([update]))
+    assert store.games_played[row, column] == 1
+    assert store.mus[row, column] == 30.0
+
+    async def stored_games_played() -> int:
+        db_session = DBGlobalSession().new_session()
+        try:
+            return (await db_session.get(PlayerData, user_id)).tank_games_played
+        finally:
+            await db_session.close()
+
+    assert run(stored_games_played()) == 1
+
+
+async def read_players(user_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """Reads every column of the players' rows, keyed by user id."""
+    db_session = DBGlobalSession().new_session()
+    try:
+        rows = (await db_session.execute(select(PlayerData.__table__).where(PlayerData.user_id.in_(user_ids)))).all()
+    finally:
+        await db_session.close()
+    return {row.user_id: row._asdict() for row in rows}
+
+
+class RacingSession:
+    """Stands in for a session, with another command creating a player just after the existing players are read."""
+
+    def __init__(self: Self, db_session: Any, racing_id: int) -> None:
+        """Init that takes in the session to stand in for, and the id of the player created meanwhile."""
+        self.db_session = db_session
+        self.racing_id = racing_id
+
+    async def scalars(self: Self, statement: Any) -> List[int]:
+        """Reads the players already in the database, then creates the racing player."""
+        existing_ids = list(await self.db_session.scalars(statement))
+        self.db_session.add(PlayerData(user_id=self.racing_id, tank_mu=20.0))
+        await self.db_session.flush()
+        return existing_ids
+
+    def __getattr__(self: Self, name: str) -> Any:
+        """Passes everything else through to the session."""
+        return getattr(self.db_session, name)
+
+
+def test_ensure_players_in_db_only_creates_missing_players(run: Callable) -> None:
+    """Players already in the database, or created while the rest are inserted, keep their rows as they were."""
+    existing_ids, new_ids, racing_id = [7101, 7102], [7103, 7104, 7105], 7106
+
+    async def ensure_mixed_players() -> None:
+        db_session = DBGlobalSession().new_session()
+        try:
+            db_session.add_all(
+                [PlayerData(user_id=user_id, tank_mu=30.0, tank_games_played=3) for user_id in existing_ids]
+            )
+            await db_session.commit()
+            user_ids = [new_ids[0], *existing_ids, *new_ids, racing_id, existing_ids[0]]
+            await ensure_players_in_db(user_ids, RacingSession(db_session, racing_id))
+        finally:
+            await db_session.close()
+
+    run(ensure_mixed_players())
+    rows = run(read_players([*existing_ids, *new_ids, racing_id]))
+    assert sorted(rows) == sorted([*existing_ids, *new_ids, racing_id])
+    for user_id in existing_ids:
+        assert rows[user_id]["tank_mu"] == 30.0 and rows[user_id]["tank_games_played"] == 3
+    for user_id in new_ids:
+        assert rows[user_id]["tank_mu"] == trueskill.MU and rows[user_id]["tank_games_played"] == 0
+    assert rows[racing_id]["tank_mu"] == 20.0
+
+
+def test_rating_updates_only_change_the_role_played(run: Callable) -> None:
+    """One batch of updates writes each player's rating on the role they played and counts the game there only."""
+    user_ids = [7111, 7112, 7113, 7114, 7115]
+    roles = ["tank", "support", "assassin", "assassin2", "offlane"]
+    updates = [
+        (user_id, role, trueskill.Rating(20.0 + index, 5.0 - index / 10), index % 2 == 0)
+        for index, (user_id, role) in enumerate(zip(user_ids, roles))
+    ]
+
+    async def update_twice() -> None:
+        db_session = DBGlobalSession().new_session()
+        try:
+            await ensure_players_in_db(user_ids, db_session)
+            for _ in range(2):
+                await update_player_ratings(updates, db_session)
+            await db_session.commit()
+        finally:
+            await db_session.close()
+
+    run(update_twice())
+    rows = run(read_players(user_ids))
+    for user_id, role, rating, won in updates:
+        played = player_data.get_rated_role(role)
+        for rated_role in RATED_ROLES:
+            row = rows[user_id]
+            if rated_role == played:
+                assert (row[f"{rated_role}_mu"], row[f"{rated_role}_sigma"]) == (rating.mu, rating.sigma)
+                assert row[f"{rated_role}_games_played"] == 2
+                assert row[f"{rated_role}_games_won"] == (2 if won else 0)
+            else:
+                assert (row[f"{rated_role}_mu"], row[f"{rated_role}_sigma"]) == (trueskill.MU, trueskill.SIGMA)
+                assert row[f"{rated_role}_games_played"] == row[f"{rated_role}_games_won"] == 0
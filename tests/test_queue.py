@@ -0,0 +1,166 @@
+"""Tests for the queue, and the matchmaker that keeps its best game up to date."""
+
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import pytest
+
+from benchmarks.fakes import FakeMember, make_members
+from commands import game, matchmaking, queue
+from util.exceptions import GuildNotConfiguredException
+
+
+@pytest.fixture()
+def search_threads(monkeypatch: pytest.MonkeyPatch) -> list:
+    """Records the thread of every matchmaking search, run slowly in a thread pool standing in for the process pool."""
+    threads = []
+    search_best_game = matchmaking.search_best_game
+
+    def slow_search(*args: Any) -> Any:
+        threads.append(threading.get_ident())
+        time.sleep(0.05)
+        return search_best_game(*args)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(matchmaking, "search_best_game", slow_search)
+    monkeypatch.setattr(queue, "_matchmaking_executor", executor)
+    monkeypatch.setattr(queue, "Member", FakeMember)
+    yield threads
+    executor.shutdown()
+
+
+def test_leave_searches_off_the_event_loop(run: Callable, search_threads: list) -> None:
+    """A player leaving the best game has the queue searched again in the executor, while the event loop runs on."""
+    guild_queue = queue.Queue(8001)
+    members = make_members(14, random.Random(8001), fill_chance=1.0, first_user_id=8001000)
+
+    async def leave_best_game() -> tuple:
+        for member in members:
+            await guild_queue.add(member)
+        best = guild_queue.matchmaker.best
+        in_best_game = {user_id for user_id, _ in best[1] + best[2]}
+        leaving = next(member for member in members if member.id in in_best_game)
+        search_threads.clear()
+
+        ticks = 0
+
+        async def tick() -> None:
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.005)
+
+        ticker = asyncio.create_task(tick())
+        await guild_queue.remove(leaving)
+        ticker.cancel()
+        return threading.get_ident(), ticks, leaving.id
+
+    loop_thread, ticks, left_id = run(leave_best_game())
+    assert search_threads and loop_thread not in search_threads
+    # The search sleeps for 50 ms, which the event loop spends running other tasks.
+    assert ticks >= 5
+    best = guild_queue.matchmaker.best
+    assert best is not None and left_id not in {user_id for user_id, _ in best[1] + best[2]}
+    guild_queue.clear()
+
+
+def test_clear_throws_away_a_running_search(run: Callable, search_threads: list) -> None:
+    """A search that was running when the queue was cleared does not bring its players back into the matchmaker."""
+    guild_queue = queue.Queue(8002)
+    members = make_members(10, random.Random(8002), fill_chance=1.0, first_user_id=8002000)
+
+    async def clear_while_searching() -> None:
+        for member in members[:-1]:
+            await guild_queue.add(member)
+        adding = asyncio.create_task(guild_queue.add(members[-1]))
+        while guild_queue.matchmaker.searched:
+            await asyncio.sleep(0.001)
+        guild_queue.clear()
+        await adding
+
+    run(clear_while_searching())
+    assert guild_queue.matchmaker.best is None
+    assert guild_queue.matchmaker.searched
+
+
+def test_failed_join_is_taken_back_out(run: Callable, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A join whose ratings cannot be read leaves no trace of the player, who can then join again."""
+    monkeypatch.setattr(queue, "Member", FakeMember)
+    guild_queue = queue.Queue(8003)
+    member = make_members(1, random.Random(8003), first_user_id=8003000)[0]
+    load_rating_arrays = queue.load_rating_arrays
+
+    async def failing_load(*args: Any) -> Any:
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(queue, "load_rating_arrays", failing_load)
+    with pytest.raises(RuntimeError):
+        run(guild_queue.add(member))
+    assert member not in guild_queue.queue and member.id not in guild_queue.joined_at
+    assert member.id not in guild_queue.matchmaker.players
+
+    monkeypatch.setattr(queue, "load_rating_arrays", load_rating_arrays)
+    assert run(guild_queue.add(member)) == (member.id, 1)
+    guild_queue.clear()
+
+
+def test_restoring_the_queue_traces_no_joins(run: Callable, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Players put back in the queue on startup are not traced as joining again, unlike players who join."""
+    monkeypatch.setattr(queue, "Member", FakeMember)
+    events = []
+    monkeypatch.setattr(queue, "record_queue_event", lambda event, user_id, **fields: events.append((event, user_id)))
+    guild_queue = queue.Queue(8004)
+    members = make_members(2, random.Random(8004), first_user_id=8004000)
+
+    run(guild_queue.add(members[0], restoring=True))
+    run(guild_queue.add(members[1]))
+    assert events == [("join", members[1].id)]
+    guild_queue.clear()
+
+
+def test_guilds_are_kept_apart(run: Callable, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Two guilds' queues and games never share players or locks, and a guild the ids are not set up for is rejected."""
+    monkeypatch.setattr(queue, "Member", FakeMember)
+    monkeypatch.setattr(game, "Member", FakeMember)
+    guild_ids = [8005, 8006]
+    members = {
+        guild_id: make_members(10, random.Random(guild_id), fill_chance=1.0, first_user_id=guild_id * 1000)
+        for guild_id in guild_ids
+    }
+
+    async def fill_queues() -> None:
+        for guild_id in guild_ids:
+            for member in members[guild_id]:
+                await queue.Queue(guild_id).add(member)
+
+    run(fill_queues())
+    for guild_id in guild_ids:
+        guild_queue = queue.Queue(guild_id)
+        assert guild_queue.queue == members[guild_id]
+        assert set(guild_queue.matchmaker.players) == {member.id for member in members[guild_id]}
+        best = guild_queue.matchmaker.best
+        assert {user_id for user_id, _ in best[1] + best[2]} == set(guild_queue.matchmaker.players)
+    assert queue.Queue(guild_ids[0]).matchmaker.lock is not queue.Queue(guild_ids[1]).matchmaker.lock
+
+    roles = list(game.RoleEnum)
+    registries = [game.GameRegistry(guild_id) for guild_id in guild_ids]
+    registries[0].get(1).assign_game(
+        {role: game.Player(member, role) for role, member in zip(roles, members[guild_ids[0]][:5])},
+        {role: game.Player(member, role) for role, member in zip(roles, members[guild_ids[0]][5:])},
+    )
+    assert registries[0].lock is not registries[1].lock
+    assert set(registries[0].playing_user_ids()) == {member.id for member in members[guild_ids[0]]}
+    assert not registries[1].playing_user_ids() and registries[1].free()
+    registries[0].get(1).reset_state()
+
+    monkeypatch.setattr(queue, "GUILD_ID", guild_ids[0])
+    with pytest.raises(GuildNotConfiguredException):
+        queue.Queue(8007)
+    with pytest.raises(GuildNotConfiguredException):
+        game.GameRegistry(8007)
+    for guild_id in guild_ids:
+        queue.Queue(guild_id).clear()
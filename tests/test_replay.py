@@ -0,0 +1,158 @@
+"""Tests for replaying the match history with new TrueSkill parameters."""
+
+import random
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import pytest
+import trueskill
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from database import replay
+from database.db import Base, DBGlobalSession
+from database.models.match import MatchRecord, insert_matches
+from database.models.player_data import RATED_ROLES, PlayerData, RatingStore, get_rated_role
+
+SLOTS = ["tank", "support", "assassin", "assassin2", "offlane"]
+
+
+@pytest.mark.parametrize("seed", range(12))
+def test_rate_match_matches_trueskill(seed: int) -> None:
+    """Rating a game in closed form gives what `env.rate` does, with draws possible and sigmas tiny or huge."""
+    rng = random.Random(seed)
+    env = trueskill.TrueSkill(draw_probability=[0.0, 0.1, 0.5][seed % 3], tau=[0.0, trueskill.TAU][seed % 2])
+    teams = [
+        [(rng.gauss(trueskill.MU, 10.0), rng.choice([1e-3, rng.uniform(0.5, 10.0), 50.0])) for _ in SLOTS]
+        for _ in range(2)
+    ]
+    rated = replay.rate_match(teams[0], teams[1], env)
+    expected = env.rate([[env.create_rating(mu, sigma) for mu, sigma in team] for team in teams], ranks=[0, 1])
+    for rated_team, expected_team in zip(rated, expected):
+        for (mu, sigma), rating in zip(rated_team, expected_team):
+            assert mu == pytest.approx(rating.mu, abs=1e-9)
+            assert sigma == pytest.approx(rating.sigma, abs=1e-9)
+
+
+def make_match(ended_at: float, user_ids: List[int], winner: int) -> MatchRecord:
+    """Describes a finished game with the first five players on team 1, each team taking the slots in order."""
+    return {
+        "guild_id": 5001,
+        "ended_at": ended_at,
+        "map": None,
+        "first_pick": None,
+        "winner": winner,
+        "quality": None,
+        "players": [
+            {
+                "user_id": user_id,
+                "team": 1 if index < len(SLOTS) else 2,
+                "role": SLOTS[index % len(SLOTS)],
+                "mu_before": 0.0,
+                "sigma_before": 0.0,
+                "mu_after": 0.0,
+                "sigma_after": 0.0,
+            }
+            for index, user_id in enumerate(user_ids)
+        ],
+    }
+
+
+# Two games between the same ten players, the second with their order reversed and team 2 winning.
+USER_IDS = list(range(5001, 5011))
+MATCHES = [(1, make_match(100.0, USER_IDS, 1)), (2, make_match(200.0, USER_IDS[::-1], 2))]
+# A player whose games were reported before matches were recorded.
+UNRECORDED_ID = 5011
+
+
+@pytest.fixture()
+def history(run: Callable, monkeypatch: pytest.MonkeyPatch) -> Iterator[None]:
+    """Points the replay at a database of its own, holding `MATCHES`, their players and one unrecorded player."""
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    session_class = DBGlobalSession()._session_class
+
+    async def create() -> None:
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        DBGlobalSession().assign_session_class(async_sessionmaker(engine, expire_on_commit=False))
+        db_session = DBGlobalSession().new_session()
+        try:
+            db_session.add_all([PlayerData(user_id=user_id) for user_id in USER_IDS])
+            db_session.add(PlayerData(user_id=UNRECORDED_ID, tank_games_played=5, tank_games_won=3))
+            await insert_matches(MATCHES, db_session)
+            await db_session.commit()
+        finally:
+            await db_session.close()
+
+    async def keep_database() -> None:
+        pass
+
+    run(create())
+    monkeypatch.setattr(replay, "init_db", keep_database)
+    # Replaying the empty journal takes the sequence number from this database, which the other tests do not use.
+    monkeypatch.setattr(RatingStore(), "sequence", RatingStore().sequence)
+    yield
+    DBGlobalSession().assign_session_class(session_class)
+    run(engine.dispose())
+
+
+async def read_players() -> Dict[int, Dict[str, Any]]:
+    """Reads every column of every player's row, keyed by user id."""
+    db_session = DBGlobalSession().new_session()
+    try:
+        rows = (await db_session.execute(select(PlayerData.__table__))).all()
+    finally:
+        await db_session.close()
+    return {row.user_id: row._asdict() for row in rows}
+
+
+def expected_players(env: trueskill.TrueSkill) -> Dict[Tuple[int, str], Tuple[trueskill.Rating, int, int]]:
+    """Rates `MATCHES` one after another with `env.rate`, giving each rating and the games played and won on it."""
+    players: Dict[Tuple[int, str], Tuple[trueskill.Rating, int, int]] = {}
+    for _, match in MATCHES:
+        teams = [
+            [
+                (player["user_id"], get_rated_role(player["role"]))
+                for player in match["players"]
+                if player["team"] == team
+            ]
+            for team in (match["winner"], 3 - match["winner"])
+        ]
+        before = [[players.get(key, (env.create_rating(), 0, 0)) for key in team] for team in teams]
+        rated = env.rate([[rating for rating, _, _ in team] for team in before], ranks=[0, 1])
+        for won, team, team_before, rated_team in zip([1, 0], teams, before, rated):
+            for key, (_, played, wins), rating in zip(team, team_before, rated_team):
+                players[key] = (rating, played + 1, wins + won)
+    return players
+
+
+def test_dry_run_writes_nothing(run: Callable, history: None) -> None:
+    """A dry run counts the matches and the players who would change, and leaves every player as they were."""
+    before = run(read_players())
+    result = run(replay.run(replay.parse_args(["--dry-run", "--force", "--mu", "30"])))
+    assert result["matches"] == len(MATCHES)
+    assert result["players_changed"] == len(USER_IDS) + 1
+    assert result["write_seconds"] is None
+    assert run(read_players()) == before
+
+
+def test_players_missing_games_need_force(run: Callable, history: None) -> None:
+    """Nothing is written while a player has games the history lacks, and `--force` writes the replayed ratings."""
+    before = run(read_players())
+    result = run(replay.run(replay.parse_args(["--mu", "30", "--draw-probability", "0.2"])))
+    assert result["players_missing_games"] == 1 and result["write_seconds"] is None
+    assert run(read_players()) == before
+
+    result = run(replay.run(replay.parse_args(["--mu", "30", "--draw-probability", "0.2", "--force"])))
+    assert result["write_seconds"] is not None
+    base_env = trueskill.global_env()
+    env = trueskill.TrueSkill(mu=30.0, sigma=base_env.sigma, beta=base_env.beta, tau=base_env.tau, draw_probability=0.2)
+    expected = expected_players(env)
+    players = run(read_players())
+    for user_id in USER_IDS:
+        for role in RATED_ROLES:
+            rating, played, won = expected.get((user_id, role), (env.create_rating(), 0, 0))
+            assert players[user_id][f"{role}_mu"] == pytest.approx(rating.mu, abs=1e-9)
+            assert players[user_id][f"{role}_sigma"] == pytest.approx(rating.sigma, abs=1e-9)
+            assert (players[user_id][f"{role}_games_played"], players[user_id][f"{role}_games_won"]) == (played, won)
+    assert players[UNRECORDED_ID]["tank_games_played"] == players[UNRECORDED_ID]["tank_games_won"] == 0
+    assert players[UNRECORDED_ID]["tank_mu"] == 30.0
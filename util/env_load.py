@@ -23,3 +23,28 @@ LOBBY_CHANNEL_ID = int(os.environ.get("LOBBY_CHANNEL_ID"))
 TEAM_1_CHANNEL_ID = int(os.environ.get("TEAM_1_CHANNEL_ID"))
 TEAM_2_CHANNEL_ID = int(os.environ.get("TEAM_2_CHANNEL_ID"))
 GENERAL_CHANNEL_ID = int(os.environ.get("GENERAL_CHANNEL_ID"))
+# Team voice channels for running more games at once, as "team 1 id:team 2 id" pairs separated by commas.
+EXTRA_GAME_CHANNEL_IDS = [
+    tuple(int(channel_id) for channel_id in pair.split(":"))
+    for pair in os.environ.get("EXTRA_GAME_CHANNEL_IDS", "").split(",")
+    if pair.strip()
+]
+
+# The guild the role and channel ids above belong to. Commands in any other guild are rejected. If not set, every guild
+# the bot is in is served with these ids.
+GUILD_ID = int(os.environ["GUILD_ID"]) if os.environ.get("GUILD_ID") else None
+
+MATCHMAKING_WORKERS = int(os.environ.get("MATCHMAKING_WORKERS", os.cpu_count() or 1))
+# How long a matchmaking search may run for, in milliseconds. 0 lets searches run until they have covered every game.
+MATCHMAKING_BUDGET_MS = int(os.environ.get("MATCHMAKING_BUDGET_MS", 300))
+MATCHMAKING_CACHE_SIZE = int(os.environ.get("MATCHMAKING_CACHE_SIZE", 32))
+# How many of the best games a search keeps, so `/reshuffle` can switch to the next one without searching again.
+MATCHMAKING_CANDIDATES = int(os.environ.get("MATCHMAKING_CANDIDATES", 5))
+# How much further from the target match quality a game may be for every minute each of its players has waited.
+MATCHMAKING_WAIT_WEIGHT = float(os.environ.get("MATCHMAKING_WAIT_WEIGHT", 0))
+# File to append every queue join and leave to as JSON lines, for `benchmarks.queue_simulator` to replay.
+QUEUE_TRACE_PATH = os.environ.get("QUEUE_TRACE_PATH") or None
+# File that reported ratings are journaled to until they are written to the database. Written right away if not set.
+RATING_JOURNAL_PATH = os.environ.get("RATING_JOURNAL_PATH") or None
+# Seconds between writes of journaled ratings to the database.
+RATING_FLUSH_SECONDS = float(os.environ.get("RATING_FLUSH_SECONDS", 60))
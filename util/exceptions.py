@@ -37,12 +37,26 @@ class NoValidGameException(Exception):
     pass
 
 
+class NoOtherGameException(Exception):
+    """Exception that is called when a game is reshuffled, but no other game can be made from the queue."""
+
+    pass
+
+
 class NoGameInProgressException(Exception):
     """Exception that is called when there is no game in progress."""
 
     pass
 
 
+class GameNotFoundException(Exception):
+    """Exception that is called when a game is looked up by a number that has no voice channels set up."""
+
+    def __init__(self: Self, number: int) -> None:
+        """Init that takes in the game number to return a descriptive message."""
+        self.number = number
+
+
 class NotAdminException(Exception):
     """Exception that is called when a user is not an admin, but tries to use a protected command."""
 
@@ -63,6 +77,14 @@ class NoGuildException(Exception):
     pass
 
 
+class GuildNotConfiguredException(Exception):
+    """Exception that is called when a command is used in a guild the role and channel ids are not set up for."""
+
+    def __init__(self: Self, guild_id: int) -> None:
+        """Init that takes in the guild's id to return a descriptive message."""
+        self.guild_id = guild_id
+
+
 class ChannelNotFoundException(Exception):
     """Exception that is called when a channel is not found by its ID."""
 